@@ -0,0 +1,770 @@
+"""
+A script to benchmark the camera system without the need to connect to
+the actual OAK cameras or to a server.
+
+The DepthAI Device object is replaced by a fake device that simulates the
+USB boot and pipeline upload time of a real OAK camera, and answers capture
+events with a synthetic still after a short delay. The brightness of the
+still follows the exposure time and ISO set in the capture event, so the
+exposure control can be exercised as well. Image processing stages
+are benchmarked on synthetic 12 MP frames.
+
+The pipeline benchmark runs the whole capture and upload path, from
+CameraHandler to DashboardHandler, with fake devices and a local folder
+standing in for the server behind an emulated link. It fires bursts of
+triggers and measures the latency from trigger to images saved on the host
+device and to images confirmed on the server, the throughput, and the
+average duration of every stage recorded in the metrics registry.
+
+All results can be written to a JSON file, so that runs of different versions
+can be compared.
+
+Typical usage example:
+
+    python3 benchmark.py
+    python3 benchmark.py --boot-time 2.0 --iterations 10
+    python3 benchmark.py --benchmark metering
+    python3 benchmark.py --benchmark profiles
+    python3 benchmark.py --benchmark sharpness
+    python3 benchmark.py --benchmark pipeline --output results.json
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import queue
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import cv2
+import depthai as dai
+import numpy as np
+from numpy.linalg import norm
+from camera_handler import (BrightnessMeter, Camera, CameraHandler, DeviceSession, GammaSolver,
+                            SharpnessMeter)
+from dashboard_handler import DashboardHandler
+from dashboard_transport import LocalDirectoryTransport
+from encoding_profile import ENCODING_PROFILES
+from metrics import REGISTRY
+from spool_index import SpoolIndex
+from storage_handler import StorageHandler
+
+FRAME_SHAPE = (3040, 4056, 3) # Height, width and channels of a 12 MP still
+# Timestamp folders are named to the second, so triggers closer than this would
+# write to the same folder
+MIN_TRIGGER_INTERVAL = 1.0
+
+class FakeImgFrame:
+    """
+    A class that mimics DepthAI's ImgFrame object holding a synthetic still.
+    """
+
+    def __init__(self, frame, exposure_time_us, sensitivity_iso, encoded_image=None,
+                 sequence_number=0):
+        self.frame = frame
+        self.exposure_time_us = exposure_time_us
+        self.sensitivity_iso = sensitivity_iso
+        self.encoded_image = encoded_image
+        self.sequence_number = sequence_number
+
+    def getCvFrame(self):
+        """
+        Return the synthetic still as an OpenCV BGR frame.
+        """
+        return self.frame
+
+    def getData(self):
+        """
+        Return the JPEG bitstream of a still encoded on the device.
+        """
+        return self.encoded_image
+
+    def getExposureTime(self):
+        """
+        Return the exposure time the still was taken with.
+        """
+        return datetime.timedelta(microseconds=self.exposure_time_us)
+
+    def getSensitivity(self):
+        """
+        Return the ISO the still was taken with.
+        """
+        return self.sensitivity_iso
+
+    def getSequenceNum(self):
+        """
+        Return the number of the sensor frame the still was taken from.
+        """
+        return self.sequence_number
+
+class FakeInputQueue:
+    """
+    A class that mimics DepthAI's DataInputQueue. Every capture event sent
+    through it makes the fake device output a still after the capture delay.
+    """
+
+    def __init__(self, fake_device):
+        self.fake_device = fake_device
+
+    def send(self, ctrl):
+        """
+        Receive a capture event and schedule a still on the output queue.
+        """
+        if self.fake_device.isClosed():
+            raise RuntimeError("Communication exception - possible device error/misconfiguration")
+        exposure_time_us = ctrl.getExposureTime().total_seconds() * 1e6
+        if exposure_time_us > 0:
+            self.fake_device.exposure_time_us = exposure_time_us
+            self.fake_device.sensitivity_iso = ctrl.getSensitivity()
+        timer = threading.Timer(self.fake_device.capture_delay, self.fake_device.output_still)
+        timer.daemon = True
+        timer.start()
+
+class FakeOutputQueue:
+    """
+    A class that mimics DepthAI's non-blocking DataOutputQueue of size 1.
+    """
+
+    def __init__(self):
+        self.messages = queue.Queue(maxsize=1)
+        self.callbacks = []
+
+    def put(self, message):
+        """
+        Put a message in the queue, discarding the oldest one if the queue is full,
+        and run the registered callbacks.
+        """
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            self.tryGet()
+            self.messages.put_nowait(message)
+        for callback in self.callbacks:
+            callback(message)
+
+    def addCallback(self, callback):
+        """
+        Register a callback to run whenever a message arrives.
+        """
+        self.callbacks.append(callback)
+        return len(self.callbacks) - 1
+
+    def has(self):
+        """
+        Check whether there is a message in the queue.
+        """
+        return not self.messages.empty()
+
+    def get(self):
+        """
+        Block until a message is available.
+        """
+        return self.messages.get()
+
+    def tryGet(self):
+        """
+        Return a message if there is one, otherwise None.
+        """
+        try:
+            return self.messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def tryGetAll(self):
+        """
+        Return all messages in the queue.
+        """
+        messages = []
+        while self.has():
+            messages.append(self.tryGet())
+        return messages
+
+class FakeDevice:
+    """
+    A class that mimics DepthAI's Device object, including the time it takes
+    to boot the device and upload the pipeline.
+
+    The scene brightness is the brightness of a still taken with the auto exposure
+    setting of 10000 us at ISO 100. Stills taken with a manual exposure are scaled
+    by the exposure relative to that.
+
+    With on-device encoding, stills are sent as JPEG bitstreams and a preview
+    frame is sent along with every still.
+    """
+    AUTO_EXPOSURE_TIME_US = 10000
+    AUTO_SENSITIVITY_ISO = 100
+
+    def __init__(self, oak_device_info, boot_time=1.5, pipeline_upload_time=0.5,
+                 capture_delay=0.1, frame_shape=FRAME_SHAPE, scene_brightness=80,
+                 on_device_encoding=False, preview_size=(320, 240)):
+        del oak_device_info
+        time.sleep(boot_time)
+        self.pipeline_upload_time = pipeline_upload_time
+        self.capture_delay = capture_delay
+        self.scene_frame = generate_synthetic_frame(scene_brightness, frame_shape)
+        self.exposure_time_us = self.AUTO_EXPOSURE_TIME_US
+        self.sensitivity_iso = self.AUTO_SENSITIVITY_ISO
+        self.on_device_encoding = on_device_encoding
+        self.preview_size = preview_size
+        self.output_queue = FakeOutputQueue()
+        self.preview_queue = FakeOutputQueue()
+        self.sequence_number = 0 # Number of the last sensor frame
+        self.closed = False
+
+    def startPipeline(self, pipeline):
+        """
+        Simulate uploading the pipeline to the device.
+        """
+        del pipeline
+        time.sleep(self.pipeline_upload_time)
+
+    def getInputQueue(self, name, maxSize, blocking):
+        """
+        Return the fake control queue.
+        """
+        del name, maxSize, blocking
+        return FakeInputQueue(self)
+
+    def getOutputQueue(self, name, maxSize, blocking):
+        """
+        Return the fake still or preview queue.
+        """
+        del maxSize, blocking
+        return self.preview_queue if name == DeviceSession.PREVIEW_STREAM_NAME \
+            else self.output_queue
+
+    def output_still(self):
+        """
+        Put a synthetic still taken with the current exposure on the still queue.
+        """
+        if self.closed:
+            return
+        exposure_ratio = (self.exposure_time_us * self.sensitivity_iso
+                          / (self.AUTO_EXPOSURE_TIME_US * self.AUTO_SENSITIVITY_ISO))
+        if exposure_ratio == 1:
+            frame = self.scene_frame
+        else:
+            frame = cv2.convertScaleAbs(self.scene_frame, alpha=exposure_ratio)
+        self.sequence_number += 1
+        if not self.on_device_encoding:
+            self.output_queue.put(FakeImgFrame(frame, self.exposure_time_us,
+                                               self.sensitivity_iso,
+                                               sequence_number=self.sequence_number))
+            return
+        self.preview_queue.put(FakeImgFrame(
+            cv2.resize(frame, self.preview_size, interpolation=cv2.INTER_AREA),
+            self.exposure_time_us, self.sensitivity_iso, sequence_number=self.sequence_number))
+        self.output_queue.put(FakeImgFrame(None, self.exposure_time_us, self.sensitivity_iso,
+                                           encoded_image=cv2.imencode(".jpg", frame)[1],
+                                           sequence_number=self.sequence_number))
+
+    def getUsbSpeed(self):
+        """
+        Return the USB speed of the device.
+        """
+        return dai.UsbSpeed.SUPER
+
+    def isClosed(self):
+        """
+        Check whether the device was closed.
+        """
+        return self.closed
+
+    def close(self):
+        """
+        Close the device.
+        """
+        self.closed = True
+
+def capture_through_session(device_session, capture_timeout=5.0):
+    """
+    Send a capture event through a device session and wait for the still.
+    """
+    input_control_queue, _ = device_session.get_queues()
+    device_session.clear_received_stills()
+    ctrl = dai.CameraControl()
+    ctrl.setCaptureStill(True)
+    input_control_queue.send(ctrl)
+    return device_session.wait_for_still(capture_timeout).getCvFrame()
+
+def benchmark_device_session(iterations, boot_time, pipeline_upload_time, capture_delay):
+    """
+    Compare the capture latency of opening a new Device object for every capture
+    (cold) against reusing a long-lived device session (warm).
+
+    Returns:
+        dict : the capture latencies in seconds for the cold and warm paths
+
+    """
+    def device_factory(oak_device_info):
+        return FakeDevice(oak_device_info, boot_time=boot_time,
+                          pipeline_upload_time=pipeline_upload_time,
+                          capture_delay=capture_delay)
+
+    cold_latencies = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        device_session = DeviceSession(None, None, device_factory=device_factory)
+        capture_through_session(device_session)
+        device_session.close()
+        cold_latencies.append(time.perf_counter() - start_time)
+
+    warm_latencies = []
+    device_session = DeviceSession(None, None, device_factory=device_factory)
+    device_session.open()
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        capture_through_session(device_session)
+        warm_latencies.append(time.perf_counter() - start_time)
+    device_session.close()
+
+    return {"cold": cold_latencies, "warm": warm_latencies}
+
+def generate_synthetic_frame(mean_brightness, frame_shape=FRAME_SHAPE, seed=0):
+    """
+    Generate a noisy BGR frame with a horizontal gradient around a mean brightness.
+    """
+    random_generator = np.random.default_rng(seed)
+    height, width, channels = frame_shape
+    gradient = np.linspace(-30, 30, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    noise = random_generator.normal(0, 20, size=(height, width, channels)).astype(np.float32)
+    return np.clip(mean_brightness + gradient + noise, 0, 255).astype(np.uint8)
+
+def legacy_brightness(frame):
+    """
+    Measure brightness the way Camera did before the brightness meter.
+    """
+    return np.average(norm(frame, axis=2)) / np.sqrt(3)
+
+def classify_brightness(brightness):
+    """
+    Classify a brightness into the decision Camera takes on it.
+    """
+    if brightness < Camera.BRIGHTNESS_REJECT_LOW:
+        return "reject dark"
+    if brightness > Camera.BRIGHTNESS_REJECT_HIGH:
+        return "reject bright"
+    if brightness < Camera.BRIGHTNESS_LOW:
+        return "gamma down"
+    if brightness > Camera.BRIGHTNESS_HIGH:
+        return "gamma up"
+    return "accept"
+
+def measure_time_and_memory(function, frame, iterations):
+    """
+    Measure the average run time and the peak memory allocated by a function.
+    """
+    tracemalloc.start()
+    result = function(frame)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        function(frame)
+    return result, (time.perf_counter() - start_time) / iterations, peak_memory
+
+def benchmark_brightness_metering(iterations, mean_brightness_list=(25, 55, 80, 110, 150)):
+    """
+    Compare the full-frame floating point brightness measurement against the
+    brightness meter on synthetic frames, including whether both lead to the
+    same decision.
+
+    Returns:
+        list : one dict per synthetic frame with the brightness, time and peak
+            memory of both measurements
+
+    """
+    brightness_meter = BrightnessMeter()
+    results = []
+    for mean_brightness in mean_brightness_list:
+        frame = generate_synthetic_frame(mean_brightness)
+        legacy_result, legacy_time, legacy_memory = measure_time_and_memory(
+            legacy_brightness, frame, iterations)
+        meter_result, meter_time, meter_memory = measure_time_and_memory(
+            brightness_meter.measure, frame, iterations)
+        results.append({"legacy_brightness": legacy_result, "legacy_time": legacy_time,
+                        "legacy_peak_memory": legacy_memory,
+                        "meter_brightness": meter_result, "meter_time": meter_time,
+                        "meter_peak_memory": meter_memory,
+                        "same_decision": (classify_brightness(legacy_result)
+                                          == classify_brightness(meter_result))})
+    return results
+
+def legacy_gamma_correction(frame, gamma=1.0, gamma_step=0.01):
+    """
+    Correct brightness the way Camera did before the gamma solver, by nudging
+    gamma up to 10 times and re-measuring the full frame after every step.
+    """
+    brightness = legacy_brightness(frame)
+    counter = 0
+    while counter < 10 and (brightness > Camera.BRIGHTNESS_HIGH
+                            or brightness < Camera.BRIGHTNESS_LOW):
+        gamma += gamma_step if brightness > Camera.BRIGHTNESS_HIGH else -gamma_step
+        gamma_table = [np.power(x / 255.0, gamma) * 255.0 for x in range(256)]
+        frame = cv2.LUT(frame, np.round(np.array(gamma_table)).astype(np.uint8))
+        brightness = legacy_brightness(frame)
+        counter += 1
+    return frame
+
+def solver_gamma_correction(frame, brightness_meter=BrightnessMeter()):
+    """
+    Correct brightness with the gamma solver in a single LUT pass.
+    """
+    gamma = GammaSolver.solve(brightness_meter.histogram(frame), Camera.BRIGHTNESS_TARGET)
+    return GammaSolver.apply(frame, gamma)
+
+def benchmark_gamma_correction(iterations, mean_brightness_list=(50, 60, 100, 120)):
+    """
+    Compare the iterative gamma correction against the gamma solver on synthetic
+    frames that need correction.
+
+    Returns:
+        list : one dict per synthetic frame with the time taken and the brightness
+            reached by both corrections
+
+    """
+    brightness_meter = BrightnessMeter()
+    results = []
+    for mean_brightness in mean_brightness_list:
+        frame = generate_synthetic_frame(mean_brightness)
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            legacy_frame = legacy_gamma_correction(frame)
+        legacy_time = (time.perf_counter() - start_time) / iterations
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            solver_frame = solver_gamma_correction(frame, brightness_meter)
+        solver_time = (time.perf_counter() - start_time) / iterations
+        results.append({"input_brightness": brightness_meter.measure(frame),
+                        "legacy_brightness": brightness_meter.measure(legacy_frame),
+                        "legacy_time": legacy_time,
+                        "solver_brightness": brightness_meter.measure(solver_frame),
+                        "solver_time": solver_time})
+    return results
+
+def benchmark_encoding_profiles(iterations, mean_brightness_list=(60, 110)):
+    """
+    Encode synthetic frames with every encoding profile. The synthetic frames are
+    noisier than real stills, so the sizes are an upper bound, but they compare
+    the profiles fairly.
+
+    Returns:
+        list : one dict per profile with the average size of an encoded image in
+            bytes and the average encode time
+
+    """
+    frame_list = [generate_synthetic_frame(mean_brightness)
+                  for mean_brightness in mean_brightness_list]
+    results = []
+    for encoding_profile in ENCODING_PROFILES.values():
+        image_sizes = []
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            for frame in frame_list:
+                image_sizes.append(len(encoding_profile.encode(frame)))
+        results.append({"profile": encoding_profile.name,
+                        "image_size": statistics.mean(image_sizes),
+                        "encode_time": ((time.perf_counter() - start_time)
+                                        / (iterations * len(frame_list)))})
+    return results
+
+def legacy_sharpness(frame):
+    """
+    Score sharpness with the variance of the Laplacian of the full resolution luma plane.
+    """
+    return cv2.Laplacian(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()
+
+def benchmark_sharpness_selection(iterations, blur_length_list=(9, 0, 25, 5)):
+    """
+    Score a synthetic burst of stills blurred by horizontal motion of different
+    lengths, at full resolution and with the sharpness meter, on raw frames and on
+    JPEG bitstreams as encoded on the device.
+
+    Returns:
+        list : one dict per measurement with the average time to score a still, and
+            whether the still without motion blur scored highest
+
+    """
+    scene_frame = generate_synthetic_frame(80)
+    # Vertical bars give the scene edges that motion blur smears
+    scene_frame[:, (np.arange(FRAME_SHAPE[1]) // 64) % 2 == 0] //= 2
+    burst_frame_list = [cv2.blur(scene_frame, (blur_length, 1)) if blur_length > 1
+                        else scene_frame for blur_length in blur_length_list]
+    burst_image_list = [cv2.imencode(".jpg", frame)[1] for frame in burst_frame_list]
+    sharpest_index = blur_length_list.index(min(blur_length_list))
+    sharpness_meter = SharpnessMeter()
+
+    results = []
+    for measurement, score_function, still_list in (
+            ("full resolution", legacy_sharpness, burst_frame_list),
+            ("meter", sharpness_meter.measure, burst_frame_list),
+            ("meter on JPEG", sharpness_meter.measure_encoded, burst_image_list)):
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            sharpness_scores = [score_function(still) for still in still_list]
+        results.append({"measurement": measurement,
+                        "score_time": ((time.perf_counter() - start_time)
+                                       / (iterations * len(still_list))),
+                        "scores": sharpness_scores,
+                        "sharpest_selected": int(np.argmax(sharpness_scores)) == sharpest_index})
+    return results
+
+class BenchmarkDashboardHandler(DashboardHandler):
+    """
+    A DashboardHandler that records when every timestamp folder is completely sent.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.uploaded_time_dictionary = {}
+        self.uploaded_condition = threading.Condition()
+
+    def send_timestamp_folders(self, upload_job_list, bandwidth_limit=None):
+        """
+        Send a batch of timestamp folders, and record the ones that were removed from
+        the host device afterwards, that is, completely sent.
+        """
+        sent_byte_count = super().send_timestamp_folders(upload_job_list, bandwidth_limit)
+        uploaded_time = time.monotonic()
+        with self.uploaded_condition:
+            for upload_job in upload_job_list:
+                if not os.path.exists(upload_job.timestamp_folder_directory):
+                    self.uploaded_time_dictionary.setdefault(
+                        upload_job.timestamp_folder_directory, uploaded_time)
+            self.uploaded_condition.notify_all()
+        return sent_byte_count
+
+def benchmark_pipeline(burst_count=3, burst_size=3, burst_pause=3.0, camera_count=2,
+                       capture_delay=0.1, frame_shape=FRAME_SHAPE, link_bandwidth=10e6,
+                       link_round_trip_time=0.05, upload_timeout=120.0):
+    """
+    Run bursts of triggers through the capture and upload path with fake devices and
+    a local folder standing in for the server, behind an emulated link.
+
+    Args:
+        burst_count (int) : the number of bursts of triggers
+        burst_size (int) : the number of triggers per burst, MIN_TRIGGER_INTERVAL apart
+        burst_pause (float) : the time between two bursts, in seconds
+        camera_count (int) : the number of fake cameras
+        capture_delay (float) : the simulated time between capture event and still
+        frame_shape (tuple) : the shape of the synthetic stills
+        link_bandwidth (float) : the bandwidth of the emulated link, in bytes per second.
+                                None for no limit
+        link_round_trip_time (float) : the round trip time of the emulated link, in seconds
+        upload_timeout (float) : the longest time to wait for all images to be sent
+                                after the last trigger, in seconds
+
+    Returns:
+        dict : the trigger to saved and trigger to uploaded latencies in seconds, the
+            number of triggers and of folders and images sent, the throughput in
+            images and bytes per second, and the statistics of every stage
+
+    """
+    REGISTRY.reset()
+    with tempfile.TemporaryDirectory() as benchmark_directory:
+        local_images_saving_directory = os.path.join(benchmark_directory, "images")
+        os.makedirs(local_images_saving_directory)
+        spool_index = SpoolIndex(os.path.join(local_images_saving_directory,
+                                              SpoolIndex.DATABASE_FILE_NAME),
+                                 local_images_saving_directory)
+        storage_handler = StorageHandler()
+
+        def device_factory(oak_device_info):
+            return FakeDevice(oak_device_info, boot_time=0, pipeline_upload_time=0,
+                              capture_delay=capture_delay, frame_shape=frame_shape)
+
+        camera_list = [Camera(liftbot_id="LB0", camera_name=f"camera{camera_id}",
+                              oak_device_info=None, oak_device_pipeline=None,
+                              storage_handler=storage_handler, device_factory=device_factory)
+                       for camera_id in range(camera_count)]
+        camera_handler = CameraHandler(liftbot_id="LB0",
+                                       local_images_saving_directory=
+                                       local_images_saving_directory,
+                                       rm_speed_threshold=0, camera_position_mapping={},
+                                       storage_handler=storage_handler,
+                                       kewazo_camera_object_list=camera_list,
+                                       spool_index=spool_index)
+        dashboard_handler = BenchmarkDashboardHandler(
+            liftbot_id="LB0", ssh_pass_file_name=None, connection_port=None,
+            dashboard_host_name=None, dashboard_host_ip=None,
+            dashboard_top_saving_directory="images",
+            local_images_saving_directory=local_images_saving_directory,
+            dashboard_transport=LocalDirectoryTransport(
+                os.path.join(benchmark_directory, "server"), link_bandwidth,
+                link_round_trip_time),
+            spool_index=spool_index)
+
+        saved_time_dictionary = {}
+        def record_saved_time(timestamp_saving_directory):
+            saved_time_dictionary[timestamp_saving_directory] = time.monotonic()
+        camera_handler.add_capture_completed_callback(record_saved_time)
+        camera_handler.add_capture_completed_callback(dashboard_handler.notify_folder_ready)
+        dashboard_handler.start()
+
+        # Open the device sessions first, so that the boot is not part of the latencies
+        for camera in camera_list:
+            camera.device_session.open()
+
+        trigger_time_dictionary = {}
+        start_time = time.monotonic()
+        for burst_id in range(burst_count):
+            if burst_id > 0:
+                time.sleep(burst_pause)
+            for trigger_id in range(burst_size):
+                if trigger_id > 0:
+                    # Wait for the next second, so that every trigger gets its own folder
+                    time.sleep(MIN_TRIGGER_INTERVAL - time.time() % MIN_TRIGGER_INTERVAL + 0.01)
+                trigger_time = time.monotonic()
+                trigger_time_dictionary[camera_handler.process_images()] = trigger_time
+
+        with dashboard_handler.uploaded_condition:
+            dashboard_handler.uploaded_condition.wait_for(
+                lambda: set(trigger_time_dictionary) <= set(
+                    dashboard_handler.uploaded_time_dictionary), timeout=upload_timeout)
+            uploaded_time_dictionary = dict(dashboard_handler.uploaded_time_dictionary)
+        end_time = max(uploaded_time_dictionary.values(), default=time.monotonic())
+        upload_progress = dashboard_handler.get_upload_progress()
+        stage_statistics = REGISTRY.get_stage_statistics()
+
+        dashboard_handler.close()
+        camera_handler.close()
+        spool_index.close()
+
+    return {"triggers": len(trigger_time_dictionary),
+            "uploaded_folders": len(uploaded_time_dictionary),
+            "uploaded_images": stage_statistics.get("written_to_uploaded", {}).get("count", 0),
+            "uploaded_bytes": upload_progress["sent_bytes"],
+            "trigger_to_saved": [saved_time_dictionary[folder] - trigger_time
+                                 for folder, trigger_time in trigger_time_dictionary.items()
+                                 if folder in saved_time_dictionary],
+            "trigger_to_uploaded": [uploaded_time_dictionary[folder] - trigger_time
+                                    for folder, trigger_time in trigger_time_dictionary.items()
+                                    if folder in uploaded_time_dictionary],
+            "image_throughput": (stage_statistics.get("written_to_uploaded", {}).get("count", 0)
+                                 / (end_time - start_time)),
+            "byte_throughput": upload_progress["sent_bytes"] / (end_time - start_time),
+            "stages": stage_statistics}
+
+def get_git_revision():
+    """
+    Get the git commit the benchmark is run on, or None outside a git repository.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_latencies(title, latencies):
+    """
+    Print the mean, median and maximum of a list of latencies.
+    """
+    print(f"{title:<28} mean {statistics.mean(latencies) * 1000:9.1f} ms   "
+          f"median {statistics.median(latencies) * 1000:9.1f} ms   "
+          f"max {max(latencies) * 1000:9.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the camera system on fake devices")
+    parser.add_argument("--benchmark",
+                        choices=["all", "session", "metering", "gamma", "profiles", "sharpness",
+                                 "pipeline"],
+                        default="all")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--boot-time", type=float, default=1.5,
+                        help="Simulated USB boot time of the device, in seconds")
+    parser.add_argument("--pipeline-upload-time", type=float, default=0.5,
+                        help="Simulated pipeline upload time, in seconds")
+    parser.add_argument("--capture-delay", type=float, default=0.1,
+                        help="Simulated time between capture event and still, in seconds")
+    parser.add_argument("--burst-count", type=int, default=3,
+                        help="Bursts of triggers in the pipeline benchmark")
+    parser.add_argument("--burst-size", type=int, default=3,
+                        help="Triggers per burst, one second apart")
+    parser.add_argument("--burst-pause", type=float, default=3.0,
+                        help="Time between two bursts, in seconds")
+    parser.add_argument("--link-bandwidth", type=float, default=10e6,
+                        help="Bandwidth of the emulated link to the server, in bytes per second")
+    parser.add_argument("--link-round-trip-time", type=float, default=0.05,
+                        help="Round trip time of the emulated link to the server, in seconds")
+    parser.add_argument("--output", help="JSON file to write all results to")
+    args = parser.parse_args()
+    results = {"git_revision": get_git_revision(),
+               "time": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "machine": platform.machine(),
+               "arguments": vars(args)}
+
+    if args.benchmark in ("all", "session"):
+        session_latencies = benchmark_device_session(args.iterations, args.boot_time,
+                                                     args.pipeline_upload_time,
+                                                     args.capture_delay)
+        results["session"] = session_latencies
+        print_latencies("Capture, cold device open", session_latencies["cold"])
+        print_latencies("Capture, warm session", session_latencies["warm"])
+
+    if args.benchmark in ("all", "metering"):
+        results["metering"] = benchmark_brightness_metering(args.iterations)
+        for metering_result in results["metering"]:
+            print(f"Brightness {metering_result['legacy_brightness']:6.1f} -> "
+                  f"{metering_result['meter_brightness']:6.1f}   "
+                  f"time {metering_result['legacy_time'] * 1000:7.1f} -> "
+                  f"{metering_result['meter_time'] * 1000:5.1f} ms   "
+                  f"peak memory {metering_result['legacy_peak_memory'] / 2 ** 20:6.1f} -> "
+                  f"{metering_result['meter_peak_memory'] / 2 ** 20:4.1f} MiB   "
+                  f"same decision: {metering_result['same_decision']}")
+
+    if args.benchmark in ("all", "gamma"):
+        results["gamma"] = benchmark_gamma_correction(args.iterations)
+        for gamma_result in results["gamma"]:
+            print(f"Brightness {gamma_result['input_brightness']:6.1f}   "
+                  f"iterative -> {gamma_result['legacy_brightness']:6.1f} in "
+                  f"{gamma_result['legacy_time'] * 1000:7.1f} ms   "
+                  f"solver -> {gamma_result['solver_brightness']:6.1f} in "
+                  f"{gamma_result['solver_time'] * 1000:6.1f} ms")
+
+    if args.benchmark in ("all", "profiles"):
+        results["profiles"] = benchmark_encoding_profiles(args.iterations)
+        for profile_result in results["profiles"]:
+            print(f"Profile {profile_result['profile']:<10} "
+                  f"{profile_result['image_size'] / 1000:8.1f} kB per image   "
+                  f"encode {profile_result['encode_time'] * 1000:7.1f} ms")
+
+    if args.benchmark in ("all", "sharpness"):
+        results["sharpness"] = benchmark_sharpness_selection(args.iterations)
+        for sharpness_result in results["sharpness"]:
+            print(f"Sharpness {sharpness_result['measurement']:<16} "
+                  f"{sharpness_result['score_time'] * 1000:7.1f} ms per still   "
+                  f"sharpest selected: {sharpness_result['sharpest_selected']}")
+
+    if args.benchmark in ("all", "pipeline"):
+        pipeline_result = benchmark_pipeline(args.burst_count, args.burst_size,
+                                             args.burst_pause,
+                                             capture_delay=args.capture_delay,
+                                             link_bandwidth=args.link_bandwidth or None,
+                                             link_round_trip_time=args.link_round_trip_time)
+        results["pipeline"] = pipeline_result
+        print(f"Pipeline: {pipeline_result['triggers']} triggers, "
+              f"{pipeline_result['uploaded_folders']} folders and "
+              f"{pipeline_result['uploaded_images']} images sent, "
+              f"{pipeline_result['image_throughput']:.2f} images/s, "
+              f"{pipeline_result['byte_throughput'] / 1e6:.2f} MB/s")
+        if pipeline_result["trigger_to_saved"]:
+            print_latencies("Trigger to saved", pipeline_result["trigger_to_saved"])
+        if pipeline_result["trigger_to_uploaded"]:
+            print_latencies("Trigger to uploaded", pipeline_result["trigger_to_uploaded"])
+        for stage, stage_statistics in pipeline_result["stages"].items():
+            print(f"Stage {stage:<22} {stage_statistics['count']:5} times   "
+                  f"mean {stage_statistics['mean'] * 1000:9.1f} ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            # NumPy numbers are written as plain numbers
+            json.dump(results, output_file, indent=2, default=float)
+        print(f"Results written to {args.output}")
@@ -10,9 +10,19 @@ It allows the user to set up either a common operation pipeline for all cameras,
 pipeline for each camera if need. 
 It allows all Camera objects to be controlled from a single class, the CameraHandler. The
 CameraHandler class facilitates multiprocess operation of all Camera objects via Thread.
-Camerahandler also sets a common saving directory for all cameras. After receiving the RM's
+The captures run on the bounded worker pool of a CaptureScheduler, which groups them by USB hub
+so that any number of cameras can share a hub without saturating it.
+Camerahandler also sets a common saving directory for all cameras, and hands the captured images
+to a StorageHandler that encodes and writes them in the background. After receiving the RM's
 speed information from the CAN layer, it determines whether the Camera objects should remain idle,
 or take pictures.
+Stills that are near-duplicates of the recent stills of their camera, e.g. because the payload
+on the TP did not change between lifts, can be skipped or marked by a DuplicateDetector.
+Cameras can be added and retired while images are captured, e.g. by a DeviceMonitor when a
+camera is attached to or detached from the USB bus. They are named after the MX ID of their
+DepthAI device, so a camera that is attached again keeps its position on the TP.
+As the TP often still vibrates when a capture is triggered, every camera can take a burst of
+stills per trigger and only save the sharpest ones, scored by a SharpnessMeter.
 
 The structure of folders to save images is as follows:
 .
@@ -32,11 +42,13 @@ The structure of folders to save images is as follows:
 Typical usage example:
 
     kewazo_camera_object = Camera(liftbot_id, camera_name, oak_device_info, oak_device_pipeline)
-    kewazo_camera_object.process_image(context_manager, timestamp_saving_directory, date, timestamp)
+    kewazo_camera_object.process_image(timestamp_saving_directory, date, timestamp)
+    kewazo_camera_object.close()
 
     camera_handler = CameraHandler(liftbot_id, local_images_saving_directory,
                 rm_speed_threshold, camera_position_mapping)
     camera_handler.execute(rm_speed)
+    camera_handler.close()
 
 DepthAI's API documentation and tutorial can be found at:
 https://docs.luxonis.com/projects/api/en/latest/ 
@@ -44,16 +56,634 @@ https://docs.luxonis.com/projects/api/en/latest/
 """
 
 import os
+import time
+import queue
 import threading
-import contextlib
 import datetime
-import time
+import collections
 import cv2
 import numpy as np
-from numpy.linalg import norm
 import logging
 import depthai as dai
-import shutil
+from storage_handler import StorageHandler
+from motion_detector import RmMotionDetector
+from duplicate_detector import DuplicateDetector, DUPLICATE_FILE_SUFFIX
+from capture_scheduler import CaptureScheduler
+from metrics import REGISTRY
+
+class DeviceSession:
+    """
+    A class that keeps a DepthAI Device object open between captures.
+
+    Opening a Device boots the camera over USB and uploads the pipeline, which
+    takes seconds. The session does this once, keeps the "control" and "still"
+    queues alive for every following capture, and transparently reopens the
+    Device if the USB connection drops.
+
+    Stills are handed over from the "still" queue by a callback, so a capture
+    can wait for its still with a deadline instead of polling the queue. If the
+    pipeline encodes stills on the device, the recent frames of the low resolution
+    "preview" stream are kept as well, to read the exposure of a still from the
+    preview frame of the same sensor frame.
+
+    """
+    CONTROL_STREAM_NAME = "control"
+    STILL_STREAM_NAME = "still"
+    PREVIEW_STREAM_NAME = "preview"
+    PREVIEW_HISTORY_SIZE = 30 # Preview frames kept to find the one of a still, 3 s at 10 FPS
+
+    def __init__(self, oak_device_info, oak_device_pipeline, device_factory=None,
+                 has_preview_stream=False):
+        """
+        Initialize the session. The Device object is only opened on first use.
+
+        Args:
+            oak_device_info (dai.DeviceInfo) : a DepthAI's DeviceInfo object to initialize
+                                                DepthAI's Device object
+            oak_device_pipeline (dai.Pipeline) : a DepthAI's Pipeline object to start on
+                                                the Device object
+            device_factory (callable) : a callable that takes a DeviceInfo object and
+                                        returns a Device object. Defaults to dai.Device.
+                                        Used to run the session against a fake device
+            has_preview_stream (bool) : whether the pipeline has a "preview" output stream
+
+        """
+        self.oak_device_info = oak_device_info
+        self.oak_device_pipeline = oak_device_pipeline
+        self.device_factory = device_factory if device_factory is not None else dai.Device
+        self.oak_device = None
+        self.input_control_queue = None
+        self.image_output_queue = None
+        self.has_preview_stream = has_preview_stream
+        self.preview_output_queue = None
+        self.recent_previews = collections.deque(maxlen=self.PREVIEW_HISTORY_SIZE)
+        self.open_count = 0 # Number of times the Device object was opened
+        self.usb_speed = None # USB speed of the device, known once it was opened
+        self.session_lock = threading.RLock()
+
+        # Only the latest still is kept, same as the maxSize=1 still queue on the device
+        self.received_stills = queue.Queue(maxsize=1)
+        self.received_stills_lock = threading.Lock()
+
+    def open(self):
+        """
+        Open the Device object, start the pipeline and create the input and output
+        queues. Do nothing if the session is already open and healthy.
+
+        """
+        with self.session_lock:
+            if self.is_healthy():
+                return
+            self.close()
+            open_start_time = time.perf_counter()
+            oak_device = self.device_factory(self.oak_device_info)
+            try:
+                oak_device.startPipeline(self.oak_device_pipeline)
+
+                # Define an input queue to send capture image event to Depthai device
+                # maxSize=1 and blocking=False means that only the latest capture event is in
+                # the queue. This is to prevent the camera from receving too many capture
+                # events within a short period, which may happen when the RM moves a lot
+                # in short period
+                self.input_control_queue = oak_device.getInputQueue(
+                    name=self.CONTROL_STREAM_NAME, maxSize=1, blocking=False)
+
+                # Define an image output queue with non-blocking behavior for the Depthai
+                # device. maxSize=1 and blocking=False means that only the latest captured
+                # is in the output queue
+                self.image_output_queue = oak_device.getOutputQueue(
+                    name=self.STILL_STREAM_NAME, maxSize=1, blocking=False)
+                self.image_output_queue.addCallback(self.on_still_received)
+
+                if self.has_preview_stream:
+                    self.preview_output_queue = oak_device.getOutputQueue(
+                        name=self.PREVIEW_STREAM_NAME, maxSize=1, blocking=False)
+                    self.preview_output_queue.addCallback(self.on_preview_received)
+            except Exception:
+                oak_device.close()
+                raise
+            self.oak_device = oak_device
+            self.usb_speed = oak_device.getUsbSpeed()
+            self.open_count += 1
+            REGISTRY.observe_stage("device_open", time.perf_counter() - open_start_time)
+            if self.open_count > 1:
+                logging.warning("Device session reopened. Reconnection count: %s",
+                                self.open_count - 1)
+
+    def is_healthy(self):
+        """
+        Check whether the Device object is open and its XLink connection is alive.
+
+        Returns:
+            bool : True if the session can be used to capture images
+
+        """
+        return self.oak_device is not None and not self.oak_device.isClosed()
+
+    def get_queues(self):
+        """
+        Get the control input queue and the still output queue, reopening the
+        Device object first if the connection was lost.
+
+        Returns:
+            tuple : the control input queue and the still output queue
+
+        """
+        with self.session_lock:
+            if not self.is_healthy():
+                self.open()
+            return self.input_control_queue, self.image_output_queue
+
+    def on_still_received(self, still_frame):
+        """
+        Callback run by DepthAI whenever a still arrives in the still queue.
+        Replaces any still that was not picked up yet.
+
+        Args:
+            still_frame (dai.ImgFrame) : the still sent by the device
+
+        """
+        with self.received_stills_lock:
+            self.clear_received_stills()
+            self.received_stills.put_nowait(still_frame)
+
+    def on_preview_received(self, preview_frame):
+        """
+        Callback run by DepthAI whenever a frame arrives in the preview queue.
+
+        Args:
+            preview_frame (dai.ImgFrame) : the preview frame sent by the device
+
+        """
+        self.recent_previews.append(preview_frame)
+
+    def get_preview_of_still(self, still_frame):
+        """
+        Get the preview frame taken from the same sensor frame as a still. Preview
+        frames taken before the still may predate the exposure it was taken with,
+        so only the frame with the sequence number of the still is returned.
+
+        Args:
+            still_frame (dai.ImgFrame) : the still sent by the device
+
+        Returns:
+            dai.ImgFrame : the preview frame of the still, or None if it did not
+                        arrive or was already replaced by newer frames
+
+        """
+        still_sequence_number = still_frame.getSequenceNum()
+        for preview_frame in reversed(self.recent_previews):
+            if preview_frame.getSequenceNum() == still_sequence_number:
+                return preview_frame
+        return None
+
+    def clear_received_stills(self):
+        """
+        Discard any still that arrived before the current capture event.
+
+        """
+        try:
+            while True:
+                self.received_stills.get_nowait()
+        except queue.Empty:
+            pass
+
+    def wait_for_still(self, timeout):
+        """
+        Block until a still arrives or the timeout has passed.
+
+        Args:
+            timeout (float) : the maximum time to wait for the still, in seconds
+
+        Returns:
+            dai.ImgFrame : the still, or None if it did not arrive in time
+
+        """
+        try:
+            return self.received_stills.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """
+        Close the Device object so it can be used by another session.
+
+        """
+        with self.session_lock:
+            if self.oak_device is not None:
+                try:
+                    self.oak_device.close()
+                except Exception:
+                    logging.exception("Error when closing device session")
+            self.oak_device = None
+            self.input_control_queue = None
+            self.image_output_queue = None
+            self.preview_output_queue = None
+            # Sequence numbers start over when the Device object is opened again
+            self.recent_previews.clear()
+
+class BrightnessMeter:
+    """
+    A class that measures the brightness of a frame from a subsample of its pixels.
+
+    The brightness of a pixel is the root mean square of its B, G, R values, which
+    is the norm of the pixel divided by sqrt(3). Instead of computing it for every
+    pixel in floating point, the meter only looks at every n-th pixel in both
+    directions, and turns the integer sum of squares into a brightness level with
+    a lookup table. The levels are collected in a 256-bin integer histogram.
+
+    Pixels inside an optional region of interest (ROI) can be weighted more than
+    the rest of the frame, for example to meter on the centre of the TP.
+
+    """
+    DEFAULT_SAMPLING_STRIDE = 8 # Look at 1 of every 8 x 8 pixels
+    CENTRE_ROI = (0.25, 0.25, 0.5, 0.5) # Middle half of the frame in both directions
+
+    # Brightness level for every possible sum of squares of B, G, R values
+    SUM_OF_SQUARES_TO_LEVEL = np.rint(
+        np.sqrt(np.arange(3 * 255 ** 2 + 1) / 3)).astype(np.uint8)
+
+    def __init__(self, sampling_stride=DEFAULT_SAMPLING_STRIDE, roi=None, roi_weight=1):
+        """
+        Initialize the meter.
+
+        Args:
+            sampling_stride (int) : the distance between sampled pixels, in both directions
+            roi (tuple) : the region of interest as (x, y, width, height), each given as a
+                        fraction of the frame size. None to weight all pixels equally
+            roi_weight (int) : how many times a pixel inside the ROI is counted
+
+        """
+        self.sampling_stride = sampling_stride
+        self.roi = roi
+        self.roi_weight = roi_weight
+
+    def histogram(self, frame):
+        """
+        Compute the brightness histogram of a frame.
+
+        Args:
+            frame (numpy.ndarray) : a BGR frame, or a single channel frame
+
+        Returns:
+            numpy.ndarray : 256 integer counts, one for each brightness level
+
+        """
+        levels = self.brightness_levels(frame[::self.sampling_stride, ::self.sampling_stride])
+        histogram = np.bincount(levels.ravel(), minlength=256)
+        if self.roi is not None and self.roi_weight > 1:
+            height, width = levels.shape
+            roi_x, roi_y, roi_width, roi_height = self.roi
+            roi_levels = levels[int(roi_y * height):int((roi_y + roi_height) * height),
+                                int(roi_x * width):int((roi_x + roi_width) * width)]
+            histogram += (self.roi_weight - 1) * np.bincount(roi_levels.ravel(), minlength=256)
+        return histogram
+
+    def brightness_levels(self, sampled_frame):
+        """
+        Convert sampled pixels to brightness levels between 0 and 255.
+
+        Args:
+            sampled_frame (numpy.ndarray) : the sampled pixels of a BGR or single
+                                            channel frame
+
+        Returns:
+            numpy.ndarray : a uint8 brightness level for every sampled pixel
+
+        """
+        if sampled_frame.ndim == 2:
+            return sampled_frame
+        sampled_pixels = sampled_frame.astype(np.int32)
+        sum_of_squares = np.einsum("ijk,ijk->ij", sampled_pixels, sampled_pixels)
+        return self.SUM_OF_SQUARES_TO_LEVEL[sum_of_squares]
+
+    def measure(self, frame):
+        """
+        Measure the brightness of a frame.
+
+        Args:
+            frame (numpy.ndarray) : a BGR frame, or a single channel frame
+
+        Returns:
+            float : the average brightness of the frame, between 0 and 255
+
+        """
+        return self.brightness_from_histogram(self.histogram(frame))
+
+    @staticmethod
+    def brightness_from_histogram(histogram):
+        """
+        Compute the average brightness from a brightness histogram.
+
+        Args:
+            histogram (numpy.ndarray) : 256 counts, one for each brightness level
+
+        Returns:
+            float : the average brightness, between 0 and 255
+
+        """
+        return float(np.dot(histogram, np.arange(256))) / max(int(histogram.sum()), 1)
+
+class SharpnessMeter:
+    """
+    A class that scores how sharp a frame is, to keep the least blurred stills of
+    a burst.
+
+    The score is the variance of the Laplacian of the luma plane. Motion blur
+    smooths the edges of the scene, which lowers the second derivative
+    everywhere, so a blurred still scores lower than a sharp still of the same
+    scene. Like the brightness meter, the sharpness meter only looks at every n-th
+    pixel in both directions, so that scoring a 12 MP still costs a few
+    milliseconds. Stills encoded on the device are decoded straight to a scaled
+    down luma plane. Scores are only comparable between stills of the same scene
+    and size.
+
+    """
+    DEFAULT_SAMPLING_STRIDE = 4 # Look at 1 of every 4 x 4 pixels
+
+    # Flag to decode a JPEG bitstream to a scaled down luma plane, for every stride
+    REDUCED_GRAYSCALE_READ_FLAGS = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                                    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                                    8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+    def __init__(self, sampling_stride=DEFAULT_SAMPLING_STRIDE):
+        """
+        Initialize the meter.
+
+        Args:
+            sampling_stride (int) : the distance between sampled pixels, in both
+                                    directions. One of 1, 2, 4 or 8
+
+        """
+        if sampling_stride not in self.REDUCED_GRAYSCALE_READ_FLAGS:
+            raise ValueError(f"Unsupported sampling stride {sampling_stride}")
+        self.sampling_stride = sampling_stride
+
+    def measure(self, frame):
+        """
+        Score the sharpness of a frame.
+
+        Args:
+            frame (numpy.ndarray) : a BGR frame, or a single channel frame
+
+        Returns:
+            float : the variance of the Laplacian of the sampled luma plane
+
+        """
+        sampled_frame = frame[::self.sampling_stride, ::self.sampling_stride]
+        if sampled_frame.ndim == 3:
+            sampled_frame = cv2.cvtColor(np.ascontiguousarray(sampled_frame),
+                                         cv2.COLOR_BGR2GRAY)
+        return self.laplacian_variance(sampled_frame)
+
+    def measure_encoded(self, encoded_image):
+        """
+        Score the sharpness of a JPEG bitstream without decoding it at full resolution.
+
+        Args:
+            encoded_image (numpy.ndarray) : the JPEG bitstream
+
+        Returns:
+            float : the variance of the Laplacian of the scaled down luma plane
+
+        """
+        return self.laplacian_variance(cv2.imdecode(
+            encoded_image, self.REDUCED_GRAYSCALE_READ_FLAGS[self.sampling_stride]))
+
+    @staticmethod
+    def laplacian_variance(luma_plane):
+        """
+        Compute the variance of the Laplacian of a luma plane.
+
+        """
+        # The Laplacian of 8-bit values fits in 16 bits
+        _, laplacian_deviation = cv2.meanStdDev(cv2.Laplacian(luma_plane, cv2.CV_16S))
+        return float(laplacian_deviation[0, 0]) ** 2
+
+class GammaSolver:
+    """
+    A class that finds the gamma that brings a frame to a target brightness and
+    applies it with a single lookup table (LUT) pass.
+
+    The gamma is solved from the brightness histogram of the frame: the brightness
+    after gamma correction is predicted for every gamma on a quantised grid in one
+    matrix product, and the gamma whose prediction is closest to the target is
+    chosen. No gamma is applied to the frame until the solution is known.
+
+    LUTs are kept in a bounded least-recently-used cache keyed by the quantised
+    gamma. The cache is a class attribute, so it is shared by all cameras.
+
+    """
+    GAMMA_STEP = 0.01 # Quantisation step of gamma, and key of the LUT cache
+    GAMMA_MIN = 0.25 # Lowest gamma the solver returns, brightens the image
+    GAMMA_MAX = 4.0 # Highest gamma the solver returns, darkens the image
+    LUT_CACHE_SIZE = 64 # Maximum number of LUTs kept in the cache
+
+    GAMMA_KEYS = np.arange(round(GAMMA_MIN / GAMMA_STEP), round(GAMMA_MAX / GAMMA_STEP) + 1)
+
+    # Brightness level after gamma correction, for every gamma on the grid (rows)
+    # and every brightness level (columns)
+    CORRECTED_LEVELS = np.rint(255.0 * np.power(
+        np.arange(256) / 255.0, GAMMA_KEYS[:, np.newaxis] * GAMMA_STEP)).astype(np.float32)
+
+    lut_cache = collections.OrderedDict()
+    lut_cache_lock = threading.Lock()
+
+    @classmethod
+    def quantise(cls, gamma):
+        """
+        Quantise a gamma to the key used by the LUT cache.
+
+        Args:
+            gamma (float) : the gamma to quantise
+
+        Returns:
+            int : the gamma as an integer multiple of GAMMA_STEP
+
+        """
+        return int(round(gamma / cls.GAMMA_STEP))
+
+    @classmethod
+    def solve(cls, histogram, target_brightness):
+        """
+        Find the gamma that brings a frame closest to a target brightness.
+
+        Args:
+            histogram (numpy.ndarray) : the brightness histogram of the frame,
+                                        as returned by BrightnessMeter.histogram
+            target_brightness (float) : the brightness to reach, between 0 and 255
+
+        Returns:
+            float : the quantised gamma
+
+        """
+        predicted_brightness = cls.CORRECTED_LEVELS @ (
+            histogram.astype(np.float32) / max(int(histogram.sum()), 1))
+        gamma_key = cls.GAMMA_KEYS[np.argmin(np.abs(predicted_brightness - target_brightness))]
+        return round(float(gamma_key * cls.GAMMA_STEP), 6)
+
+    @classmethod
+    def get_lut(cls, gamma):
+        """
+        Get the LUT of a gamma from the cache, building it if it is not cached.
+
+        Args:
+            gamma (float) : the gamma of the LUT
+
+        Returns:
+            numpy.ndarray : 256 uint8 values, the corrected value of every input value
+
+        """
+        gamma_key = cls.quantise(gamma)
+        with cls.lut_cache_lock:
+            gamma_lut = cls.lut_cache.get(gamma_key)
+            if gamma_lut is not None:
+                cls.lut_cache.move_to_end(gamma_key)
+                return gamma_lut
+        gamma_lut = np.rint(255.0 * np.power(
+            np.arange(256) / 255.0, gamma_key * cls.GAMMA_STEP)).astype(np.uint8)
+        with cls.lut_cache_lock:
+            cls.lut_cache[gamma_key] = gamma_lut
+            while len(cls.lut_cache) > cls.LUT_CACHE_SIZE:
+                cls.lut_cache.popitem(last=False)
+        return gamma_lut
+
+    @classmethod
+    def apply(cls, frame, gamma):
+        """
+        Apply gamma correction to a frame in one LUT pass.
+
+        Args:
+            frame (numpy.ndarray) : the frame to correct
+            gamma (float) : the gamma to apply
+
+        Returns:
+            numpy.ndarray : the corrected frame
+
+        """
+        return cv2.LUT(frame, cls.get_lut(gamma))
+
+class ExposureController:
+    """
+    A class that keeps the exposure of a camera on target with closed-loop control.
+
+    After every still, the measured brightness is recorded in a short history and
+    compared with the target brightness. If it is outside the deadband, the
+    exposure for the next capture is scaled by the ratio between target and
+    measured brightness, raised to a proportional gain. The exposure is split
+    into exposure time and ISO, preferring a longer exposure time over a higher
+    ISO to keep noise low. The exposure time and ISO the still was actually
+    taken with are read from the still, so the control converges even if a new
+    setting only took effect on a later frame.
+
+    If a still carries no exposure information, the DepthAI brightness control
+    is stepped proportionally instead.
+
+    """
+    EXPOSURE_TIME_MIN_US = 20 # Shortest exposure time accepted by the sensor
+    EXPOSURE_TIME_MAX_US = 33000 # Longest exposure time before motion blur gets too strong
+    SENSITIVITY_ISO_MIN = 100
+    SENSITIVITY_ISO_MAX = 1600
+    BRIGHTNESS_CONTROL_MIN = -10 # Range of DepthAI's brightness control
+    BRIGHTNESS_CONTROL_MAX = 10
+    BRIGHTNESS_PER_CONTROL_STEP = 10 # Approximate change in brightness per control step
+    DEFAULT_PROPORTIONAL_GAIN = 0.8
+    MAX_CORRECTION_RATIO = 4.0 # Largest change in exposure in a single step
+    DEFAULT_HISTORY_SIZE = 20
+
+    def __init__(self, target_brightness, deadband,
+                 proportional_gain=DEFAULT_PROPORTIONAL_GAIN, history_size=DEFAULT_HISTORY_SIZE):
+        """
+        Initialize the controller with the camera on auto exposure.
+
+        Args:
+            target_brightness (float) : the brightness to keep stills at, between 0 and 255
+            deadband (float) : no correction is made while the brightness is within this
+                            distance of the target
+            proportional_gain (float) : the fraction of the brightness error, on a
+                                        logarithmic scale, corrected in a single step
+            history_size (int) : the number of measured brightness values to keep
+
+        """
+        self.target_brightness = target_brightness
+        self.deadband = deadband
+        self.proportional_gain = proportional_gain
+        self.brightness_history = collections.deque(maxlen=history_size)
+        self.exposure_time_us = None # None while the camera is on auto exposure
+        self.sensitivity_iso = None
+        self.brightness_control = 0 # Default of DepthAI camera
+
+    def apply(self, ctrl):
+        """
+        Write the current exposure settings into a capture event.
+
+        Args:
+            ctrl (dai.CameraControl) : the capture event to send
+
+        """
+        ctrl.setBrightness(self.brightness_control)
+        if self.exposure_time_us is not None:
+            ctrl.setManualExposure(self.exposure_time_us, self.sensitivity_iso)
+
+    def update(self, brightness, still_frame):
+        """
+        Record the brightness of a still and compute the settings for the next capture.
+
+        Args:
+            brightness (float) : the measured brightness of the still
+            still_frame (dai.ImgFrame) : the still, to read the exposure it was taken with
+
+        """
+        self.brightness_history.append(brightness)
+        brightness_error = self.target_brightness - brightness
+        if abs(brightness_error) <= self.deadband:
+            return
+
+        # Halve the gain if the last correction overshot the target, to damp oscillation
+        proportional_gain = self.proportional_gain
+        if len(self.brightness_history) > 1 and \
+                (self.brightness_history[-2] - self.target_brightness) * brightness_error > 0:
+            proportional_gain /= 2
+
+        exposure_time_us, sensitivity_iso = self.read_exposure(still_frame)
+        if exposure_time_us is None:
+            brightness_control_step = int(round(
+                proportional_gain * brightness_error / self.BRIGHTNESS_PER_CONTROL_STEP))
+            self.brightness_control = int(np.clip(self.brightness_control + brightness_control_step,
+                                                  self.BRIGHTNESS_CONTROL_MIN,
+                                                  self.BRIGHTNESS_CONTROL_MAX))
+            return
+
+        correction_ratio = np.clip(
+            (self.target_brightness / max(brightness, 1.0)) ** proportional_gain,
+            1 / self.MAX_CORRECTION_RATIO, self.MAX_CORRECTION_RATIO)
+        exposure = exposure_time_us * sensitivity_iso * correction_ratio
+        self.exposure_time_us = int(np.clip(exposure / self.SENSITIVITY_ISO_MIN,
+                                            self.EXPOSURE_TIME_MIN_US, self.EXPOSURE_TIME_MAX_US))
+        self.sensitivity_iso = int(np.clip(exposure / self.exposure_time_us,
+                                           self.SENSITIVITY_ISO_MIN, self.SENSITIVITY_ISO_MAX))
+
+    @staticmethod
+    def read_exposure(still_frame):
+        """
+        Read the exposure time and ISO a still was taken with.
+
+        Args:
+            still_frame (dai.ImgFrame) : the still
+
+        Returns:
+            tuple : the exposure time in microseconds and the ISO, or (None, None)
+                    if the still carries no exposure information
+
+        """
+        try:
+            exposure_time_us = still_frame.getExposureTime().total_seconds() * 1e6
+            sensitivity_iso = still_frame.getSensitivity()
+        except AttributeError:
+            return None, None
+        if exposure_time_us <= 0 or sensitivity_iso <= 0:
+            return None, None
+        return exposure_time_us, sensitivity_iso
 
 class Camera:
     """
@@ -66,9 +696,32 @@ class Camera:
     IMAGE_NAMING = "{liftbot_id}_{camera_name}_{date}_{timestamp}.jpg"
     BRIGHTNESS_LOW = 70 # Threshold to determine whether image is too dark
     BRIGHTNESS_HIGH = 90 # Threshold to determine whether image is too bright
-    GAMMA_ADJUSTMENT_STEP = 0.01 # Exposure step to adjust camera exposure
+    BRIGHTNESS_REJECT_LOW = 40 # Below this, gamma correction cannot fix the image
+    BRIGHTNESS_REJECT_HIGH = 130 # Above this, gamma correction cannot fix the image
+    # Brightness that gamma correction aims for, in the middle of the threshold range
+    BRIGHTNESS_TARGET = (BRIGHTNESS_LOW + BRIGHTNESS_HIGH) / 2
+    MAX_RECAPTURES = 2 # Stills taken again within a trigger if brightness is unusable
+    DEFAULT_BURST_SIZE = 1 # Stills taken per trigger to choose the sharpest from
+    DEFAULT_BURST_KEEP_COUNT = 1 # Sharpest stills of a burst that are saved
+    BURST_FILE_SUFFIX = "_burst{rank}" # Added to the image file name of all but the sharpest still
+    DEFAULT_CAPTURE_TIMEOUT = 2.0 # Seconds to wait for a still after the capture event
+    # Decoding a still encoded on the device at 1/8 of its resolution only takes a
+    # fraction of a full decode, and is still larger than the preview stream
+    METERING_DECODE_FLAG = cv2.IMREAD_REDUCED_COLOR_8
+
+    # Outcomes of a capture, returned by process_image and counted per camera
+    CAPTURE_SAVED = "saved"
+    CAPTURE_QUEUED = "queued" # Still handed over to the storage handler to be written
+    CAPTURE_DISCARDED = "discarded" # Still too bright or too dark after all recaptures
+    CAPTURE_TIMEOUT = "timeout" # Still did not arrive before the capture timeout
+    CAPTURE_FAILED = "failed" # Device could not be reached or image could not be saved
+    CAPTURE_DUPLICATE = "duplicate" # Still skipped as a near-duplicate of a recent still
 
-    def __init__(self, liftbot_id, camera_name, oak_device_info, oak_device_pipeline):
+    def __init__(self, liftbot_id, camera_name, oak_device_info, oak_device_pipeline,
+                 capture_timeout=DEFAULT_CAPTURE_TIMEOUT, brightness_meter=None,
+                 storage_handler=None, on_device_encoding=False, duplicate_detector=None,
+                 device_factory=None, burst_size=DEFAULT_BURST_SIZE,
+                 burst_keep_count=DEFAULT_BURST_KEEP_COUNT, sharpness_meter=None):
         """
         Initialize the camera object with information specific to Liftbot, such as
         Liftbot ID and camera placement on TP.
@@ -84,6 +737,31 @@ class Camera:
                                                 how DepthAI camera take pictures, the resolution
                                                 of pictures, image detection, ... and how 
                                                 it sends pictures to host device
+            capture_timeout (float) : the maximum time to wait for a still after sending
+                                    the capture event, in seconds
+            brightness_meter (BrightnessMeter) : the meter used to measure the brightness
+                                                of captured images. Defaults to a meter
+                                                that weights all pixels equally
+            storage_handler (StorageHandler) : the handler that encodes and writes images
+                                            in the background. If None, images are
+                                            written before process_image returns
+            on_device_encoding (bool) : whether the pipeline encodes stills to JPEG on
+                                        the camera and streams a low resolution preview.
+                                        Must match the pipeline
+            duplicate_detector (DuplicateDetector) : the detector that skips or marks
+                                                    stills that are near-duplicates of
+                                                    recent stills. None to keep all stills
+            device_factory (callable) : a callable that takes a DeviceInfo object and
+                                        returns an open Device object. Defaults to
+                                        dai.Device. Used to run without cameras
+            burst_size (int) : the number of stills taken per capture. The sharpest
+                            are saved, so that a still blurred by the vibration of
+                            the TP is not the only one
+            burst_keep_count (int) : the number of sharpest stills of a burst to save,
+                                    1 or 2
+            sharpness_meter (SharpnessMeter) : the meter used to score the sharpness of
+                                            the stills of a burst. Defaults to a meter
+                                            with the default sampling stride
 
         """
         self.liftbot_id = liftbot_id
@@ -91,135 +769,369 @@ class Camera:
         self.oak_device_info = oak_device_info
         self.oak_device_pipeline = oak_device_pipeline
         self.gamma = 1.0 # Default of DepthAI camera
-        self.brightness_control = 0 # Default of DepthAI camera
+        self.exposure_controller = ExposureController(
+            target_brightness=self.BRIGHTNESS_TARGET,
+            deadband=(self.BRIGHTNESS_HIGH - self.BRIGHTNESS_LOW) / 2)
+        self.on_device_encoding = on_device_encoding
+        self.device_session = DeviceSession(oak_device_info, oak_device_pipeline,
+                                            device_factory=device_factory,
+                                            has_preview_stream=on_device_encoding)
+        self.capture_timeout = capture_timeout
+        self.brightness_meter = brightness_meter if brightness_meter is not None \
+            else BrightnessMeter()
+        self.capture_outcome_count = collections.Counter()
+        self.storage_handler = storage_handler
+        self.duplicate_detector = duplicate_detector
+        self.burst_size = burst_size
+        self.burst_keep_count = min(burst_keep_count, burst_size)
+        self.sharpness_meter = sharpness_meter if sharpness_meter is not None \
+            else SharpnessMeter()
 
-    def process_image(self, context_manager, timestamp_saving_directory, date, timestamp):
+    def process_image(self, timestamp_saving_directory, date, timestamp):
         """
-        Initialize DepthAI's Device object from DeviceInfo object, generate input queue to receive
-        image capture command and output queue to send image to host device. Save image to
-        host device in a specified folder. 
+        Capture an image through the camera's long-lived device session and save it to
+        host device in a specified folder. The Device object is opened on the first
+        capture and reopened if the USB connection was lost.
+
+        With a burst size above 1, more stills are taken right after the first usable
+        one, and only the sharpest are saved. The sharpest is saved under the usual
+        image name, the second sharpest with BURST_FILE_SUFFIX.
 
         Args:
-            context_manager (contextlib.ExitStack) : a context manager object to enter the
-                                                context of the initialized Device object and
-                                                close it cleanly after use. 
             timestamp_saving_directory (string) : the directory to save images
             date (string) : the date the image was captured, in the format YYMMDD
             timestamp (string) : the time the image was captured, in the format HHMMSS
 
+        Returns:
+            string : the outcome of the capture, one of CAPTURE_SAVED, CAPTURE_QUEUED,
+                    CAPTURE_DISCARDED, CAPTURE_TIMEOUT, CAPTURE_FAILED or CAPTURE_DUPLICATE
+
         """
 
-        # Initialize Device object with a specified pipeline
-        try:
-            oak_device : dai.Device = context_manager.enter_context(dai.Device(self.oak_device_info))
-            logging.info("Camera initialized")
-        except Exception:
-            logging.exception("Error when initialization camera ", self.camera_name)
-        try:
-            oak_device.startPipeline(self.oak_device_pipeline)
-            logging.info("Start pipeline on camera ", self.camera_name)
-        except Exception:
-            logging.exception("Cannot start pipeline on camera ", self.camera_name)
+        # Set specific directory to save image
+        image_file_name = self.IMAGE_NAMING.format(liftbot_id=self.liftbot_id,
+                                              camera_name=self.camera_name,
+                                              date=date,
+                                              timestamp=timestamp)
+
+        image_file_directory = os.path.join(timestamp_saving_directory, image_file_name)
 
-        # Define an input queue to send capture image event to Depthai device
-        # maxSize=1 and blocking=False means that only the latest capture event is in the queue
-        # This is to prevent the camera from receving too many capture events within a short period
-        # Which may happen when the RM moves a lot in short period
-        input_control_queue = oak_device.getInputQueue(name="control", maxSize=1, blocking=False)
+        # Capture stills until one has a usable brightness. After every still, the
+        # exposure controller corrects the exposure for the next capture, so a still
+        # that is too bright or too dark is taken again immediately within the same
+        # trigger instead of wasting the trigger.
+        #
+        # Brightness is calculated using the root mean square of R, G, B
+        # channels of a picture, sampled by the brightness meter. If it is too
+        # great or too low, gamma correction would return weird images.
+        for capture_attempt in range(self.MAX_RECAPTURES + 1):
+            still_frame, capture_outcome = self.capture_still(self.get_capture_command())
+            if still_frame is None:
+                return self.record_capture_outcome(capture_outcome)
+
+            image, metering_frame, exposure_frame = self.unpack_still(still_frame)
+            brightness_histogram, brightness = self.measure_brightness(metering_frame)
+            self.exposure_controller.update(brightness, exposure_frame)
+            if self.BRIGHTNESS_REJECT_LOW <= brightness <= self.BRIGHTNESS_REJECT_HIGH:
+                break
+            logging.warning("%s BRIGHTNESS %.1f UNUSABLE ON ATTEMPT %s",
+                            self.camera_name, brightness, capture_attempt + 1)
+        else:
+            return self.record_capture_outcome(self.CAPTURE_DISCARDED)
 
-        # Define an image output queue with non-blocking behavior for the Depthai device
-        # maxSize=1 and blocking=False means that only the latest captured is in the output queue
-        image_output_queue = oak_device.getOutputQueue(name="still", maxSize=1, blocking=False)
+        # Take the rest of the burst with the same exposure, and keep the sharpest
+        burst_still_list = [(image, metering_frame, brightness_histogram, brightness)]
+        if self.burst_size > 1:
+            burst_still_list = self.select_sharpest_stills(
+                burst_still_list + self.capture_burst(self.burst_size - 1))
+        image, metering_frame, brightness_histogram, brightness = burst_still_list[0]
+
+        # Compare the still against the recent stills of this camera on the small
+        # metering frame, before spending time on gamma correction and encoding.
+        # The other stills of the burst show the same scene and share the decision
+        if self.duplicate_detector is not None:
+            is_duplicate, hamming_distance = self.duplicate_detector.check(self.camera_name,
+                                                                           metering_frame)
+            if is_duplicate:
+                if self.duplicate_detector.action == DuplicateDetector.ACTION_SKIP:
+                    logging.info("%s STILL SKIPPED. NEAR-DUPLICATE AT DISTANCE %s",
+                                 self.camera_name, hamming_distance)
+                    return self.record_capture_outcome(self.CAPTURE_DUPLICATE)
+                logging.info("%s STILL MARKED. NEAR-DUPLICATE AT DISTANCE %s",
+                             self.camera_name, hamming_distance)
+                image_file_root, image_file_extension = os.path.splitext(image_file_directory)
+                image_file_directory = image_file_root + DUPLICATE_FILE_SUFFIX + \
+                    image_file_extension
+
+        capture_outcome = self.save_still(image_file_directory, image, brightness_histogram,
+                                          brightness)
+        image_file_root, image_file_extension = os.path.splitext(image_file_directory)
+        for burst_rank, (image, _, brightness_histogram, brightness) in enumerate(
+                burst_still_list[1:], start=2):
+            self.save_still(image_file_root + self.BURST_FILE_SUFFIX.format(rank=burst_rank) +
+                            image_file_extension, image, brightness_histogram, brightness)
+        return self.record_capture_outcome(capture_outcome)
+
+    def get_capture_command(self):
+        """
+        Define a capture event with the exposure set by the exposure controller.
+
+        Returns:
+            dai.CameraControl : the capture event
 
-        # Define capture event for depthai_device
+        """
         ctrl = dai.CameraControl()
-        ctrl.setBrightness(self.brightness_control)
+        self.exposure_controller.apply(ctrl)
         ctrl.setCaptureStill(True)
+        return ctrl
 
-        # Send capture event to depthai device to capture 1 image
-        input_control_queue.send(ctrl)
-        logging.info("Send capture command to camera ", self.camera_name)
+    def unpack_still(self, still_frame):
+        """
+        Get the image to save from a still, and the frames to measure its brightness
+        and read its exposure from.
 
-        # Time delay to make sure that the capture event is received
-        time.sleep(0.5)
+        With on-device encoding, the still is a JPEG bitstream. Brightness is then
+        measured on a reduced resolution decode of the still, and the exposure is
+        read from the preview frame of the same sensor frame, if it arrived.
 
-        # Set specific directory to save image
-        image_file_name = self.IMAGE_NAMING.format(liftbot_id=self.liftbot_id,
-                                              camera_name=self.camera_name,
-                                              date=date,
-                                              timestamp=timestamp)
+        Args:
+            still_frame (dai.ImgFrame) : the still sent by the device
 
-        image_file_directory = os.path.join(timestamp_saving_directory, image_file_name)
+        Returns:
+            tuple : the frame or JPEG bitstream to save (numpy.ndarray), the frame to
+                    measure brightness on (numpy.ndarray), and the frame to read the
+                    exposure of (dai.ImgFrame)
+
+        """
+        if self.on_device_encoding:
+            encoded_image = still_frame.getData()
+            exposure_frame = self.device_session.get_preview_of_still(still_frame)
+            if exposure_frame is None:
+                exposure_frame = still_frame
+            return encoded_image, self.get_metering_frame(encoded_image), exposure_frame
+        frame = still_frame.getCvFrame()
+        return frame, frame, still_frame
+
+    def measure_brightness(self, metering_frame):
+        """
+        Measure the brightness of a still on its metering frame.
+
+        Returns:
+            tuple : the brightness histogram (numpy.ndarray) and the brightness (float)
+
+        """
+        with REGISTRY.time_stage("brightness", camera=self.camera_name):
+            brightness_histogram = self.brightness_meter.histogram(metering_frame)
+            brightness = BrightnessMeter.brightness_from_histogram(brightness_histogram)
+        return brightness_histogram, brightness
+
+    def capture_burst(self, still_count):
+        """
+        Take more stills with the current exposure, right after each other. Stills
+        that do not arrive or whose brightness is unusable are left out.
+
+        Args:
+            still_count (int) : the number of stills to take
+
+        Returns:
+            list : tuples of the image to save, the metering frame, the brightness
+                histogram and the brightness of every usable still
 
-        if image_output_queue.has():
-            frame = image_output_queue.get().getCvFrame()
-
-            # Analyze brightness of image to adjust camera exposure for
-            # different lighting environments.
-            #
-            # Brightness is calculated using geometric mean of R, G, B
-            # channels of a picture
-            
-            brightness = np.average(norm(frame, axis=2)) / np.sqrt(3)
-
-
-            # If brightness is too great or too low, gamma correction
-            # would return weird images.
-            #
-            # The idea here is that if brightness is too great or too
-            # low, the images won't be sent. Instead, the brightness of
-            # the next image taken will be increased or decreased
-
-            if brightness > 130 or brightness < 40:
-                if brightness > 130:
-                    self.brightness_control -= 1
-                    try:
-                        shutil.rmtree(timestamp_saving_directory)
-                    except Exception:
-                        return
-                    return
-                elif brightness < 40:
-                    self.brightness_control += 1
-                    try:
-                        shutil.rmtree(timestamp_saving_directory)
-                    except Exception:
-                        return
-                    return
-                
-            counter = 0 # Counter to prevent infinite loop
-            while (counter < 10) and (brightness > self.BRIGHTNESS_HIGH or brightness < self.BRIGHTNESS_LOW):
-                # Adjusting gamma values
-                if brightness > self.BRIGHTNESS_HIGH:
-                    logging.warning(self.camera_name,
-                                " BRIGHTNESS TOO HIGH. INCREASING GAMMA")
-                    self.gamma += self.GAMMA_ADJUSTMENT_STEP
-                    frame = self.gamma_correction(frame, self.gamma)
-                elif brightness < self.BRIGHTNESS_LOW:
-                    logging.warning(self.camera_name,
-                                " BRIGHTNESS TOO LOW. DECREASING GAMMA")
-                    self.gamma -= self.GAMMA_ADJUSTMENT_STEP
-                    frame = self.gamma_correction(frame, self.gamma)
-                brightness = np.average(norm(frame, axis=2)) / np.sqrt(3)
-                counter += 1
-            
-            logging.info(self.camera_name,
-                                " BRIGHTNESS WITHIN THRESHOLD")
-            
-            if cv2.imwrite(image_file_directory, frame):
-                logging.info(self.camera_name, " SAVED")
+        """
+        burst_still_list = []
+        for _ in range(still_count):
+            still_frame, _ = self.capture_still(self.get_capture_command())
+            if still_frame is None:
+                break
+            image, metering_frame, _ = self.unpack_still(still_frame)
+            brightness_histogram, brightness = self.measure_brightness(metering_frame)
+            if self.BRIGHTNESS_REJECT_LOW <= brightness <= self.BRIGHTNESS_REJECT_HIGH:
+                burst_still_list.append((image, metering_frame, brightness_histogram,
+                                         brightness))
+        return burst_still_list
+
+    def select_sharpest_stills(self, burst_still_list):
+        """
+        Score the sharpness of the stills of a burst and keep the sharpest.
+
+        Args:
+            burst_still_list (list) : tuples of the image to save, the metering frame,
+                                    the brightness histogram and the brightness of
+                                    every still, as returned by capture_burst
+
+        Returns:
+            list : the burst_keep_count sharpest stills, sharpest first
+
+        """
+        with REGISTRY.time_stage("sharpness", camera=self.camera_name):
+            if self.on_device_encoding:
+                sharpness_scores = np.array([self.sharpness_meter.measure_encoded(image)
+                                             for image, *_ in burst_still_list])
             else:
-                logging.critical(self.camera_name, " NOT SAVED")
+                sharpness_scores = np.array([self.sharpness_meter.measure(image)
+                                             for image, *_ in burst_still_list])
+        # Earlier stills win ties, as they are closest to the trigger
+        kept_index_list = np.argsort(-sharpness_scores, kind="stable")[:self.burst_keep_count]
+        logging.info("%s KEPT STILLS %s OF BURST WITH SHARPNESS %s", self.camera_name,
+                     kept_index_list.tolist(), np.round(sharpness_scores, 1).tolist())
+        return [burst_still_list[burst_index] for burst_index in kept_index_list]
+
+    def save_still(self, image_file_directory, image, brightness_histogram, brightness):
+        """
+        Correct the brightness of a still and hand it over to be written, or write it
+        right away without a storage handler.
+
+        Args:
+            image_file_directory (string) : the image file to write
+            image (numpy.ndarray) : the frame, or the JPEG bitstream with on-device
+                                    encoding
+            brightness_histogram (numpy.ndarray) : the brightness histogram of the still
+            brightness (float) : the brightness of the still
+
+        Returns:
+            string : CAPTURE_SAVED, CAPTURE_QUEUED or CAPTURE_FAILED
+
+        """
+        # An image encoded on the device is written as it is. Its brightness is
+        # only corrected through the exposure of the following captures
+        if self.on_device_encoding:
+            if self.storage_handler is not None:
+                if self.storage_handler.submit_encoded(image_file_directory, image):
+                    return self.CAPTURE_QUEUED
+                logging.critical("%s NOT QUEUED. STORAGE HANDLER CLOSED", self.camera_name)
+                return self.CAPTURE_FAILED
+            if StorageHandler.write_encoded_image(image_file_directory, image):
+                return self.CAPTURE_SAVED
+            logging.critical("%s NOT SAVED", self.camera_name)
+            return self.CAPTURE_FAILED
+
+        # If brightness is outside the threshold, solve the gamma that brings it
+        # to the middle of the threshold from the histogram, and apply it in a
+        # single pass over the frame
+        frame = image
+        if brightness > self.BRIGHTNESS_HIGH or brightness < self.BRIGHTNESS_LOW:
+            with REGISTRY.time_stage("gamma", camera=self.camera_name):
+                self.gamma = GammaSolver.solve(brightness_histogram, self.BRIGHTNESS_TARGET)
+                frame = GammaSolver.apply(frame, self.gamma)
+            logging.warning("%s BRIGHTNESS %.1f OUTSIDE THRESHOLD. APPLIED GAMMA %.2f",
+                            self.camera_name, brightness, self.gamma)
         else:
-            return
-    
+            logging.info("%s BRIGHTNESS WITHIN THRESHOLD", self.camera_name)
+
+        # Hand over the frame to be encoded and written in the background, so the
+        # capture returns as soon as the frame is in memory
+        if self.storage_handler is not None:
+            if self.storage_handler.submit(image_file_directory, frame):
+                return self.CAPTURE_QUEUED
+            logging.critical("%s NOT QUEUED. STORAGE HANDLER CLOSED", self.camera_name)
+            return self.CAPTURE_FAILED
+
+        if StorageHandler.write_image(image_file_directory, frame):
+            return self.CAPTURE_SAVED
+        logging.critical("%s NOT SAVED", self.camera_name)
+        return self.CAPTURE_FAILED
+
+    def get_metering_frame(self, encoded_image):
+        """
+        Get a small frame to measure the brightness of a still encoded on the device.
+        The still itself is decoded, so that the brightness, the duplicate hash and
+        the burst selection all look at the still and not at an older frame.
+
+        Args:
+            encoded_image (numpy.ndarray) : the JPEG bitstream of the still
+
+        Returns:
+            numpy.ndarray : the still decoded at 1/8 of its resolution
+
+        """
+        return cv2.imdecode(encoded_image, self.METERING_DECODE_FLAG)
+
+    def capture_still(self, ctrl):
+        """
+        Send a capture event and wait for the still.
+
+        XLink errors after a USB drop surface as RuntimeError, in which case the
+        session is reopened and the capture event is sent once more.
+
+        Args:
+            ctrl (dai.CameraControl) : the capture event to send
+
+        Returns:
+            tuple : the still (dai.ImgFrame), or None if no still was received, and
+                    the outcome of the capture if no still was received
+
+        """
+        try:
+            self.send_capture_command(ctrl)
+        except RuntimeError:
+            logging.warning("Connection to camera %s lost. Reconnecting", self.camera_name)
+            self.device_session.close()
+            try:
+                self.send_capture_command(ctrl)
+            except Exception:
+                logging.exception("Cannot reconnect to camera %s", self.camera_name)
+                return None, self.CAPTURE_FAILED
+        except Exception:
+            logging.exception("Cannot open device session on camera %s", self.camera_name)
+            return None, self.CAPTURE_FAILED
+        logging.info("Send capture command to camera %s", self.camera_name)
+
+        # Wait for the still to arrive. The wait returns as soon as the still lands
+        # in the output queue, and gives up once the capture timeout has passed
+        capture_start_time = time.perf_counter()
+        still_frame = self.device_session.wait_for_still(self.capture_timeout)
+        if still_frame is None:
+            logging.warning("Camera %s did not return a still within %s seconds",
+                            self.camera_name, self.capture_timeout)
+            return None, self.CAPTURE_TIMEOUT
+        REGISTRY.observe_stage("capture", time.perf_counter() - capture_start_time,
+                               camera=self.camera_name)
+        return still_frame, None
+
+    def send_capture_command(self, ctrl):
+        """
+        Send a capture event to the camera through its device session.
+
+        Any still left in the output queue from an earlier capture is discarded
+        first, so that the next still received belongs to this capture event.
+
+        Args:
+            ctrl (dai.CameraControl) : the capture event to send
+
+        """
+        input_control_queue, image_output_queue = self.device_session.get_queues()
+        image_output_queue.tryGetAll()
+        self.device_session.clear_received_stills()
+        input_control_queue.send(ctrl)
+
+    def record_capture_outcome(self, outcome):
+        """
+        Count the outcome of a capture.
+
+        Args:
+            outcome (string) : the outcome of the capture
+
+        Returns:
+            string : the same outcome, so it can be returned by process_image
+
+        """
+        self.capture_outcome_count[outcome] += 1
+        REGISTRY.increment("captures", camera=self.camera_name, outcome=outcome)
+        return outcome
+
+    def close(self):
+        """
+        Close the camera's device session.
+
+        """
+        self.device_session.close()
+
     def gamma_correction(self, frame, gamma):
         '''
         Perform gamma correction so the image doesn't look too bright
         or dark in different environment
         '''
-        gamma_table = [np.power(x / 255.0, gamma) * 255.0 for x in range(256)]
-        gamma_table = np.round(np.array(gamma_table)).astype(np.uint8)
-        return cv2.LUT(frame, gamma_table)
+        return GammaSolver.apply(frame, gamma)
 
 class CameraHandler:
     """
@@ -227,18 +1139,25 @@ class CameraHandler:
     It also determines what the cameras should do from the current RM's speed.
 
     """
-    kewazo_camera_object_list = []
+    ON_DEVICE_JPEG_QUALITY = 95 # JPEG quality of stills encoded on the camera
+    PREVIEW_SIZE = (320, 240) # Width and height of the preview stream to read exposure from
 
     def __init__(self, liftbot_id, local_images_saving_directory,
-                rm_speed_threshold, camera_position_mapping):
+                rm_speed_threshold, camera_position_mapping,
+                capture_timeout=Camera.DEFAULT_CAPTURE_TIMEOUT, brightness_meter=None,
+                storage_handler=None, on_device_encoding=False, kewazo_camera_object_list=None,
+                motion_detector=None, spool_index=None, duplicate_detector=None,
+                device_factory=None, burst_size=Camera.DEFAULT_BURST_SIZE,
+                burst_keep_count=Camera.DEFAULT_BURST_KEEP_COUNT, sharpness_meter=None,
+                capture_scheduler=None):
         """
         Initialize multiple Camera objects with the appropriate DeviceInfo, Pipeline,
         and information about Liftbot. 
 
         NOTE: Only the Camera object gets initialized, not the DepthAI Device object.
-        The Device object will only get initialized when the cameras need to capture 
-        images. This is because initializing the Device object too soon may cause 
-        "Device already in use" error.
+        The Device object will only get initialized when the cameras first need to capture
+        images, and is then kept open by the camera's device session until close() is
+        called.
 
         Args:
             liftbot_id (string) : the ID to differentiate between multiple Liftbots 
@@ -251,41 +1170,263 @@ class CameraHandler:
                                     like 400000 when the RM is not moving. It is an
                                     absolute value
             camera_position_mapping (dictionary) : the dictionary to map camera's id to its
-                                                position on the TP. Only holds 2 values to
-                                                map to 'left' or 'right'
+                                                position on the TP, such as 'left' or
+                                                'right', for any number of cameras. The id
+                                                is either
+                                                the MX ID of the DepthAI device, or its
+                                                index in enumeration order
+            capture_timeout (float) : the maximum time each camera waits for a still after
+                                    the capture event, in seconds
+            brightness_meter (BrightnessMeter) : the meter shared by all cameras to measure
+                                                the brightness of captured images
+            storage_handler (StorageHandler) : the handler shared by all cameras to encode
+                                            and write images in the background. Defaults
+                                            to a StorageHandler with default settings
+            on_device_encoding (bool) : whether the cameras encode stills to JPEG before
+                                        sending them to the host device, see
+                                        set_depthai_common_pipeline
+            kewazo_camera_object_list (list) : the objects to capture images with, each
+                                            with the process_image and close methods of
+                                            Camera. If given, no DepthAI devices are
+                                            searched for. Used to replay CAN logs without
+                                            cameras
+            motion_detector (RmMotionDetector) : the detector that decides from the RM
+                                                speeds when the RM starts moving. Defaults
+                                                to an RmMotionDetector with the speed
+                                                threshold as start threshold
+            spool_index (SpoolIndex) : the index to record every written image in as
+                                    captured. None to not record images
+            duplicate_detector (DuplicateDetector) : the detector shared by all cameras
+                                                    to skip or mark near-duplicate
+                                                    stills. None to keep all stills
+            device_factory (callable) : a callable that takes a DeviceInfo object and
+                                        returns an open Device object, used by all
+                                        cameras. Defaults to dai.Device
+            burst_size (int) : the number of stills each camera takes per capture, of
+                            which only the sharpest are saved
+            burst_keep_count (int) : the number of sharpest stills of a burst to save,
+                                    1 or 2
+            sharpness_meter (SharpnessMeter) : the meter shared by all cameras to score
+                                            the sharpness of the stills of a burst
+            capture_scheduler (CaptureScheduler) : the scheduler that runs the captures
+                                                of all cameras, grouped by USB hub and
+                                                with a timeout per camera. Defaults to
+                                                a CaptureScheduler with default settings
 
         """
 
         self.liftbot_id = liftbot_id
         self.local_images_saving_directory = local_images_saving_directory
         self.rm_speed_threshold = rm_speed_threshold
-        self.last_speed_registered = 0 # Last recored RM speed, initialized to 0
+        self.camera_position_mapping = camera_position_mapping
+        self.motion_detector = motion_detector if motion_detector is not None \
+            else RmMotionDetector(start_speed_threshold=rm_speed_threshold)
         self.rm_status = 0 # Current state of RM. 1 is moving, 0 is stationary
+        self.storage_handler = storage_handler if storage_handler is not None \
+            else StorageHandler()
+        self.capture_completed_callback_list = []
+        self.spool_index = spool_index
+        self.duplicate_detector = duplicate_detector
+        self.capture_timeout = capture_timeout
+        self.brightness_meter = brightness_meter
+        self.on_device_encoding = on_device_encoding
+        self.device_factory = device_factory
+        self.burst_size = burst_size
+        self.burst_keep_count = burst_keep_count
+        self.sharpness_meter = sharpness_meter
+        self.capture_scheduler = capture_scheduler if capture_scheduler is not None \
+            else CaptureScheduler()
+        self.capture_scheduler.start()
+        self.oak_device_pipeline = None # Generated when the first camera is added
+
+        # Cameras are added and retired by the device monitor while images are captured.
+        # The list is replaced instead of changed in place, so a capture in progress
+        # keeps going with the cameras it started with
+        self.camera_list_lock = threading.Lock()
+        self.capture_lock = threading.Lock() # Held while the cameras capture images
+        self.camera_object_by_mx_id = {} # Cameras added from DepthAI devices, by MX ID
+        self.retire_thread_list = [] # Threads closing retired cameras with a late capture
+        self.assigned_camera_names = {} # Positions given to unmapped MX IDs, kept on retire
 
-        camera_id = 0
-        # Generate a common Pipeline for all Depth AI camera.
-        oak_device_pipeline = self.set_depthai_common_pipeline()
+        if kewazo_camera_object_list is not None:
+            self.kewazo_camera_object_list = kewazo_camera_object_list
+            return
+        self.kewazo_camera_object_list = []
 
         # Get all available OAK devices. Note that available means that
         # the device is connect and not in use.
-        all_camera_devices = dai.Device.getAllAvailableDevices()
+        for oak_device_info in dai.Device.getAllAvailableDevices():
+            self.add_camera(oak_device_info)
 
-        # Intialize Camera object with the common pipeline. If a camera does not use
-        # the common pipeline, it must be initialized separately.
+    def get_camera_name(self, mx_id):
+        """
+        Get the position on the TP of the camera with a DepthAI device. The position
+        mapped to the MX ID of the device is used if there is one. Otherwise the
+        device keeps the position it was given when it was first added, so that
+        cameras attached again in a different order do not swap positions. A device
+        added for the first time gets the first position mapped to an index that no
+        device was given yet, which is the position of its enumeration order when
+        all cameras are found at startup. If there is none, it gets the first one
+        that no camera holds, i.e. the position of a device that was retired. Must be
+        called with the camera list lock held.
+
+        Args:
+            mx_id (string) : the MX ID of the DepthAI device
 
-        if len(all_camera_devices) != 0:
-            for oak_device_info in all_camera_devices:
-                kewazo_camera_object = Camera(liftbot_id=liftbot_id,
-                                   camera_name=camera_position_mapping[camera_id],
-                                   oak_device_info=oak_device_info,
-                                   oak_device_pipeline=oak_device_pipeline)
-                self.kewazo_camera_object_list.append(kewazo_camera_object)
-                camera_id += 1
+        Returns:
+            string : the camera name, or None if all positions are taken
+
+        """
+        if mx_id in self.camera_position_mapping:
+            return self.camera_position_mapping[mx_id]
+        camera_name_list = [camera_object.camera_name for camera_object
+                            in self.kewazo_camera_object_list]
+        assigned_camera_name = self.assigned_camera_names.get(mx_id)
+        if assigned_camera_name is not None and assigned_camera_name not in camera_name_list:
+            return assigned_camera_name
+        mx_id_camera_name_list = [camera_name for camera_key, camera_name
+                                  in self.camera_position_mapping.items()
+                                  if isinstance(camera_key, str)]
+        free_camera_name_list = [
+            self.camera_position_mapping[camera_id]
+            for camera_id in sorted(camera_key for camera_key in self.camera_position_mapping
+                                    if isinstance(camera_key, int))
+            if self.camera_position_mapping[camera_id] not in camera_name_list and
+            self.camera_position_mapping[camera_id] not in mx_id_camera_name_list]
+        for camera_name in free_camera_name_list:
+            if camera_name not in self.assigned_camera_names.values():
+                break
+        else:
+            if not free_camera_name_list:
+                return None
+            camera_name = free_camera_name_list[0]
+        self.assigned_camera_names[mx_id] = camera_name
+        return camera_name
+
+    def add_camera(self, oak_device_info):
+        """
+        Initialize a Camera object for a DepthAI device and capture images with it
+        from the next capture on. The Device object is only opened on the first
+        capture.
+
+        Args:
+            oak_device_info (dai.DeviceInfo) : the DeviceInfo object of the device
+
+        Returns:
+            Camera : the new Camera object, or None if the device already has a camera
+                    or no position is left for it
 
-    def set_depthai_common_pipeline(self):
+        """
+        mx_id = oak_device_info.getMxId()
+        with self.camera_list_lock:
+            if mx_id in self.camera_object_by_mx_id:
+                return None
+            camera_name = self.get_camera_name(mx_id)
+            if camera_name is None:
+                logging.critical("No camera position left for device %s", mx_id)
+                return None
+
+            # Generate a common Pipeline for all Depth AI camera. If a camera does not
+            # use the common pipeline, it must be initialized separately.
+            if self.oak_device_pipeline is None:
+                self.oak_device_pipeline = self.set_depthai_common_pipeline(
+                    self.on_device_encoding)
+            kewazo_camera_object = Camera(liftbot_id=self.liftbot_id,
+                                          camera_name=camera_name,
+                                          oak_device_info=oak_device_info,
+                                          oak_device_pipeline=self.oak_device_pipeline,
+                                          capture_timeout=self.capture_timeout,
+                                          brightness_meter=self.brightness_meter,
+                                          storage_handler=self.storage_handler,
+                                          on_device_encoding=self.on_device_encoding,
+                                          duplicate_detector=self.duplicate_detector,
+                                          device_factory=self.device_factory,
+                                          burst_size=self.burst_size,
+                                          burst_keep_count=self.burst_keep_count,
+                                          sharpness_meter=self.sharpness_meter)
+            self.camera_object_by_mx_id[mx_id] = kewazo_camera_object
+            self.kewazo_camera_object_list = self.kewazo_camera_object_list + \
+                [kewazo_camera_object]
+        logging.warning("CAMERA %s ADDED WITH DEVICE %s", camera_name, mx_id)
+        return kewazo_camera_object
+
+    def retire_camera(self, mx_id):
+        """
+        Stop capturing images with the camera of a DepthAI device. A capture in
+        progress is finished first, then the device session of the camera is closed.
+        If a capture of the camera was given up on and still uses the device session,
+        the session is closed on a retire thread once the capture returns, so that the
+        captures of the other cameras go on in the meantime.
+
+        Args:
+            mx_id (string) : the MX ID of the DepthAI device
+
+        Returns:
+            Camera : the retired Camera object, or None if the device has no camera
+
+        """
+        with self.camera_list_lock:
+            kewazo_camera_object = self.camera_object_by_mx_id.pop(mx_id, None)
+            if kewazo_camera_object is None:
+                return None
+            self.kewazo_camera_object_list = [
+                camera_object for camera_object in self.kewazo_camera_object_list
+                if camera_object is not kewazo_camera_object]
+        # A capture that started with the camera has handed it to the capture scheduler
+        # once the lock is free. It takes at most the camera timeout
+        with self.capture_lock:
+            pass
+        if self.capture_scheduler.wait_for_camera(kewazo_camera_object, 0):
+            kewazo_camera_object.close()
+        else:
+            logging.warning("Camera %s retiring. Closing it once its capture returns",
+                            kewazo_camera_object.camera_name)
+            retire_thread = threading.Thread(target=self.close_retired_camera,
+                                             args=(kewazo_camera_object,),
+                                             name=f"camera-retire-{mx_id}", daemon=True)
+            with self.camera_list_lock:
+                self.retire_thread_list = [thread for thread in self.retire_thread_list
+                                           if thread.is_alive()] + [retire_thread]
+            retire_thread.start()
+        logging.warning("CAMERA %s RETIRED WITH DEVICE %s",
+                        kewazo_camera_object.camera_name, mx_id)
+        return kewazo_camera_object
+
+    def close_retired_camera(self, kewazo_camera_object):
+        """
+        Wait until the capture of a retired camera that was given up on returned, then
+        close the device session of the camera.
+
+        """
+        self.capture_scheduler.wait_for_camera(kewazo_camera_object)
+        kewazo_camera_object.close()
+        logging.warning("Camera %s closed after its capture returned",
+                        kewazo_camera_object.camera_name)
+
+    def get_camera_by_mx_id(self, mx_id):
+        """
+        Get the camera of a DepthAI device.
+
+        Returns:
+            Camera : the Camera object, or None if the device has no camera
+
+        """
+        with self.camera_list_lock:
+            return self.camera_object_by_mx_id.get(mx_id)
+
+    def set_depthai_common_pipeline(self, on_device_encoding=False):
         """
         Generate a common Pipeline for all DepthAI Device.
 
+        With on-device encoding, stills are encoded to JPEG by a VideoEncoder node
+        on the camera, and the JPEG bitstream is sent to the host device instead of
+        the raw frame. This cuts USB bandwidth, and host CPU and memory per capture.
+        A low resolution preview stream is sent as well, so that the host device
+        can read the exposure of a still encoded on the camera.
+
+        Args:
+            on_device_encoding (bool) : whether to encode stills on the camera
+
         Returns:
             dai.Pipeline : a Pipeline object that contains information about
                         how the camera should capture image, when it
@@ -303,13 +1444,29 @@ class CameraHandler:
 
         # Define xLinkIn node for receiving capture image event from host device
         xin_still = pipeline.create(dai.node.XLinkIn)
-        xin_still.setStreamName("control")
+        xin_still.setStreamName(DeviceSession.CONTROL_STREAM_NAME)
         xin_still.out.link(cam_rgb.inputControl)
 
         # Define XLinkOut node for sending image frame to host device
         xout_still = pipeline.create(dai.node.XLinkOut)
-        xout_still.setStreamName("still")
-        cam_rgb.still.link(xout_still.input)
+        xout_still.setStreamName(DeviceSession.STILL_STREAM_NAME)
+
+        if not on_device_encoding:
+            cam_rgb.still.link(xout_still.input)
+            return pipeline
+
+        # Define VideoEncoder node to encode stills to JPEG on the camera
+        still_encoder = pipeline.create(dai.node.VideoEncoder)
+        still_encoder.setDefaultProfilePreset(1, dai.VideoEncoderProperties.Profile.MJPEG)
+        still_encoder.setQuality(self.ON_DEVICE_JPEG_QUALITY)
+        cam_rgb.still.link(still_encoder.input)
+        still_encoder.bitstream.link(xout_still.input)
+
+        # Define XLinkOut node for sending low resolution preview frames to host device
+        cam_rgb.setPreviewSize(*self.PREVIEW_SIZE)
+        xout_preview = pipeline.create(dai.node.XLinkOut)
+        xout_preview.setStreamName(DeviceSession.PREVIEW_STREAM_NAME)
+        cam_rgb.preview.link(xout_preview.input)
 
         return pipeline
 
@@ -327,54 +1484,58 @@ class CameraHandler:
             logging.critical("No permission to create folder")
         return saving_directory
 
-    def execute(self, rm_speed):
-        """
-        Determine what the cameras should do based on the speed threshold, the current RM status,
-        and the difference between the current RM speed and the last recorded RM speed.
- 
+    def add_capture_completed_callback(self, callback):
         """
-        speed_diff = abs(rm_speed - self.last_speed_registered)
+        Register a function to be called with the timestamp saving directory every
+        time all images of a capture are written to it. The function is called from
+        a storage handler thread, so it should return quickly.
 
-        # There are 3 conditions that must be satisfied in order for the cameras to capture images:
-        #
-        # 1. The RM must not be moving (rm_status=0).
-        # 2. The current RM Speed is normal (abs(rm_speed) < 400000). This is implemented due to
-        # the fact that even when the RM is stationary, the recorded speed sent via CAN Bus can
-        #  sometimes be > 400000 or < -400000.
-        # 3. The absolute difference between the current RM speed and the last recorded RM speed
-        # is greater than the speed threshold. This is implemented as the camera should only
-        # capture images when the RM start moving (when the speed difference is large). When
-        # the RM is moving, although there will still be difference between the speed recorded,
-        # such difference is not very large.
-        #
-        # Upon satisfying all 3 conditions, a command will be send to all cameras to capture images.
-        # The RM status will also be updated to 1 (moving).
+        Args:
+            callback (function) : called with the timestamp saving directory
 
-        if (speed_diff > self.rm_speed_threshold and abs(rm_speed) < 210
-            and self.rm_status == 0 and speed_diff < 100):
-            self.process_images()
-            logging.info("Taking photos")
-            self.rm_status = 1
+        """
+        self.capture_completed_callback_list.append(callback)
 
-        # If the RM speed is normal (abs(rm_speed) < 400000 and abs(rm_speed) < 400000 > 40), the
-        # current RM speed will be recorded as the last RM speed to faciliate comparison
-        # with the next recorded RM speed.
+    def notify_capture_completed(self, timestamp_saving_directory):
+        """
+        Record the images of a timestamp saving directory in the spool index, then
+        call all capture completed callbacks for it.
 
-        if abs(rm_speed) < 210 and abs(rm_speed) > 150: #correct value here is 400
-            self.last_speed_registered = rm_speed
+        """
+        if self.spool_index is not None:
+            self.spool_index.record_folder(timestamp_saving_directory)
+        for callback in self.capture_completed_callback_list:
+            callback(timestamp_saving_directory)
 
-        # If the RM speed is not normal, the RM will be determined to be stationary.
-        # Its status will be updated to 0 (stationary).
-        # The last_speed_registered will also be 0.
+    def execute(self, rm_speed):
+        """
+        Determine what the cameras should do based on the current RM speed. The motion
+        detector filters the RM speed and tells when the RM starts moving, at which point
+        a command is sent to all cameras to capture images, once per start.
 
-        else:
-            self.rm_status = 0
-            self.last_speed_registered = 0
+        """
+        with REGISTRY.time_stage("trigger_decision"):
+            is_rm_starting = self.motion_detector.update(rm_speed)
+        if is_rm_starting:
+            REGISTRY.increment("triggers")
+            self.process_images()
+            logging.info("Taking photos")
+
+        # Current state of RM. 1 is moving, 0 is stationary
+        self.rm_status = 1 if self.motion_detector.is_moving else 0
 
     def process_images(self):
         """
         Generate appropriate saving directory for images based on the current date and time.
-        Use thread-based parallelism to command all Camera objects to capture images. 
+        Command all Camera objects to capture images through the capture scheduler.
+        Returns once all frames are captured, or their camera timed out, while they
+        are still being written by the storage handler. The capture completed
+        callbacks are called once, when they are all written. A camera that timed
+        out keeps the folder from being handed over until its capture returned, so
+        that the folder is not sent and removed while its image is still coming.
+
+        Returns:
+            string : the timestamp saving directory of the capture
 
         """
 
@@ -390,17 +1551,35 @@ class CameraHandler:
         timestamp_saving_directory = self.set_saving_directory(
             date_specific_saving_directory, timestamp)
 
-        with contextlib.ExitStack() as context_manager:
-            process_list = []
-            for camera_object in self.kewazo_camera_object_list:
-                # NOTE: Process-based parallelism does not work. Only Thread was
-                # found to work properly
-                process_capturing_image = threading.Thread(target=camera_object.process_image,
-                                                           args=(context_manager,
-                                                                timestamp_saving_directory,
-                                                                date,
-                                                                timestamp))
-                process_capturing_image.start()
-                process_list.append(process_capturing_image)
-            for process in process_list:
-                process.join()
+        # Cameras retired during the capture are only closed once it is finished.
+        # NOTE: Process-based parallelism does not work. Only Thread was found to
+        # work properly, so the capture scheduler runs the captures on worker threads
+        with self.capture_lock:
+            kewazo_camera_object_list = self.kewazo_camera_object_list
+            # Every camera holds the folder until its capture returned, late or not
+            self.storage_handler.hold_folder(timestamp_saving_directory,
+                                             len(kewazo_camera_object_list))
+            self.capture_scheduler.capture(
+                kewazo_camera_object_list, (timestamp_saving_directory, date, timestamp),
+                finished_callback=lambda capture_job: self.storage_handler.release_folder(
+                    timestamp_saving_directory))
+        self.storage_handler.seal_folder(timestamp_saving_directory,
+                                         self.notify_capture_completed)
+        return timestamp_saving_directory
+
+    def close(self):
+        """
+        Close the device sessions of all Camera objects, and write the images
+        still waiting in the storage handler.
+
+        """
+        self.capture_scheduler.close()
+        for camera_object in self.kewazo_camera_object_list:
+            self.capture_scheduler.wait_for_camera(camera_object,
+                                                   self.capture_scheduler.camera_timeout)
+            camera_object.close()
+        with self.camera_list_lock:
+            retire_thread_list = self.retire_thread_list
+        for retire_thread in retire_thread_list:
+            retire_thread.join(self.capture_scheduler.camera_timeout)
+        self.storage_handler.close()
@@ -7,16 +7,27 @@ It creates a CAN bus object with specified filters which the Camera Module can
 use to receive CAN messages from different CAN IDs to determine whether it should capture images.
 It also disconnects the CAN controller from CAN network when the Camera Module is turned off.
 
+CAN messages are read continuously in the background by a python-can Notifier.
+The RmSpeedListener decodes the RM speed of every message into a ring buffer, so
+that the camera system always works on the freshest RM speed, even if capturing
+images kept it busy for a while.
+
 Typical usage example:
 
     can0 = CanBushandler.setup_can(can_id_list_to_listen)
+    rm_speed_listener = RmSpeedListener()
+    notifier = can.Notifier(can0, [rm_speed_listener])
+    rm_speed_sample = rm_speed_listener.wait_for_latest(timeout)
+    notifier.stop()
     CanBushandler.can_down()
 
 """
 
 import os
-import can
+import threading
+import collections
 import logging
+import can
 
 class CanBusHandler:
     """
@@ -24,7 +35,7 @@ class CanBusHandler:
     """
 
     @staticmethod
-    def setup_can(can_id_list_to_listen):
+    def setup_can(can_id_list_to_listen, channel='can0', interface='socketcan'):
         """
         Connect CAN controller (MCP2515) to the CAN network to receive messages
         from specified CAN ID.
@@ -32,30 +43,57 @@ class CanBusHandler:
 
         Args:
             can_id_list_to_listen (list) : list of CAN ID to filter CAN messages.
+            channel (string) : the CAN channel to connect to
+            interface (string) : the python-can interface. Use 'virtual' to run
+                                without a CAN controller
 
         Returns:
             can.interface.Bus : a CAN object.
 
         """
         # Check whether the bitrate here matches RM's
-        try:
-            os.system('sudo ip link set can0 type can bitrate 1000000')
-            os.system('sudo ifconfig can0 up')
-        except Exception:
-            logging.critical("CAN SETUP ERROR")
-
+        if interface == 'socketcan':
+            try:
+                os.system(f'sudo ip link set {channel} type can bitrate 1000000')
+                os.system(f'sudo ifconfig {channel} up')
+            except Exception:
+                logging.critical("CAN SETUP ERROR")
 
-        can_channel = 'can0'
-        can_bustype = 'socketcan'
         can_filters = []
         for can_id in can_id_list_to_listen:
             can_filters.append({"can_id": can_id, "can_mask": 0x7FF, "extended": False})
 
-        can0 = can.interface.Bus(channel=can_channel, bustype=can_bustype, can_filters=can_filters)
+        can0 = can.interface.Bus(channel=channel, interface=interface, can_filters=can_filters)
         logging.info("CAN SETUP OK")
 
         return can0
 
+    @staticmethod
+    def decode_rm_speed(msg):
+        """
+        Convert a CAN message from the RM to the actual RM speed.
+
+        Args:
+            msg (can.Message) : the CAN message
+
+        Returns:
+            int : the RM speed
+
+        Raises:
+            ValueError : if the message does not carry an RM speed
+
+        """
+        if msg.is_error_frame or msg.is_remote_frame or len(msg.data) == 0:
+            raise ValueError("CAN message does not carry an RM speed")
+
+        # RM speed is the last 4 bytes of the CAN message
+        rm_speed_as_bytes = msg.data[-4:]
+
+        # Converting the speed from the CAN message to the actual RM speed.
+        #
+        # NOTE: CAN message follows little endian system.
+        return int.from_bytes(rm_speed_as_bytes, byteorder='little', signed=True)
+
     @staticmethod
     def can_down():
         """
@@ -63,3 +101,111 @@ class CanBusHandler:
         """
         os.system('sudo ifconfig can0 down')
         logging.critical("CAN network brought down by CANBusHandler")
+
+class RmSpeedListener(can.Listener):
+    """
+    A python-can Listener that decodes RM speeds into a ring buffer as CAN
+    messages arrive.
+
+    The consumer only takes the freshest RM speed. Every RM speed that was
+    superseded by a newer one before the consumer took it is counted as an
+    overrun frame. Messages that do not carry an RM speed are counted as
+    dropped frames.
+
+    """
+    DEFAULT_BUFFER_SIZE = 256
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        Args:
+            buffer_size (int) : the number of most recent RM speeds to keep
+
+        """
+        self.rm_speed_buffer = collections.deque(maxlen=buffer_size)
+        self.buffer_condition = threading.Condition()
+        self.unconsumed_count = 0 # RM speeds received since the consumer last took one
+
+        self.received_frame_count = 0
+        self.dropped_frame_count = 0
+        self.overrun_frame_count = 0
+        self.bus_error_count = 0
+
+    def on_message_received(self, msg):
+        """
+        Decode the RM speed of a CAN message into the ring buffer. Called by the
+        Notifier thread for every CAN message.
+
+        Args:
+            msg (can.Message) : the CAN message
+
+        """
+        with self.buffer_condition:
+            self.received_frame_count += 1
+            try:
+                rm_speed = CanBusHandler.decode_rm_speed(msg)
+            except ValueError:
+                self.dropped_frame_count += 1
+                return
+            self.rm_speed_buffer.append((msg.timestamp, rm_speed))
+            self.unconsumed_count += 1
+            self.buffer_condition.notify_all()
+
+    def on_error(self, exc):
+        """
+        Count and log errors raised while reading the CAN bus. Called by the
+        Notifier thread, which may stop reading afterwards, so the owner of the
+        Notifier sets the CAN bus up again once bus errors were counted.
+
+        Args:
+            exc (Exception) : the error raised by the CAN bus
+
+        """
+        with self.buffer_condition:
+            self.bus_error_count += 1
+        logging.critical("Could not receive CAN message. CAN network down: %s", exc)
+
+    def wait_for_latest(self, timeout=None):
+        """
+        Block until an RM speed arrives that the consumer has not taken yet, and
+        take the freshest one.
+
+        Args:
+            timeout (float) : the maximum time to wait, in seconds. None to wait forever
+
+        Returns:
+            tuple : the timestamp of the CAN message and the RM speed, or None if no
+                    new RM speed arrived before the timeout
+
+        """
+        with self.buffer_condition:
+            if not self.buffer_condition.wait_for(lambda: self.unconsumed_count > 0, timeout):
+                return None
+            self.overrun_frame_count += self.unconsumed_count - 1
+            self.unconsumed_count = 0
+            return self.rm_speed_buffer[-1]
+
+    def get_recent_speeds(self):
+        """
+        Get the most recent RM speeds, oldest first.
+
+        Returns:
+            list : tuples of the timestamp of the CAN message and the RM speed
+
+        """
+        with self.buffer_condition:
+            return list(self.rm_speed_buffer)
+
+    def get_metrics(self):
+        """
+        Get the frame counters of the listener.
+
+        Returns:
+            dict : the number of frames received, dropped and overrun, and the
+                number of bus errors
+
+        """
+        with self.buffer_condition:
+            return {"received": self.received_frame_count,
+                    "dropped": self.dropped_frame_count,
+                    "overrun": self.overrun_frame_count,
+                    "bus_errors": self.bus_error_count}
@@ -0,0 +1,215 @@
+"""
+A script to replay recorded RM CAN traffic through the camera system's trigger
+logic, without cameras and faster than real time.
+
+CAN messages are read from a candump (.log), ASC (.asc) or BLF (.blf) log
+with python-can's log readers. Every message goes through the same RM speed
+decoding as CentralHandler, and the decoded RM speed is passed to
+CameraHandler.execute. The cameras are replaced by stub objects that only
+record when they were triggered, on the clock of the log.
+
+The triggers are compared against the RM starts found in the log: an RM start
+is a change from standing still to moving at a valid speed for a number of
+consecutive messages. A start without a trigger shortly after it is a missed
+start, and a trigger without a start shortly before it is a spurious trigger.
+
+Typical usage example:
+
+    python3 can_log_replay.py candump-2023-07-17.log
+    python3 can_log_replay.py field_run.blf --rm-speed-threshold 60 --json
+
+"""
+
+import argparse
+import json
+import tempfile
+import time
+import can
+import numpy as np
+from can_bus_handler import RmSpeedListener
+from camera_handler import CameraHandler
+
+class TriggerRecordingCamera:
+    """
+    A class that stands in for a Camera object and only records the log time
+    at which it was triggered.
+    """
+
+    def __init__(self, camera_name, replay_clock):
+        """
+        Args:
+            camera_name (string) : the name of the camera
+            replay_clock (dict) : holds the timestamp of the CAN message being
+                                replayed under the key 'timestamp'
+
+        """
+        self.camera_name = camera_name
+        self.replay_clock = replay_clock
+        self.trigger_timestamp_list = []
+
+    def process_image(self, timestamp_saving_directory, date, timestamp):
+        """
+        Record the log time of the trigger instead of capturing an image.
+        """
+        del timestamp_saving_directory, date, timestamp
+        self.trigger_timestamp_list.append(self.replay_clock["timestamp"])
+
+    def close(self):
+        """
+        Nothing to close.
+        """
+
+def find_rm_starts(rm_speed_samples, rm_speed_threshold, garbage_speed, min_moving_samples):
+    """
+    Find the log times at which the RM started moving.
+
+    Args:
+        rm_speed_samples (list) : tuples of message timestamp and RM speed
+        rm_speed_threshold (int) : the absolute RM speed above which the RM is moving
+        garbage_speed (int) : the absolute RM speed from which a value is invalid and ignored
+        min_moving_samples (int) : the number of consecutive moving samples that make a start
+
+    Returns:
+        list : the timestamp of the first moving sample of every start
+
+    """
+    rm_start_timestamp_list = []
+    is_moving = False
+    moving_sample_count = 0
+    first_moving_timestamp = None
+    for timestamp, rm_speed in rm_speed_samples:
+        if abs(rm_speed) >= garbage_speed:
+            continue
+        if abs(rm_speed) > rm_speed_threshold:
+            if moving_sample_count == 0:
+                first_moving_timestamp = timestamp
+            moving_sample_count += 1
+            if not is_moving and moving_sample_count >= min_moving_samples:
+                is_moving = True
+                rm_start_timestamp_list.append(first_moving_timestamp)
+        else:
+            is_moving = False
+            moving_sample_count = 0
+    return rm_start_timestamp_list
+
+def match_triggers(rm_start_timestamp_list, trigger_timestamp_list, match_window):
+    """
+    Match every RM start with the first trigger within the match window after it.
+
+    Returns:
+        tuple : the number of missed starts and the number of spurious triggers
+
+    """
+    unmatched_trigger_list = sorted(trigger_timestamp_list)
+    missed_start_count = 0
+    for rm_start_timestamp in rm_start_timestamp_list:
+        matching_trigger_list = [trigger_timestamp for trigger_timestamp in unmatched_trigger_list
+                                 if 0 <= trigger_timestamp - rm_start_timestamp <= match_window]
+        if matching_trigger_list:
+            unmatched_trigger_list.remove(matching_trigger_list[0])
+        else:
+            missed_start_count += 1
+    return missed_start_count, len(unmatched_trigger_list)
+
+def replay_can_log(log_file_name, can_id_list_to_listen, rm_speed_threshold,
+                   camera_position_mapping, garbage_speed, min_moving_samples, match_window):
+    """
+    Replay a CAN log through the RM speed decoding and CameraHandler.execute.
+
+    Returns:
+        dict : the replay report
+
+    """
+    replay_clock = {"timestamp": 0.0}
+    camera_list = [TriggerRecordingCamera(camera_name, replay_clock)
+                   for camera_name in camera_position_mapping.values()]
+    rm_speed_listener = RmSpeedListener()
+    rm_speed_samples = []
+    decision_latency_list = []
+
+    with tempfile.TemporaryDirectory() as local_images_saving_directory:
+        camera_handler = CameraHandler(liftbot_id="REPLAY",
+                                       local_images_saving_directory=local_images_saving_directory,
+                                       rm_speed_threshold=rm_speed_threshold,
+                                       camera_position_mapping=camera_position_mapping,
+                                       kewazo_camera_object_list=camera_list)
+        message_count = 0
+        replay_start_time = time.perf_counter()
+        for msg in can.LogReader(log_file_name):
+            if msg.arbitration_id not in can_id_list_to_listen:
+                continue
+            message_count += 1
+            replay_clock["timestamp"] = msg.timestamp
+
+            decision_start_time = time.perf_counter()
+            rm_speed_listener.on_message_received(msg)
+            rm_speed_sample = rm_speed_listener.wait_for_latest(timeout=0)
+            if rm_speed_sample is not None:
+                camera_handler.execute(rm_speed_sample[1])
+            decision_latency_list.append(time.perf_counter() - decision_start_time)
+
+            if rm_speed_sample is not None:
+                rm_speed_samples.append(rm_speed_sample)
+        replay_time = time.perf_counter() - replay_start_time
+        camera_handler.close()
+
+    trigger_timestamp_list = camera_list[0].trigger_timestamp_list if camera_list else []
+    rm_start_timestamp_list = find_rm_starts(rm_speed_samples, rm_speed_threshold,
+                                             garbage_speed, min_moving_samples)
+    missed_start_count, spurious_trigger_count = match_triggers(
+        rm_start_timestamp_list, trigger_timestamp_list, match_window)
+    log_duration = rm_speed_samples[-1][0] - rm_speed_samples[0][0] if rm_speed_samples else 0.0
+    decision_latency_us = np.array(decision_latency_list or [0.0]) * 1e6
+
+    return {"log_file": log_file_name,
+            "messages": message_count,
+            "dropped_messages": rm_speed_listener.get_metrics()["dropped"],
+            "log_duration_s": log_duration,
+            "replay_time_s": replay_time,
+            "messages_per_second": message_count / replay_time if replay_time else 0.0,
+            "speedup": log_duration / replay_time if replay_time else 0.0,
+            "triggers": len(trigger_timestamp_list),
+            "rm_starts": len(rm_start_timestamp_list),
+            "missed_starts": missed_start_count,
+            "spurious_triggers": spurious_trigger_count,
+            "decision_latency_us": {
+                "p50": float(np.percentile(decision_latency_us, 50)),
+                "p90": float(np.percentile(decision_latency_us, 90)),
+                "p99": float(np.percentile(decision_latency_us, 99)),
+                "max": float(decision_latency_us.max())}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay CAN logs through the trigger logic")
+    parser.add_argument("log_file_name", nargs="+", help="candump .log, .asc or .blf file")
+    parser.add_argument("--can-id", type=lambda can_id: int(can_id, 0), action="append",
+                        help="CAN ID carrying the RM speed, default 0x3A0")
+    parser.add_argument("--rm-speed-threshold", type=int, default=60)
+    parser.add_argument("--garbage-speed", type=int, default=400000,
+                        help="Absolute RM speed from which a value is treated as invalid")
+    parser.add_argument("--min-moving-samples", type=int, default=5,
+                        help="Consecutive moving samples that make an RM start")
+    parser.add_argument("--match-window", type=float, default=2.0,
+                        help="Seconds after an RM start in which a trigger counts for it")
+    parser.add_argument("--json", action="store_true", help="Print the reports as JSON")
+    args = parser.parse_args()
+
+    report_list = [replay_can_log(log_file_name, args.can_id or [0x3A0],
+                                  args.rm_speed_threshold, {0: "left", 1: "right"},
+                                  args.garbage_speed, args.min_moving_samples,
+                                  args.match_window)
+                   for log_file_name in args.log_file_name]
+    if args.json:
+        print(json.dumps(report_list, indent=2))
+    else:
+        for report in report_list:
+            print(f"{report['log_file']}: {report['messages']} messages "
+                  f"({report['dropped_messages']} dropped), "
+                  f"{report['log_duration_s']:.1f} s of traffic replayed in "
+                  f"{report['replay_time_s']:.2f} s "
+                  f"({report['messages_per_second']:.0f} messages/s)")
+            print(f"    triggers {report['triggers']}   RM starts {report['rm_starts']}   "
+                  f"missed starts {report['missed_starts']}   "
+                  f"spurious triggers {report['spurious_triggers']}")
+            print("    decision latency   " + "   ".join(
+                f"{name} {value:.1f} us"
+                for name, value in report["decision_latency_us"].items()))
@@ -0,0 +1,430 @@
+"""
+This module schedules the captures of all cameras of a trigger on a bounded pool
+of worker threads, so that the camera system scales beyond two cameras without
+saturating the USB bus.
+
+Cameras on the same USB hub share its bandwidth. A full resolution still takes
+a large share of a USB 3 link, and all of a USB 2 link, so firing every camera
+at once makes the stills of all cameras on a hub arrive late, or time out. The
+CaptureScheduler groups the captures by the hub the DepthAI device of every
+camera is attached to, and lets a hub carry only a limited number of captures at
+once. A camera that runs at USB 2 speed takes the whole budget of its hub. The
+starts of two captures on the same hub can also be staggered by a short interval.
+Cameras on different hubs, or on PoE, capture in parallel.
+
+Every capture must finish within the camera timeout of its start. A capture that
+does not is given up on, so that one slow device cannot stall the whole trigger:
+its hub budget is released, and its worker is replaced until it returns. Until
+then the camera is busy. It is left out of the following triggers, so that two
+captures never share its device session, and it can be waited for before it is
+closed.
+
+Typical usage example:
+
+    capture_scheduler = CaptureScheduler(worker_count, hub_bandwidth, stagger_interval,
+                                         camera_timeout)
+    capture_scheduler.start()
+    capture_scheduler.capture(kewazo_camera_object_list, capture_arguments)
+    capture_scheduler.wait_for_camera(kewazo_camera_object)
+    capture_scheduler.get_metrics()
+    capture_scheduler.close()
+
+"""
+
+import time
+import threading
+import collections
+import logging
+import depthai as dai
+from metrics import REGISTRY
+
+class CaptureJob:
+    """
+    A class that holds the capture of one camera for one trigger.
+    """
+    STATE_QUEUED = "queued"
+    STATE_CAPTURING = "capturing"
+    STATE_DONE = "done"
+    STATE_TIMED_OUT = "timed_out" # Given up on, still running or never started
+    STATE_SKIPPED = "skipped" # Never started, as the camera was busy or the scheduler closed
+
+    def __init__(self, camera_object, capture_arguments, hub_name, bandwidth_weight,
+                 finished_callback=None):
+        """
+        Args:
+            camera_object (Camera) : the camera to capture with
+            capture_arguments (tuple) : the arguments of the camera's process_image
+            hub_name (string) : the USB hub the camera is attached to
+            bandwidth_weight (int) : the share of the hub budget the capture takes
+            finished_callback (function) : called with the job once it no longer uses
+                                        the camera, see CaptureScheduler.capture
+
+        """
+        self.camera_object = camera_object
+        self.capture_arguments = capture_arguments
+        self.hub_name = hub_name
+        self.bandwidth_weight = bandwidth_weight
+        self.finished_callback = finished_callback
+        self.state = self.STATE_QUEUED
+        self.outcome = None # Returned by process_image
+        self.submitted_time = time.monotonic()
+        self.started_time = None
+        self.finished_time = None
+
+class CaptureScheduler:
+    """
+    A class that runs the captures of a trigger on a bounded pool of workers, with
+    a bandwidth budget per USB hub and a timeout per camera.
+    """
+    DEFAULT_WORKER_COUNT = 4
+    DEFAULT_HUB_BANDWIDTH = 2 # Captures one USB 3 hub carries at once
+    DEFAULT_STAGGER_INTERVAL = 0.0 # Seconds between the starts of two captures on one hub
+    DEFAULT_CAMERA_TIMEOUT = 10.0 # Seconds a capture may take, including recaptures
+    # USB speeds at which a still takes all of the hub's bandwidth
+    SLOW_USB_SPEEDS = (dai.UsbSpeed.LOW, dai.UsbSpeed.FULL, dai.UsbSpeed.HIGH)
+
+    def __init__(self, worker_count=DEFAULT_WORKER_COUNT, hub_bandwidth=DEFAULT_HUB_BANDWIDTH,
+                 stagger_interval=DEFAULT_STAGGER_INTERVAL,
+                 camera_timeout=DEFAULT_CAMERA_TIMEOUT):
+        """
+        Args:
+            worker_count (int) : the number of captures run at once over all hubs
+            hub_bandwidth (int) : the number of captures of USB 3 cameras one hub
+                                carries at once. A USB 2 camera captures alone
+            stagger_interval (float) : the minimum time between the starts of two
+                                    captures on the same hub, in seconds
+            camera_timeout (float) : the time a capture may take from its start, and
+                                    may wait to start, in seconds
+
+        """
+        self.worker_count = worker_count
+        self.hub_bandwidth = hub_bandwidth
+        self.stagger_interval = stagger_interval
+        self.camera_timeout = camera_timeout
+
+        self.job_list = [] # Queued jobs, in order of submission
+        self.active_job_list = [] # Jobs capturing
+        self.hub_load = collections.Counter() # Bandwidth weight of the captures per hub
+        self.hub_started_time = {} # Start of the last capture per hub
+        self.scheduler_condition = threading.Condition()
+        self.is_closed = False
+        self.worker_list = []
+        self.replacement_worker_count = 0 # Workers started for captures given up on
+        self.busy_camera_set = set() # Cameras with a job that is queued or still running
+
+        self.finished_job_count = 0
+        self.timed_out_job_count = 0
+        self.skipped_job_count = 0
+
+    @staticmethod
+    def get_hub_name(camera_object):
+        """
+        Get the USB hub a camera is attached to, from the USB port path of its
+        DepthAI device, e.g. hub "1.2" for device "1.2.4". Cameras that are not
+        attached over USB are their own hub.
+
+        Returns:
+            string : the hub name
+
+        """
+        oak_device_info = getattr(camera_object, "oak_device_info", None)
+        if oak_device_info is None:
+            return camera_object.camera_name
+        if oak_device_info.protocol != dai.XLinkProtocol.X_LINK_USB_VSC:
+            return oak_device_info.name
+        # Names of unbooted devices end with the chip name, e.g. 1.2.4-ma2480
+        usb_port_path = oak_device_info.name.split("-")[0]
+        return usb_port_path.rsplit(".", 1)[0]
+
+    def get_bandwidth_weight(self, camera_object):
+        """
+        Get the share of its hub's budget a capture of a camera takes. The USB speed
+        is only known once the device session was opened; until then the camera is
+        taken to run at USB 3 speed.
+
+        """
+        device_session = getattr(camera_object, "device_session", None)
+        if device_session is not None and device_session.usb_speed in self.SLOW_USB_SPEEDS:
+            return self.hub_bandwidth
+        return 1
+
+    def can_start_job(self, job, current_time):
+        """
+        Check whether a queued job may start on its hub. Must be called with the
+        scheduler condition held.
+
+        """
+        hub_load = self.hub_load[job.hub_name]
+        if hub_load > 0 and hub_load + job.bandwidth_weight > self.hub_bandwidth:
+            return False
+        return current_time >= self.hub_started_time.get(job.hub_name, float("-inf")) + \
+            self.stagger_interval
+
+    def take_job(self):
+        """
+        Take the first queued job that may start, and the time to wait until one may
+        start if there is none. Must be called with the scheduler condition held.
+
+        Returns:
+            tuple : the job (CaptureJob) or None, and the time to wait in seconds, or
+                    None to wait until a capture finishes
+
+        """
+        current_time = time.monotonic()
+        wait_time = None
+        for job in self.job_list:
+            if self.can_start_job(job, current_time):
+                self.job_list.remove(job)
+                job.state = CaptureJob.STATE_CAPTURING
+                job.started_time = current_time
+                self.active_job_list.append(job)
+                self.hub_load[job.hub_name] += job.bandwidth_weight
+                self.hub_started_time[job.hub_name] = current_time
+                return job, None
+            stagger_end_time = self.hub_started_time.get(job.hub_name, current_time) + \
+                self.stagger_interval
+            if stagger_end_time > current_time:
+                wait_time = stagger_end_time - current_time if wait_time is None \
+                    else min(wait_time, stagger_end_time - current_time)
+        return None, wait_time
+
+    def release_hub(self, job):
+        """
+        Give the hub budget of a job back. Must be called with the scheduler
+        condition held.
+
+        """
+        self.active_job_list.remove(job)
+        self.hub_load[job.hub_name] -= job.bandwidth_weight
+        if self.hub_load[job.hub_name] <= 0:
+            del self.hub_load[job.hub_name]
+
+    def process_jobs(self):
+        """
+        Worker loop. Run queued captures whenever their hub allows, until the
+        CaptureScheduler is closed. A worker whose capture was given up on stops
+        once the capture returns, as a replacement was started in the meantime.
+
+        """
+        while True:
+            with self.scheduler_condition:
+                while True:
+                    if self.is_closed:
+                        return
+                    job, wait_time = self.take_job()
+                    if job is not None:
+                        break
+                    self.scheduler_condition.wait(wait_time)
+            REGISTRY.observe_stage("capture_queue", job.started_time - job.submitted_time,
+                                   camera=job.camera_object.camera_name)
+
+            try:
+                outcome = job.camera_object.process_image(*job.capture_arguments)
+            except Exception:
+                logging.exception("Unknown Error when capturing with camera %s",
+                                  job.camera_object.camera_name)
+                outcome = None
+
+            with self.scheduler_condition:
+                job.outcome = outcome
+                job.finished_time = time.monotonic()
+                self.finished_job_count += 1
+                self.busy_camera_set.discard(job.camera_object)
+                if job.state == CaptureJob.STATE_TIMED_OUT:
+                    self.replacement_worker_count -= 1
+                else:
+                    job.state = CaptureJob.STATE_DONE
+                    self.release_hub(job)
+                self.scheduler_condition.notify_all()
+
+            self.run_finished_callback(job)
+            if job.state == CaptureJob.STATE_TIMED_OUT:
+                logging.warning("Camera %s finished capture after %.1f s",
+                                job.camera_object.camera_name,
+                                job.finished_time - job.started_time)
+                return
+
+    @staticmethod
+    def run_finished_callback(job):
+        """
+        Call back for a job that no longer uses its camera, logging instead of
+        raising errors so that a faulty callback cannot stop a worker thread.
+
+        """
+        if job.finished_callback is None:
+            return
+        try:
+            job.finished_callback(job)
+        except Exception:
+            logging.exception("Error in callback for capture of camera %s",
+                              job.camera_object.camera_name)
+
+    def give_up_job(self, job):
+        """
+        Give up on a job that took longer than the camera timeout, and start a
+        replacement worker if it is still capturing. Must be called with the
+        scheduler condition held.
+
+        """
+        if job.state == CaptureJob.STATE_QUEUED:
+            self.job_list.remove(job)
+            self.busy_camera_set.discard(job.camera_object)
+        else:
+            self.release_hub(job)
+            self.replacement_worker_count += 1
+            self.start_worker(f"capture-worker-replacement-{self.timed_out_job_count}")
+        job.state = CaptureJob.STATE_TIMED_OUT
+        self.timed_out_job_count += 1
+        REGISTRY.increment("capture_timeouts", camera=job.camera_object.camera_name)
+        logging.critical("Camera %s did not finish capture within %s seconds. Moving on",
+                         job.camera_object.camera_name, self.camera_timeout)
+        self.scheduler_condition.notify_all()
+
+    def capture(self, camera_object_list, capture_arguments, finished_callback=None):
+        """
+        Capture with all cameras and wait until every capture finished or was given
+        up on. Cameras still busy with a capture given up on in an earlier call are
+        skipped.
+
+        Args:
+            camera_object_list (list) : the cameras to capture with
+            capture_arguments (tuple) : the arguments of the cameras' process_image
+            finished_callback (function) : called with the job of every camera once it
+                                        no longer uses the camera: when its capture
+                                        returned, on a worker thread and also if it
+                                        was given up on, or when it was skipped or
+                                        given up on before it started
+
+        Returns:
+            list : the CaptureJob of every camera
+
+        """
+        job_list = [CaptureJob(camera_object, capture_arguments,
+                               self.get_hub_name(camera_object),
+                               self.get_bandwidth_weight(camera_object), finished_callback)
+                    for camera_object in camera_object_list]
+        unstarted_job_list = [] # Jobs that never started, called back by this thread
+        with self.scheduler_condition:
+            for job in job_list:
+                if self.is_closed or job.camera_object in self.busy_camera_set:
+                    self.skip_job(job)
+                    unstarted_job_list.append(job)
+                    continue
+                self.busy_camera_set.add(job.camera_object)
+                self.job_list.append(job)
+            self.scheduler_condition.notify_all()
+
+            while True:
+                current_time = time.monotonic()
+                next_deadline = None
+                is_finished = True
+                for job in job_list:
+                    if job.state in (CaptureJob.STATE_DONE, CaptureJob.STATE_TIMED_OUT,
+                                     CaptureJob.STATE_SKIPPED):
+                        continue
+                    # Queued jobs wait at most the camera timeout for their hub
+                    deadline = (job.started_time if job.started_time is not None
+                                else job.submitted_time) + self.camera_timeout
+                    if current_time >= deadline:
+                        if job.state == CaptureJob.STATE_QUEUED:
+                            unstarted_job_list.append(job)
+                        self.give_up_job(job)
+                        continue
+                    is_finished = False
+                    next_deadline = deadline if next_deadline is None \
+                        else min(next_deadline, deadline)
+                if is_finished:
+                    break
+                if self.is_closed:
+                    # Queued jobs were dropped by close, captures in progress are finished
+                    for job in job_list:
+                        if job.state == CaptureJob.STATE_QUEUED:
+                            self.busy_camera_set.discard(job.camera_object)
+                            self.skip_job(job)
+                            unstarted_job_list.append(job)
+                    break
+                self.scheduler_condition.wait(next_deadline - current_time)
+
+        for job in unstarted_job_list:
+            self.run_finished_callback(job)
+        return job_list
+
+    def skip_job(self, job):
+        """
+        Skip a job that did not start. Must be called with the scheduler condition
+        held.
+
+        """
+        job.state = CaptureJob.STATE_SKIPPED
+        self.skipped_job_count += 1
+        REGISTRY.increment("capture_skips", camera=job.camera_object.camera_name)
+        logging.warning("Camera %s skipped. Busy with a capture given up on, or closing",
+                        job.camera_object.camera_name)
+
+    def wait_for_camera(self, camera_object, timeout=None):
+        """
+        Wait until a camera has no capture queued or running, including a capture
+        that was given up on, so that it can be closed.
+
+        Args:
+            camera_object (Camera) : the camera to wait for
+            timeout (float) : the maximum time to wait, in seconds. None to wait until
+                            the capture returns
+
+        Returns:
+            bool : True if the camera is no longer busy
+
+        """
+        with self.scheduler_condition:
+            return self.scheduler_condition.wait_for(
+                lambda: camera_object not in self.busy_camera_set, timeout)
+
+    def get_metrics(self):
+        """
+        Get the state of the scheduler.
+
+        Returns:
+            dict : the number of captures queued, running and finished, the number of
+                captures given up on and skipped, the number of cameras busy, and the
+                bandwidth weight in use per hub
+
+        """
+        with self.scheduler_condition:
+            return {"queued": len(self.job_list),
+                    "capturing": len(self.active_job_list),
+                    "finished": self.finished_job_count,
+                    "timed_out": self.timed_out_job_count,
+                    "skipped": self.skipped_job_count,
+                    "busy_cameras": len(self.busy_camera_set),
+                    "hub_load": dict(self.hub_load)}
+
+    def start_worker(self, worker_name):
+        """
+        Start a worker thread.
+
+        """
+        worker = threading.Thread(target=self.process_jobs, name=worker_name, daemon=True)
+        worker.start()
+        self.worker_list.append(worker)
+
+    def start(self):
+        """
+        Start the worker threads.
+
+        """
+        for worker_id in range(self.worker_count):
+            self.start_worker(f"capture-worker-{worker_id}")
+
+    def close(self):
+        """
+        Stop taking new captures, and let the workers finish the captures in progress.
+        Captures given up on are not waited for.
+
+        """
+        with self.scheduler_condition:
+            self.is_closed = True
+            self.job_list.clear()
+            self.scheduler_condition.notify_all()
+        for worker in self.worker_list:
+            if worker is not threading.current_thread():
+                worker.join(self.camera_timeout)
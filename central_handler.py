@@ -1,178 +1,645 @@
-"""
-This module handles setting up the camera system to receive CAN message,
-capture images, and send images to server.
-
-All operations (receving message, capture images, and send images) are
-done synchronously with thread-based parallelism.
-
-Typical usage example:
-
-    central_handler = CentralHandler(liftbot_id, ssh_pass_file_name,
-                                    connection_port, dashboard_host_name,
-                                    dashboard_host_ip, dashboard_images_saving_directory,
-                                    rm_speed_threshold, camera_position_mapping,
-                                    can_id_list_to_listen)
-    central_handler.start()
-
-"""
-import logging
-import threading
-import contextlib
-from multiprocessing import Process
-from can_bus_handler import CanBusHandler
-from camera_handler import CameraHandler
-from dashboard_handler import DashboardHandler
-
-
-class CentralHandler:
-    """
-    This module handles setting up the camera system to receive CAN message,
-    capture images, and send images to server.
-
-    All operations (receving message, capture images, and send images) are
-    done synchronously with thread-based parallelism.
-
-    """
-
-    LOCAL_IMAGES_SAVING_DIRECTORY = "./images"
-
-    def __init__(self, liftbot_id, ssh_pass_file_name, connection_port, dashboard_host_name,
-                 dashboard_host_ip, dashboard_top_saving_directory, rm_speed_threshold,
-                 camera_position_mapping, can_id_list_to_listen):
-
-        """
-        Initialize the CentralHandler with the appropriate information so it can set up
-        CAN communication and initialize Dashboardhandler and CameraHandler
-
-        Args:
-            liftbot_id (string) : an ID to differentiate between multiple Liftbots 
-                            to know which Liftbot the camera belongs to
-            ssh_pass_file_name (.txt) : a file that contains the ssh password to
-                                    connect to the server
-            connection_port (int) : a number to indicate which port on the server to
-                                        connect to
-            dashboard_host_name (string) : the server's host name 
-            dashboard_host_ip (string) : the server's host ip
-            dashboard_top_saving_directory (string) : the top folder that contains
-                                                    all the images on the server
-            local_images_saving_directory (string) : the top folder that contains all
-                                                the images on the host device
-            rm_speed_threshold (int) : the speed threshold to determine whether the RM is
-                                    actually moving. This is implemented as the RM_speed
-                                    retrieved from CAN sometimes show very high value
-                                    like 400000 when the RM is not moving. It is an
-                                    absolute value
-            camera_position_mapping (dictionary) : the dictionary to map camera's id to
-                                            its position on the TP. Only holds 2 values
-                                            to map to 'left' or 'right'
-            can_id_list_to_listen (list) : list of CAN ID to filter CAN messages
-
-        """
-        self.liftbot_id = liftbot_id
-
-        self.can_handler = contextlib.ExitStack().enter_context(CanBusHandler.setup_can(can_id_list_to_listen=can_id_list_to_listen))
-        self.dashboard_handler = DashboardHandler(liftbot_id=liftbot_id, ssh_pass_file_name=ssh_pass_file_name,
-                                                  connection_port=connection_port,
-                                                  dashboard_host_name=dashboard_host_name,
-                                                  dashboard_host_ip=dashboard_host_ip,
-                                                  dashboard_top_saving_directory=
-                                                  dashboard_top_saving_directory,
-                                                  local_images_saving_directory=
-                                                  self.LOCAL_IMAGES_SAVING_DIRECTORY)
-        self.camera_handler = CameraHandler(liftbot_id=liftbot_id,
-                                            local_images_saving_directory=
-                                            self.LOCAL_IMAGES_SAVING_DIRECTORY,
-                                            rm_speed_threshold=rm_speed_threshold,
-                                            camera_position_mapping=camera_position_mapping)
-        
-        logging.info("CENTRAL HANDLER setup OK")
-
-    def send_image_to_dashboard(self):
-        """
-        Execute Dashboard Handler to send images to server.
-
-        """
-        try:
-            while True:
-                self.dashboard_handler.execute()
-        except KeyboardInterrupt:
-            logging.critical("Stop sending image. KeyboardInterrupt")
-            return
-        except Exception:
-            logging.exception("Unknown Error. Cannot send to server")
-            return
-
-    def handle_can_message(self):
-        """
-        Receiving CAN message from the RM. The function then convert
-        this message to the actual RM speed, and tell Camera Handler to
-        execute its operation based on this speed. 
-
-        """
-        try:
-            while True:
-                try:
-                    msg = self.can_handler.recv()
-                except Exception:
-                    logging.critical("Could not receive CAN message. CAN network down")
-                # RM speed is the last 4 bytes of the CAN message
-                rm_speed_as_bytes = msg.data[-4:]
-
-                # Converting the speed from the CAN message to the actual RM speed.
-                #
-                # NOTE: CAN message follows little endian system.
-                rm_speed = int.from_bytes(rm_speed_as_bytes, byteorder='little', signed=True)
-                self.camera_handler.execute(rm_speed)
-        except KeyboardInterrupt:
-            logging.critical("Stop handling CAN message. KeyboardInterrupt")
-            return
-        except Exception:
-            logging.exception("Unknown Error while handling CAN Message")
-            return
-
-
-    def start(self):
-        """
-        Start camera system execution.
-        """
-        process_handling_can_messages = threading.Thread(target=self.handle_can_message)
-        process_uploading_images = threading.Thread(target=self.send_image_to_dashboard)
-        
-        try:
-            process_uploading_images.start()
-            process_handling_can_messages.start()
-
-            process_uploading_images.join()
-            process_handling_can_messages.join()
-
-        except KeyboardInterrupt:
-            logging.critical("KeyboardInterrupt")
-            CanBusHandler.can_down()
-        except Exception:
-            logging.exception("Unknown Error. Read stack for details")
-            CanBusHandler.can_down()
-
-if __name__ == "__main__":
-    LIFTBOT_ID = "LB1"
-    SSH_PASS_FILE = "ssh_pass"
-    CONNECTION_PORT = "18538"
-    DASHBOARD_HOST_NAME = "khang"
-    DASHBOARD_HOST_IP = "7.tcp.eu.ngrok.io"
-    DASHBOARD_TOP_SAVING_DIRECTORY= "./images"
-    CAMERA_POSITION_MAPPING = {0: "left", 1: "right"}
-    RM_SPEED_THRESHOLD = 60 # Speed threshold is absolute value +- 60
-    CAN_ID_LIST_TO_LISTEN = [0x3A0] # Add more if needed
-
-    logging.basicConfig(filename='./log/debug.log', format='%(asctime)s %(message)s', filemode='a', level=logging.WARNING)
-
-    central_handler = CentralHandler(liftbot_id=LIFTBOT_ID,
-                                     ssh_pass_file_name=SSH_PASS_FILE,
-                                     connection_port=CONNECTION_PORT,
-                                     dashboard_host_name=DASHBOARD_HOST_NAME,
-                                     dashboard_host_ip=DASHBOARD_HOST_IP,
-                                     dashboard_top_saving_directory=
-                                     DASHBOARD_TOP_SAVING_DIRECTORY,
-                                     rm_speed_threshold=RM_SPEED_THRESHOLD,
-                                     camera_position_mapping=CAMERA_POSITION_MAPPING,
-                                     can_id_list_to_listen=CAN_ID_LIST_TO_LISTEN)
-    central_handler.start()
+"""
+This module handles setting up the camera system to receive CAN message,
+capture images, and send images to server.
+
+All operations (receving message, capture images, and send images) are
+done synchronously with thread-based parallelism. CAN messages are read
+continuously in the background, and captures are decided on the freshest
+RM speed. Every capture whose images are all written is handed over to
+Dashboard Handler's upload queue.
+The latency of every stage, from CAN frame to image on the server, is
+recorded in the metrics registry and can be served locally or dumped to a file.
+
+Startup is staged so that no RM start is missed while the camera system boots.
+CAN messages are read first. OpenCV, NumPy and DepthAI are only imported
+afterwards, in the background, where the cameras are searched for and the
+capture and upload subsystems are set up. Until the capture subsystem reports
+ready, RM speeds still go through the motion detector, and an RM start is kept
+and captured as soon as the cameras are up. The time from process start to CAN
+ready, capture ready and first capture is logged and exported as metrics.
+
+Typical usage example:
+
+    central_handler = CentralHandler(liftbot_id, ssh_pass_file_name,
+                                    connection_port, dashboard_host_name,
+                                    dashboard_host_ip, dashboard_images_saving_directory,
+                                    rm_speed_threshold, camera_position_mapping,
+                                    can_id_list_to_listen)
+    central_handler.start()
+
+"""
+import os
+import time
+import socket
+import logging
+import threading
+import contextlib
+import can
+from can_bus_handler import CanBusHandler, RmSpeedListener
+from motion_detector import RmMotionDetector
+from metrics import REGISTRY, MetricsServer, MetricsFileWriter
+from profiler import RuntimeProfiler
+
+# Fallback for the process start when /proc cannot be read
+MODULE_IMPORT_TIME = time.monotonic()
+
+class CentralHandler:
+    """
+    This module handles setting up the camera system to receive CAN message,
+    capture images, and send images to server.
+
+    All operations (receving message, capture images, and send images) are
+    done synchronously with thread-based parallelism.
+
+    """
+
+    LOCAL_IMAGES_SAVING_DIRECTORY = "./images"
+    PROFILE_LOG_DIRECTORY = "./log"
+    CAN_MESSAGE_TIMEOUT = 5 # Seconds without RM speed before the CAN network is reported down
+
+    def __init__(self, liftbot_id, ssh_pass_file_name, connection_port, dashboard_host_name,
+                 dashboard_host_ip, dashboard_top_saving_directory, rm_speed_threshold,
+                 camera_position_mapping, can_id_list_to_listen, on_device_encoding=False,
+                 can_channel='can0', can_interface='socketcan', encoding_profile_name=None,
+                 preview_profile_name=None, full_resolution_upload_hours=None,
+                 duplicate_detector_settings=None, metrics_port=None, metrics_file_name=None,
+                 is_profiling_enabled=False, device_poll_interval=1.0, burst_size=1,
+                 burst_keep_count=1, capture_scheduler_settings=None, upload_url=None,
+                 upload_token_file_name=None, upload_bandwidth_limit=None):
+
+        """
+        Initialize the CentralHandler with the appropriate information so it can set up
+        CAN communication. Dashboardhandler and CameraHandler are initialized in the
+        background by start(), once CAN messages are read.
+
+        Args:
+            liftbot_id (string) : an ID to differentiate between multiple Liftbots 
+                            to know which Liftbot the camera belongs to
+            ssh_pass_file_name (.txt) : a file that contains the ssh password to
+                                    connect to the server
+            connection_port (int) : a number to indicate which port on the server to
+                                        connect to
+            dashboard_host_name (string) : the server's host name 
+            dashboard_host_ip (string) : the server's host ip
+            dashboard_top_saving_directory (string) : the top folder that contains
+                                                    all the images on the server
+            local_images_saving_directory (string) : the top folder that contains all
+                                                the images on the host device
+            rm_speed_threshold (int) : the speed threshold to determine whether the RM is
+                                    actually moving. This is implemented as the RM_speed
+                                    retrieved from CAN sometimes show very high value
+                                    like 400000 when the RM is not moving. It is an
+                                    absolute value
+            camera_position_mapping (dictionary) : the dictionary to map camera's id to
+                                            its position on the TP, such as 'left' or
+                                            'right', for any number of cameras. The id
+                                            is either
+                                            the MX ID of the DepthAI device, or its
+                                            index in enumeration order
+            can_id_list_to_listen (list) : list of CAN ID to filter CAN messages
+            on_device_encoding (bool) : whether the cameras encode stills to JPEG before
+                                        sending them to the host device
+            can_channel (string) : the CAN channel to connect to
+            can_interface (string) : the python-can interface. Use 'virtual' to run
+                                    without a CAN controller
+            encoding_profile_name (string) : the name of the profile in ENCODING_PROFILES
+                                            to encode images with on the host device.
+                                            None for OpenCV's default JPEG encoding
+            preview_profile_name (string) : the name of the profile in ENCODING_PROFILES
+                                            of the low resolution copy sent ahead of
+                                            every image. None for no copy
+            full_resolution_upload_hours (tuple) : the start and end hour of the day when
+                                                full resolution images are sent. None to
+                                                send them at any time
+            duplicate_detector_settings (dictionary) : the keyword arguments of the
+                                                    DuplicateDetector that skips or marks
+                                                    images that are near-duplicates of
+                                                    recent images. None to keep all images
+            metrics_port (int) : the local TCP port to serve the stage latencies and
+                                counters on in the Prometheus text format. None to not
+                                serve them
+            metrics_file_name (string) : the file to write the stage latencies and
+                                        counters to periodically in the Prometheus text
+                                        format. None to not write them
+            is_profiling_enabled (bool) : whether to profile CPU time and memory growth
+                                        from the start. Profiling can also be toggled
+                                        at any time with SIGUSR2
+            device_poll_interval (float) : the time between two checks for cameras
+                                        attached and detached while running, in
+                                        seconds. None to only use the cameras found
+                                        at startup
+            burst_size (int) : the number of stills every camera takes per capture, of
+                            which only the sharpest are saved
+            burst_keep_count (int) : the number of sharpest stills of a burst to save,
+                                    1 or 2
+            capture_scheduler_settings (dictionary) : the keyword arguments of the
+                                                    CaptureScheduler that runs the
+                                                    captures of all cameras. None for
+                                                    the default settings
+            upload_url (string) : the URL of an upload server to send images to over
+                                HTTP(S), see upload_receiver. None to send them with
+                                rsync over SSH
+            upload_token_file_name (string) : a file that contains the bearer token
+                                            for the upload server. None to send no token
+            upload_bandwidth_limit (float) : the highest total upload bandwidth in bytes
+                                            per second, shared by all transfers. None
+                                            for no cap
+
+        """
+        self.liftbot_id = liftbot_id
+        self.ssh_pass_file_name = ssh_pass_file_name
+        self.connection_port = connection_port
+        self.dashboard_host_name = dashboard_host_name
+        self.dashboard_host_ip = dashboard_host_ip
+        self.dashboard_top_saving_directory = dashboard_top_saving_directory
+        self.rm_speed_threshold = rm_speed_threshold
+        self.camera_position_mapping = camera_position_mapping
+        self.on_device_encoding = on_device_encoding
+        self.encoding_profile_name = encoding_profile_name
+        self.preview_profile_name = preview_profile_name
+        self.full_resolution_upload_hours = full_resolution_upload_hours
+        self.duplicate_detector_settings = duplicate_detector_settings
+
+        self.can_id_list_to_listen = can_id_list_to_listen
+        self.can_channel = can_channel
+        self.can_interface = can_interface
+        self.can_handler = contextlib.ExitStack().enter_context(CanBusHandler.setup_can(
+            can_id_list_to_listen=can_id_list_to_listen, channel=can_channel,
+            interface=can_interface))
+        self.rm_speed_listener = RmSpeedListener()
+        self.can_notifier = None
+        self.can_bus_error_count = 0 # Bus errors of the listener when the CAN bus was set up
+
+        # Set up in the background by set_up_capture_subsystem
+        self.spool_index = None
+        self.dashboard_handler = None
+        self.camera_handler = None
+        self.device_monitor = None
+        self.device_poll_interval = device_poll_interval
+        self.burst_size = burst_size
+        self.burst_keep_count = burst_keep_count
+        self.capture_scheduler_settings = capture_scheduler_settings
+        self.upload_url = upload_url
+        self.upload_token_file_name = upload_token_file_name
+        self.upload_bandwidth_limit = upload_bandwidth_limit
+        self.motion_detector = None
+        self.capture_ready_event = threading.Event()
+        self.capture_startup_thread = None
+        self.pending_trigger_time = None # When an RM start seen before capture was ready happened
+
+        self.process_start_uptime = self.get_process_start_uptime()
+        self.startup_times = {} # Seconds from process start to every startup milestone
+        self.startup_times_lock = threading.Lock()
+
+        # Export the state of every handler along with the stage latencies
+        REGISTRY.add_collector("can", self.rm_speed_listener.get_metrics)
+        REGISTRY.add_collector("startup", self.get_startup_times)
+        self.metrics_server = MetricsServer(REGISTRY, metrics_port) \
+            if metrics_port is not None else None
+        self.metrics_file_writer = MetricsFileWriter(metrics_file_name, REGISTRY) \
+            if metrics_file_name is not None else None
+        self.is_profiling_enabled = is_profiling_enabled
+        self.runtime_profiler = RuntimeProfiler(self.PROFILE_LOG_DIRECTORY)
+
+        logging.info("CENTRAL HANDLER setup OK")
+
+    @staticmethod
+    def get_system_uptime():
+        """
+        Get the time since the host device booted.
+
+        Returns:
+            float : the uptime in seconds, or None if it cannot be read
+
+        """
+        try:
+            with open("/proc/uptime", encoding="ascii") as uptime_file:
+                return float(uptime_file.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def get_process_start_uptime():
+        """
+        Get the uptime of the host device when this process started, which includes
+        starting the interpreter and importing this module.
+
+        Returns:
+            float : the uptime in seconds, or None if it cannot be read
+
+        """
+        try:
+            with open("/proc/self/stat", encoding="ascii") as stat_file:
+                # The process name may contain spaces, so fields are counted after it
+                stat_field_list = stat_file.read().rsplit(")", 1)[1].split()
+            return int(stat_field_list[19]) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def get_time_since_process_start(self):
+        """
+        Get the time since this process started, in seconds.
+
+        """
+        system_uptime = self.get_system_uptime()
+        if system_uptime is None or self.process_start_uptime is None:
+            return time.monotonic() - MODULE_IMPORT_TIME
+        return system_uptime - self.process_start_uptime
+
+    def record_startup_time(self, milestone):
+        """
+        Record the time from process start to a startup milestone, once.
+
+        Args:
+            milestone (string) : the name of the milestone, e.g. "capture_ready"
+
+        """
+        with self.startup_times_lock:
+            if milestone in self.startup_times:
+                return
+            self.startup_times[milestone] = self.get_time_since_process_start()
+        logging.warning("STARTUP %s after %.2f s", milestone, self.startup_times[milestone])
+
+    def get_startup_times(self):
+        """
+        Get the startup times recorded so far.
+
+        Returns:
+            dict : the seconds from process start to CAN ready, capture ready and the
+                first capture saved, and the seconds from boot of the host device to
+                the first capture saved
+
+        """
+        with self.startup_times_lock:
+            return dict(self.startup_times)
+
+    def record_first_capture(self, timestamp_saving_directory):
+        """
+        Record the startup time of the first capture saved, and the time since the
+        host device booted. Called back by Camera Handler for every capture.
+
+        """
+        if "first_capture" in self.startup_times:
+            return
+        self.record_startup_time("first_capture")
+        system_uptime = self.get_system_uptime()
+        if system_uptime is not None:
+            with self.startup_times_lock:
+                self.startup_times.setdefault("boot_to_first_capture", system_uptime)
+            logging.warning("STARTUP first capture %s saved %.1f s after boot",
+                            timestamp_saving_directory, system_uptime)
+
+    @staticmethod
+    def notify_systemd(state):
+        """
+        Tell systemd about the state of the camera system, if it runs as a service
+        of Type=notify. Do nothing otherwise.
+
+        Args:
+            state (string) : the state, e.g. "READY=1" or "STATUS=Setting up cameras"
+
+        """
+        notify_socket_name = os.environ.get("NOTIFY_SOCKET")
+        if not notify_socket_name:
+            return
+        if notify_socket_name.startswith("@"):
+            notify_socket_name = "\0" + notify_socket_name[1:]
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+                notify_socket.sendto(state.encode("utf-8"), notify_socket_name)
+        except OSError:
+            logging.warning("Could not notify systemd of %s", state)
+
+    def set_up_capture_subsystem(self):
+        """
+        Import the image processing and camera modules, set up the spool index,
+        Dashboard Handler and Camera Handler, which searches for the cameras, and
+        start sending images. Runs in the background while CAN messages are read,
+        and reports ready at the end.
+
+        """
+        try:
+            # Imported here instead of at the top of the module, so that CAN messages
+            # are read while OpenCV, NumPy and DepthAI are loaded
+            from camera_handler import CameraHandler
+            from dashboard_handler import DashboardHandler
+            from spool_index import SpoolIndex
+            from storage_handler import StorageHandler
+            from encoding_profile import ENCODING_PROFILES
+            from duplicate_detector import DuplicateDetector
+            from device_monitor import DeviceMonitor
+            from capture_scheduler import CaptureScheduler
+            from dashboard_transport import HttpUploadTransport
+            self.record_startup_time("capture_modules_imported")
+            self.notify_systemd("STATUS=Setting up cameras")
+
+            # Shared index of captured images, recorded by Camera Handler and sent by
+            # Dashboard Handler
+            self.spool_index = SpoolIndex(os.path.join(self.LOCAL_IMAGES_SAVING_DIRECTORY,
+                                                       SpoolIndex.DATABASE_FILE_NAME),
+                                          self.LOCAL_IMAGES_SAVING_DIRECTORY)
+            dashboard_transport = HttpUploadTransport(self.upload_url,
+                                                      self.upload_token_file_name) \
+                if self.upload_url is not None else None
+            dashboard_handler = DashboardHandler(liftbot_id=self.liftbot_id,
+                                                 ssh_pass_file_name=self.ssh_pass_file_name,
+                                                 connection_port=self.connection_port,
+                                                 dashboard_host_name=self.dashboard_host_name,
+                                                 dashboard_host_ip=self.dashboard_host_ip,
+                                                 dashboard_top_saving_directory=
+                                                 self.dashboard_top_saving_directory,
+                                                 local_images_saving_directory=
+                                                 self.LOCAL_IMAGES_SAVING_DIRECTORY,
+                                                 dashboard_transport=dashboard_transport,
+                                                 spool_index=self.spool_index,
+                                                 full_resolution_upload_hours=
+                                                 self.full_resolution_upload_hours,
+                                                 bandwidth_limit=self.upload_bandwidth_limit)
+            storage_handler = StorageHandler(
+                encoding_profile=ENCODING_PROFILES[self.encoding_profile_name]
+                if self.encoding_profile_name is not None else None,
+                preview_profile=ENCODING_PROFILES[self.preview_profile_name]
+                if self.preview_profile_name is not None else None)
+            duplicate_detector = DuplicateDetector(**self.duplicate_detector_settings) \
+                if self.duplicate_detector_settings is not None else None
+            capture_scheduler = CaptureScheduler(**(self.capture_scheduler_settings or {}))
+            camera_handler = CameraHandler(liftbot_id=self.liftbot_id,
+                                           local_images_saving_directory=
+                                           self.LOCAL_IMAGES_SAVING_DIRECTORY,
+                                           rm_speed_threshold=self.rm_speed_threshold,
+                                           camera_position_mapping=self.camera_position_mapping,
+                                           storage_handler=storage_handler,
+                                           on_device_encoding=self.on_device_encoding,
+                                           motion_detector=self.motion_detector,
+                                           spool_index=self.spool_index,
+                                           duplicate_detector=duplicate_detector,
+                                           burst_size=self.burst_size,
+                                           burst_keep_count=self.burst_keep_count,
+                                           capture_scheduler=capture_scheduler)
+            camera_handler.add_capture_completed_callback(dashboard_handler.notify_folder_ready)
+            camera_handler.add_capture_completed_callback(self.record_first_capture)
+
+            REGISTRY.add_collector("storage", storage_handler.get_metrics)
+            REGISTRY.add_collector("upload", dashboard_handler.get_upload_progress)
+            REGISTRY.add_collector("spool", self.spool_index.get_state_counts)
+            REGISTRY.add_collector("capture", capture_scheduler.get_metrics)
+            if duplicate_detector is not None:
+                REGISTRY.add_collector("duplicates", duplicate_detector.get_metrics)
+
+            # Add and retire cameras as they are attached and detached from now on
+            if self.device_poll_interval is not None:
+                self.device_monitor = DeviceMonitor(camera_handler,
+                                                    poll_interval=self.device_poll_interval)
+                REGISTRY.add_collector("devices", self.device_monitor.get_metrics)
+                self.device_monitor.start()
+
+            # Send images to server in the background from now on
+            dashboard_handler.start()
+            self.dashboard_handler = dashboard_handler
+            self.camera_handler = camera_handler
+        except Exception:
+            logging.exception("Could not set up the capture subsystem. No images are captured")
+            self.notify_systemd("STATUS=Capture subsystem failed")
+            return
+
+        self.capture_ready_event.set()
+        self.record_startup_time("capture_ready")
+        self.notify_systemd(f"READY=1\nSTATUS=Capturing with "
+                            f"{len(camera_handler.kewazo_camera_object_list)} cameras")
+
+    def handle_can_message(self):
+        """
+        Take the freshest RM speed decoded by the RM speed listener, and tell
+        Camera Handler to execute its operation based on this speed.
+
+        CAN messages keep being read by the Notifier while Camera Handler is
+        busy capturing images, so RM speeds that went stale in the meantime
+        are skipped instead of being processed late.
+
+        Until the capture subsystem is ready, the RM speeds only go through the
+        motion detector. An RM start seen in the meantime is captured as soon as
+        the capture subsystem is ready.
+
+        A lost CAN network is only logged once when the RM speeds stop, and once
+        when they come back, as the lift can stay parked for hours. If the CAN bus
+        raised errors, it is set up again every time no RM speed arrived in time,
+        until it reads again.
+
+        """
+        was_can_down = False
+        try:
+            while True:
+                rm_speed_sample = self.rm_speed_listener.wait_for_latest(
+                    timeout=self.CAN_MESSAGE_TIMEOUT)
+                if rm_speed_sample is None:
+                    if not was_can_down:
+                        logging.critical("No RM speed received for %s seconds. CAN network down",
+                                         self.CAN_MESSAGE_TIMEOUT)
+                    if self.is_can_reconnect_needed():
+                        self.reconnect_can(is_first_attempt=not was_can_down)
+                    was_can_down = True
+                    continue
+                if was_can_down:
+                    logging.warning("RM speed received again. CAN network up")
+                    was_can_down = False
+                can_message_timestamp, rm_speed = rm_speed_sample
+                REGISTRY.observe_stage("can_frame", max(time.time() - can_message_timestamp, 0))
+
+                if not self.capture_ready_event.is_set():
+                    if self.motion_detector.update(rm_speed) and self.pending_trigger_time is None:
+                        self.pending_trigger_time = time.monotonic()
+                        logging.warning("RM started before the cameras were ready. "
+                                        "Capturing once they are")
+                    continue
+
+                if self.pending_trigger_time is not None:
+                    logging.warning("Capturing RM start from %.1f s ago",
+                                    time.monotonic() - self.pending_trigger_time)
+                    self.pending_trigger_time = None
+                    REGISTRY.increment("triggers")
+                    self.camera_handler.process_images()
+                self.camera_handler.execute(rm_speed)
+        except KeyboardInterrupt:
+            logging.critical("Stop handling CAN message. KeyboardInterrupt")
+            return
+        except Exception:
+            logging.exception("Unknown Error while handling CAN Message")
+            return
+
+
+    def is_can_reconnect_needed(self):
+        """
+        Check whether the CAN bus must be set up again, as the Notifier may have
+        stopped reading after a bus error, or setting it up again failed.
+
+        Returns:
+            bool : True if there is no Notifier, or the CAN bus raised errors since it
+                was set up
+
+        """
+        return self.can_notifier is None or \
+            self.rm_speed_listener.get_metrics()["bus_errors"] > self.can_bus_error_count
+
+    def reconnect_can(self, is_first_attempt=True):
+        """
+        Stop the Notifier and shut the CAN bus down, then set the CAN bus up again and
+        read it with a new Notifier. On socketcan, setting it up brings the CAN
+        interface up again.
+
+        Args:
+            is_first_attempt (bool) : whether the CAN network was up until now. A failure
+                                    is only logged on the first attempt, as the CAN
+                                    network can stay down for hours
+
+        Returns:
+            bool : True if the CAN bus is read again
+
+        """
+        self.can_bus_error_count = self.rm_speed_listener.get_metrics()["bus_errors"]
+        if self.can_notifier is not None:
+            self.can_notifier.stop()
+            self.can_notifier = None
+        if self.can_handler is not None:
+            try:
+                self.can_handler.shutdown()
+            except Exception:
+                logging.exception("Error when shutting the CAN bus down")
+            self.can_handler = None
+
+        try:
+            self.can_handler = CanBusHandler.setup_can(
+                can_id_list_to_listen=self.can_id_list_to_listen, channel=self.can_channel,
+                interface=self.can_interface)
+        except Exception as error:
+            if is_first_attempt:
+                logging.critical("Could not set up CAN bus again: %s. Trying again", error)
+            return False
+        self.can_notifier = can.Notifier(self.can_handler, [self.rm_speed_listener])
+        REGISTRY.increment("can_reconnects")
+        logging.warning("CAN bus set up again after %s bus errors", self.can_bus_error_count)
+        return True
+
+    def start(self):
+        """
+        Start camera system execution. CAN messages are read first, then the capture
+        subsystem is set up in the background.
+        """
+        process_handling_can_messages = threading.Thread(target=self.handle_can_message)
+
+        # Read CAN messages in the background from now on
+        self.can_notifier = can.Notifier(self.can_handler, [self.rm_speed_listener])
+        self.record_startup_time("can_ready")
+
+        try:
+            self.runtime_profiler.install_signal_handler()
+            if self.is_profiling_enabled:
+                self.runtime_profiler.start()
+            if self.metrics_server is not None:
+                self.metrics_server.start()
+            if self.metrics_file_writer is not None:
+                self.metrics_file_writer.start()
+
+            # The motion detector follows the RM from now on, and is handed over to
+            # Camera Handler once it is set up
+            self.motion_detector = RmMotionDetector(start_speed_threshold=self.rm_speed_threshold)
+            self.capture_startup_thread = threading.Thread(target=self.set_up_capture_subsystem,
+                                                           name="capture-startup", daemon=True)
+            self.capture_startup_thread.start()
+            process_handling_can_messages.start()
+
+            process_handling_can_messages.join()
+
+        except KeyboardInterrupt:
+            logging.critical("KeyboardInterrupt")
+            CanBusHandler.can_down()
+        except Exception:
+            logging.exception("Unknown Error. Read stack for details")
+            CanBusHandler.can_down()
+        finally:
+            if self.can_notifier is not None:
+                self.can_notifier.stop()
+            self.runtime_profiler.stop()
+            logging.warning("CAN frames: %s", self.rm_speed_listener.get_metrics())
+            logging.warning("Startup times: %s", self.get_startup_times())
+            if self.capture_startup_thread is not None:
+                self.capture_startup_thread.join()
+            if self.device_monitor is not None:
+                self.device_monitor.close()
+            if self.camera_handler is not None:
+                if self.camera_handler.duplicate_detector is not None:
+                    logging.warning("Near-duplicate images: %s",
+                                    self.camera_handler.duplicate_detector.get_metrics())
+                self.camera_handler.close()
+            if self.dashboard_handler is not None:
+                self.dashboard_handler.close()
+            if self.metrics_file_writer is not None:
+                self.metrics_file_writer.close()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+            if self.spool_index is not None:
+                self.spool_index.close()
+
+if __name__ == "__main__":
+    LIFTBOT_ID = "LB1"
+    SSH_PASS_FILE = "ssh_pass"
+    CONNECTION_PORT = "18538"
+    DASHBOARD_HOST_NAME = "khang"
+    DASHBOARD_HOST_IP = "7.tcp.eu.ngrok.io"
+    DASHBOARD_TOP_SAVING_DIRECTORY= "./images"
+    # Map the MX ID of every camera, e.g. {"18443010D116631200": "left"}, to keep its
+    # position when it is attached again. Enumeration order is used for the others
+    CAMERA_POSITION_MAPPING = {0: "left", 1: "right"}
+    RM_SPEED_THRESHOLD = 60 # Speed threshold is absolute value +- 60
+    CAN_ID_LIST_TO_LISTEN = [0x3A0] # Add more if needed
+    ON_DEVICE_ENCODING = False # Encode stills to JPEG on the cameras instead of the host
+    ENCODING_PROFILE_NAME = "original" # See ENCODING_PROFILES in encoding_profile.py
+    PREVIEW_PROFILE_NAME = None # e.g. "preview" to send low resolution copies first
+    FULL_RESOLUTION_UPLOAD_HOURS = None # e.g. (22, 6) to send full images off-peak only
+    # Mark images that differ from one of the last 4 images of the camera in at most
+    # 6 of 64 bits of their perceptual hash with "_duplicate" in their name. Once the
+    # threshold is tuned on site, "action": "skip" does not save them at all
+    DUPLICATE_DETECTOR_SETTINGS = {"hash_method": "dhash", "hamming_threshold": 6,
+                                   "cache_size": 4, "action": "mark"}
+    METRICS_PORT = 9108 # curl localhost:9108/metrics. None to not serve metrics
+    METRICS_FILE = None # e.g. "./log/metrics.prom" to dump metrics every 15 seconds
+    PROFILING_ENABLED = False # Or toggle with: kill -USR2 <pid>. Reports in ./log
+    DEVICE_POLL_INTERVAL = 1.0 # Seconds between checks for cameras attached and detached
+    BURST_SIZE = 1 # e.g. 3 to take 3 stills per capture and save the sharpest
+    BURST_KEEP_COUNT = 1 # Sharpest stills of a burst to save, 1 or 2
+    # Capture with up to 2 cameras per USB hub at once, and give up on a camera that
+    # takes longer than 10 seconds
+    CAPTURE_SCHEDULER_SETTINGS = {"worker_count": 4, "hub_bandwidth": 2,
+                                  "stagger_interval": 0.0, "camera_timeout": 10.0}
+    UPLOAD_URL = None # e.g. "https://dashboard.example.com:8808" to send over HTTPS
+    UPLOAD_TOKEN_FILE = "upload_token" # Bearer token for the upload server
+    UPLOAD_BANDWIDTH_LIMIT = None # Bytes per second, e.g. 500000 to leave room on LTE
+
+    logging.basicConfig(filename='./log/debug.log', format='%(asctime)s %(message)s', filemode='a', level=logging.WARNING)
+
+    central_handler = CentralHandler(liftbot_id=LIFTBOT_ID,
+                                     ssh_pass_file_name=SSH_PASS_FILE,
+                                     connection_port=CONNECTION_PORT,
+                                     dashboard_host_name=DASHBOARD_HOST_NAME,
+                                     dashboard_host_ip=DASHBOARD_HOST_IP,
+                                     dashboard_top_saving_directory=
+                                     DASHBOARD_TOP_SAVING_DIRECTORY,
+                                     rm_speed_threshold=RM_SPEED_THRESHOLD,
+                                     camera_position_mapping=CAMERA_POSITION_MAPPING,
+                                     can_id_list_to_listen=CAN_ID_LIST_TO_LISTEN,
+                                     on_device_encoding=ON_DEVICE_ENCODING,
+                                     encoding_profile_name=ENCODING_PROFILE_NAME,
+                                     preview_profile_name=PREVIEW_PROFILE_NAME,
+                                     full_resolution_upload_hours=
+                                     FULL_RESOLUTION_UPLOAD_HOURS,
+                                     duplicate_detector_settings=DUPLICATE_DETECTOR_SETTINGS,
+                                     metrics_port=METRICS_PORT,
+                                     metrics_file_name=METRICS_FILE,
+                                     is_profiling_enabled=PROFILING_ENABLED,
+                                     device_poll_interval=DEVICE_POLL_INTERVAL,
+                                     burst_size=BURST_SIZE,
+                                     burst_keep_count=BURST_KEEP_COUNT,
+                                     capture_scheduler_settings=CAPTURE_SCHEDULER_SETTINGS,
+                                     upload_url=UPLOAD_URL,
+                                     upload_token_file_name=UPLOAD_TOKEN_FILE,
+                                     upload_bandwidth_limit=UPLOAD_BANDWIDTH_LIMIT)
+    central_handler.start()
@@ -8,6 +8,31 @@ be send to. The images stored locally on host device will then be deleted. If
 the check shows that server is not reachable, the captured images will remain
 stored locally on host device.
 
+Folders are created and sent through a DashboardTransport, which keeps one
+authenticated connection to the server alive and reuses it, instead of
+starting a new sshpass and ssh for every folder. Instead of SSH, images can be
+sent over HTTP(S) in resumable chunks with an HttpUploadTransport, which needs
+no SSH account or password file on the server.
+
+Uploads are event driven. CameraHandler reports every timestamp folder whose
+images are all written, and the folder is queued as a live upload job in an
+UploadScheduler, whose long-lived worker threads sleep while nothing is queued.
+A sweep runs at a low frequency to queue the folders left over from previous
+Liftbot runs or from failed uploads as backlog jobs. Live jobs go first, and the
+number of concurrent transfers adapts to the link, see upload_scheduler.
+
+Which images are still to be sent is taken from the spool index, see
+spool_index, not from scanning the saving directories. Each transfer sends a
+batch of folders. Only the images the transport confirms to be on the server
+are erased from the host device, and every step is recorded in the spool index
+first, so that uploads resume exactly where they stopped after a power loss.
+The saving directories are only scanned once at startup, to index images the
+spool index does not know about and to remove empty folders.
+
+If the cameras write low resolution preview copies of the images, sending the
+full resolution images can be deferred to off-peak hours. Preview copies are
+always sent right away.
+
 The structure of folders to save images on the server is as follows:
 .
 |
@@ -32,33 +57,45 @@ Typical usage example:
                                         dashboard_host_name, dashboard_host_ip,
                                         dashboard_top_saving_directory,
                                         local_images_saving_directory)
-    dashboard_handler.execute()
+    dashboard_handler.start()
+    dashboard_handler.notify_folder_ready(timestamp_folder_directory)
+    dashboard_handler.get_upload_progress()
+    dashboard_handler.close()
 
 """
 
 import os
-import datetime
 import time
+import contextlib
+import datetime
+import threading
 import shutil
 import logging
-from multiprocessing import Process, Pool
+from dashboard_transport import SshTransport
+from upload_scheduler import UploadScheduler, UploadJob
+from spool_index import SpoolIndex
+from metrics import REGISTRY
 
 class DashboardHandler:
     """
-    A class that handles sending image folders to dashboard using
-    rsync and process-based parallelism. 
+    A class that handles sending image folders to dashboard through an upload
+    scheduler, which sends the queued folders in batches.
 
-    If the image folders are sent successfully to the server, DashboardHandler will
-    erase the copy of the corresponding folder on the host device. That is, after
-    it send /230717 on the host device to the server, it will erase the /230717 
-    folder on the host device.
+    If the images are sent successfully to the server, DashboardHandler will
+    erase the copy of the corresponding images on the host device. That is, after
+    it send /230717/130450 on the host device to the server, it will erase the
+    /230717/130450 folder on the host device.
 
     """
-    SEND_TO_DASHBOARD_COMMAND = "rsync -ar --timeout=7 -q -P --append -e 'sshpass -f {ssh_pass_file_name} ssh -q -p {connection_port} -o StrictHostKeyChecking=no' {local_image_folder_directory} {dashboard_host_name}@{dashboard_host_ip}:{dashboard_directory_to_send}"
-    CREATE_NEW_FOLDER_ON_DASHBOARD_COMMAND = "sshpass -f {ssh_pass_file_name} ssh {dashboard_host_name}@{dashboard_host_ip} -p {connection_port} -o StrictHostKeyChecking=no 'mkdir -p {dashboard_folder_directory}'"
+    SWEEP_INTERVAL = 60 # Seconds between scans for folders that were not sent yet
+    FOLDER_SETTLE_TIME = 30 # Seconds a folder must be unchanged before a scan indexes it
+    DELETED_IMAGE_RETENTION_TIME = 7 * 24 * 3600 # Seconds deleted images stay in the index
 
     def __init__(self, liftbot_id, ssh_pass_file_name, connection_port, dashboard_host_name, dashboard_host_ip,
-                 dashboard_top_saving_directory, local_images_saving_directory):
+                 dashboard_top_saving_directory, local_images_saving_directory,
+                 dashboard_transport=None, sweep_interval=SWEEP_INTERVAL,
+                 max_concurrency=UploadScheduler.DEFAULT_MAX_CONCURRENCY, bandwidth_limit=None,
+                 spool_index=None, full_resolution_upload_hours=None):
         """
         Initialize the DashboardHandler with the appropriate information to connect to the server.
 
@@ -75,6 +112,21 @@ class DashboardHandler:
                                                         images of all liftbots on the server
             local_images_saving_directory : the top folder that contains all the
                                             images on the host device
+            dashboard_transport (DashboardTransport) : the connection to the server. Defaults
+                                                    to an SshTransport built from the
+                                                    connection details above
+            sweep_interval (float) : the time between scans for folders that were not
+                                    sent yet, in seconds
+            max_concurrency (int) : the highest number of concurrent backlog transfers
+            bandwidth_limit (float) : the highest total upload bandwidth in bytes per
+                                    second. None for no cap
+            spool_index (SpoolIndex) : the index of the images on the host device, shared
+                                    with CameraHandler. Defaults to a SpoolIndex in the
+                                    top folder for saving images
+            full_resolution_upload_hours (tuple) : the local hours (start, end) between which
+                                                full resolution images are sent, e.g.
+                                                (22, 6) for 22:00 to 6:00. None to send
+                                                them at any time
 
         """
 
@@ -85,7 +137,26 @@ class DashboardHandler:
         self.dashboard_host_ip = dashboard_host_ip
         self.dashboard_lb_saving_directory = os.path.join(dashboard_top_saving_directory, liftbot_id)
         self.local_images_saving_directory = local_images_saving_directory
-
+        if dashboard_transport is None:
+            dashboard_transport = SshTransport(ssh_pass_file_name, connection_port,
+                                               dashboard_host_name, dashboard_host_ip)
+        self.dashboard_transport = dashboard_transport
+        self.is_spool_index_owned = spool_index is None # Close it only if created here
+        if spool_index is None:
+            spool_index = SpoolIndex(os.path.join(local_images_saving_directory,
+                                                  SpoolIndex.DATABASE_FILE_NAME),
+                                     local_images_saving_directory)
+        self.spool_index = spool_index
+        self.sweep_interval = sweep_interval
+        self.full_resolution_upload_hours = full_resolution_upload_hours
+        self.upload_scheduler = UploadScheduler(
+            self.send_timestamp_folders, self.dashboard_transport.measure_round_trip_time,
+            max_concurrency, bandwidth_limit)
+
+        self.created_dashboard_directory_set = set()
+        self.upload_state_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sweeper = None
 
     def get_all_subfolders(self, local_folder_directory):
         """
@@ -106,170 +177,286 @@ class DashboardHandler:
                 subfolders_list.append(entry.name)
         return subfolders_list
 
-    def send_single_folder_to_dashboard(self, date_specific_folder):
+    def notify_folder_ready(self, timestamp_folder_directory):
         """
-        Send a single date folder to the server. It also updates whether the server
-        is reachable. 
-
-        If the image folders are sent successfully to the server, DashboardHandler will
-        erase the copy of the corresponding folder on the host device. That is, after
-        it send /230717 on the host device to the server, it will erase the /230717 
-        folder on the host device.
+        Queue a timestamp folder of the current run whose images are all written
+        as a live upload job, and record its images as queued in the spool index.
 
         Args:
-            date_specific_folder (string) : the name of the folder to send. The folder
-                                        must be immediately below the top level folder
-                                        for saving images (Ex: /images) on the host device
+            timestamp_folder_directory (string) : the timestamp folder on the host device
+
         """
+        self.spool_index.record_folder(timestamp_folder_directory, SpoolIndex.STATE_QUEUED)
+        self.upload_scheduler.submit(timestamp_folder_directory, UploadJob.PRIORITY_LIVE)
 
+    def make_dashboard_directory(self, dashboard_folder_directory):
+        """
+        Create a folder on the server, unless it was already created by this
+        DashboardHandler.
 
-        current_date = datetime.date.today().strftime("%y%m%d")
-        date_specific_folder_local_directory = os.path.join(
-            self.local_images_saving_directory, date_specific_folder)
-        timestamp_folders_to_send = self.get_all_subfolders(date_specific_folder_local_directory)
-
-        # Erase the date folder if it is empty, but only if the date is
-        # different from today. That is, the date folder is of the past.
-        # For example, if today is 22 Dec 2023, the folder 231222 won't
-        # get deleted evenif it's empty, but the folder 231221 will.
-        #
-        # This usually happens if all timestamp folders were sent successfully
-        # to the server on the previous Liftbot run (as all timestamp
-        # folders would then be deleted, leaving an empty date folder)
-
-        if len(timestamp_folders_to_send) == 0 and current_date != date_specific_folder:
-            shutil.rmtree(date_specific_folder_local_directory)
-            logging.info("Removed folder ", date_specific_folder_local_directory,
-                          " from local host. Folder from previous date")
-
-        else:
-            dashboard_date_folder_directory = os.path.join(
-                self.dashboard_lb_saving_directory, date_specific_folder)
-            try:
-                # Create a new folder on the server with the same name as the date folder if it
-                # doesn't exist
-                os.system(self.CREATE_NEW_FOLDER_ON_DASHBOARD_COMMAND.format(
-                    ssh_pass_file_name=self.ssh_pass_file_name,
-                    dashboard_host_name=self.dashboard_host_name,
-                    dashboard_host_ip=self.dashboard_host_ip,
-                    connection_port=self.connection_port,
-                    dashboard_folder_directory=dashboard_date_folder_directory))
-            except FileExistsError:
-                logging.warning("Folder ", dashboard_date_folder_directory, " already exist on server")
-            except TimeoutError:
-                logging.warning("Server connection lost when creating folder ",
-                                dashboard_date_folder_directory)
-            except Exception:
-                logging.exception("Unknown Error when creating new date folder on server")
-            # Send all timestamp folders under the date folder to the server
-            for timestamp_folder in timestamp_folders_to_send:
-                subfolder_local_directory = os.path.join(
-                    date_specific_folder_local_directory, timestamp_folder)
-                if len(os.listdir(subfolder_local_directory)) < 2:
-                    continue
+        Returns:
+            bool : True if the folder exists on the server
+
+        """
+        with self.upload_state_lock:
+            if dashboard_folder_directory in self.created_dashboard_directory_set:
+                return True
+        if not self.dashboard_transport.make_directory(dashboard_folder_directory):
+            logging.warning("Could not create folder %s on server", dashboard_folder_directory)
+            return False
+        with self.upload_state_lock:
+            self.created_dashboard_directory_set.add(dashboard_folder_directory)
+        return True
+
+    def send_timestamp_folders(self, upload_job_list, bandwidth_limit=None):
+        """
+        Send the images of the timestamp folders of a batch of upload jobs that the
+        spool index has as still to be sent to the server in one transfer, and erase
+        every image the transport confirms to be on the server from the host device.
+        A timestamp folder is erased once all its images are erased. Images that could
+        not be sent stay on the host device and are queued again by the next sweep.
+
+        Args:
+            upload_job_list (list) : the UploadJob of every timestamp folder to send.
+                                    Their progress is updated as images are sent
+            bandwidth_limit (float) : the highest bandwidth of the transfer in bytes per
+                                    second. None for no limit
+
+        Returns:
+            int : the number of bytes sent and erased
+
+        """
+        relative_file_list = []
+        file_size_dictionary = {}
+        file_written_time_dictionary = {}
+        upload_job_dictionary = {} # The upload job of every relative file
+        missing_file_list = []
+        for upload_job in upload_job_list:
+            for relative_file, file_size in self.spool_index.get_pending_images(
+                    upload_job.timestamp_folder_directory, self.get_uploadable_kinds()):
                 try:
-                    os.system(self.SEND_TO_DASHBOARD_COMMAND.format(
-                        ssh_pass_file_name=self.ssh_pass_file_name,
-                        connection_port=self.connection_port,
-                        local_image_folder_directory=subfolder_local_directory,
-                        dashboard_host_name=self.dashboard_host_name,
-                        dashboard_host_ip=self.dashboard_host_ip,
-                        dashboard_directory_to_send=dashboard_date_folder_directory))
-                    
-                    time.sleep(1)
-                    
-                    # Remove the timestamp folder on the host device if it was successfully
-                    # sent to the server
-                    shutil.rmtree(subfolder_local_directory)
-                    logging.info("Folder ", subfolder_local_directory,
-                                 " sent to server and removed from local host")
-                except TimeoutError:
-                    logging.warning("Server connection lost when sending image folder ",
-                                    subfolder_local_directory)
-                    continue
-                except Exception:
-                    logging.exception("Unknown Error when sending images to server. Check network connection")
+                    file_written_time_dictionary[relative_file] = os.path.getmtime(
+                        os.path.join(self.local_images_saving_directory, relative_file))
+                except FileNotFoundError:
+                    missing_file_list.append(relative_file)
                     continue
+                relative_file_list.append(relative_file)
+                file_size_dictionary[relative_file] = file_size
+                upload_job_dictionary[relative_file] = upload_job
+                upload_job.bytes_total += file_size
+        if missing_file_list:
+            # Never retry images erased from the host device by other means
+            logging.warning("%s images in the spool index no longer exist: %s",
+                            len(missing_file_list), missing_file_list)
+            self.spool_index.set_state(missing_file_list, SpoolIndex.STATE_DELETED)
+        if not relative_file_list:
+            # Timestamp folders whose images were all skipped as near-duplicates are empty
+            self.remove_empty_folders(upload_job_list)
+            return 0
+
+        # Create the Liftbot-specific folder (Example: /images/LB1) on the server if it
+        # doesn't exist. The date and timestamp folders below it are created by the transfer
+        if not self.make_dashboard_directory(self.dashboard_lb_saving_directory):
+            return 0
+
+        def update_progress(relative_file, byte_count):
+            upload_job_dictionary[relative_file].bytes_sent += byte_count
+
+        with REGISTRY.time_stage("upload"):
+            confirmed_file_list = self.dashboard_transport.send_files(
+                self.local_images_saving_directory, relative_file_list,
+                self.dashboard_lb_saving_directory, bandwidth_limit, update_progress)
+        confirmed_time = time.time()
+        confirmed_byte_count = sum(file_size_dictionary[relative_file]
+                                   for relative_file in confirmed_file_list)
+        for relative_file in confirmed_file_list:
+            REGISTRY.observe_stage("written_to_uploaded", max(
+                confirmed_time - file_written_time_dictionary[relative_file], 0))
+        REGISTRY.increment("images_uploaded", len(confirmed_file_list))
+        REGISTRY.increment("bytes_uploaded", confirmed_byte_count)
+        if len(confirmed_file_list) < len(relative_file_list):
+            REGISTRY.increment("image_upload_failures",
+                               len(relative_file_list) - len(confirmed_file_list))
+            logging.warning("Could not send %s of %s images to server",
+                            len(relative_file_list) - len(confirmed_file_list),
+                            len(relative_file_list))
+
+        # Remove only the images on the host device that were confirmed to be on
+        # the server, and the timestamp folders that are empty afterwards
+        self.spool_index.set_state(confirmed_file_list, SpoolIndex.STATE_UPLOADED)
+        with REGISTRY.time_stage("delete"):
+            self.delete_uploaded_images(confirmed_file_list)
+        self.remove_empty_folders(upload_job_list)
+        return confirmed_byte_count
+
+    @staticmethod
+    def remove_empty_folders(upload_job_list):
+        """
+        Remove the timestamp folders of a batch of upload jobs that have no images left.
 
-    def send_multiple_folders_to_dashboard(self, local_image_folder_list):
         """
-        Use process-based parallelism to send image folders to the server.
+        for upload_job in upload_job_list:
+            try:
+                os.rmdir(upload_job.timestamp_folder_directory)
+            except OSError:
+                continue
+            logging.info("Folder %s sent to server and removed from local host",
+                         upload_job.timestamp_folder_directory)
+
+    def delete_uploaded_images(self, relative_file_list):
+        """
+        Erase images confirmed to be on the server from the host device, and record
+        them as deleted in the spool index.
 
         Args:
-            local_image_folder_directories_list (list) : a list that contains the 
-                                                    directory of all image folders to send.
-                                                    All of the folders must be immediately
-                                                    below the top level folder for saving images
-                                                    (Ex: /images) on the host device
+            relative_file_list (list) : the image paths relative to the top folder for
+                                        saving images
+
+        """
+        for relative_file in relative_file_list:
+            try:
+                os.remove(os.path.join(self.local_images_saving_directory, relative_file))
+            except FileNotFoundError:
+                pass
+        self.spool_index.set_state(relative_file_list, SpoolIndex.STATE_DELETED)
 
+    def is_folder_settled(self, timestamp_folder_directory):
         """
-        with Pool() as p:
-            p.map(self.send_single_folder_to_dashboard, local_image_folder_list)
+        Check whether a timestamp folder is no longer being written. Hidden files
+        are images that the storage handler has not finished writing.
 
-    def execute(self):
         """
-        Perform checks to check whether the host device contains any image folders not
-        sent to the server in the previous Liftbot run (perhaps due to bad server connection)
+        try:
+            if any(image_file_name.startswith(".")
+                   for image_file_name in os.listdir(timestamp_folder_directory)):
+                return False
+            return time.time() - os.path.getmtime(timestamp_folder_directory) \
+                >= self.FOLDER_SETTLE_TIME
+        except FileNotFoundError:
+            return False
+
+    def recover_spool(self):
+        """
+        Bring the spool index and the saving directories in line at startup.
 
-        If there are folders that were not send to the server, the function will send these
-        folders, along with the new image folders that the cameras have just captured in 
-        the curent run, to the server. This is done via process-based parallelism
+        Images that were confirmed on the server but not erased before the last Liftbot
+        run stopped are erased. Images in settled timestamp folders that are not in
+        the spool index, e.g. from before the spool index existed, are recorded as
+        captured. Empty timestamp folders are erased, and so are empty date folders,
+        but only if the date is different from today. That is, the date folder is of
+        the past. For example, if today is 22 Dec 2023, the folder 231222 won't get
+        deleted evenif it's empty, but the folder 231221 will.
 
         """
+        self.delete_uploaded_images(self.spool_index.get_images_in_state(
+            SpoolIndex.STATE_UPLOADED))
 
-        # Create a Liftbot-specific folder (Example: /images/LB1) on the server if it
-        # doesn't exist 
+        current_date = datetime.date.today().strftime("%y%m%d")
+        for date_specific_folder in sorted(self.get_all_subfolders(
+                self.local_images_saving_directory)):
+            date_specific_folder_local_directory = os.path.join(
+                self.local_images_saving_directory, date_specific_folder)
+            for timestamp_folder in sorted(self.get_all_subfolders(
+                    date_specific_folder_local_directory)):
+                timestamp_folder_directory = os.path.join(
+                    date_specific_folder_local_directory, timestamp_folder)
+                if not self.is_folder_settled(timestamp_folder_directory):
+                    continue
+                recorded_count = self.spool_index.record_folder(timestamp_folder_directory)
+                if recorded_count > 0:
+                    logging.warning("Indexed %s images of %s not in the spool index",
+                                    recorded_count, timestamp_folder_directory)
+                with contextlib.suppress(OSError):
+                    os.rmdir(timestamp_folder_directory)
+
+            if len(self.get_all_subfolders(date_specific_folder_local_directory)) == 0 \
+                    and current_date != date_specific_folder:
+                shutil.rmtree(date_specific_folder_local_directory)
+                logging.info("Removed folder %s from local host. Folder from previous date",
+                             date_specific_folder_local_directory)
+
+    def get_uploadable_kinds(self):
+        """
+        Get the kinds of images that may be sent now. Preview copies may always be
+        sent, full resolution images only within the full resolution upload hours.
+
+        Returns:
+            tuple : the kinds of images, see SpoolIndex
+
+        """
+        if self.full_resolution_upload_hours is None:
+            return SpoolIndex.ALL_KINDS
+        start_hour, end_hour = self.full_resolution_upload_hours
+        current_hour = datetime.datetime.now().hour
+        if start_hour <= end_hour:
+            is_upload_hour = start_hour <= current_hour < end_hour
+        else: # The hours span midnight
+            is_upload_hour = current_hour >= start_hour or current_hour < end_hour
+        return SpoolIndex.ALL_KINDS if is_upload_hour else (SpoolIndex.KIND_PREVIEW,)
+
+    def sweep_backlog(self):
+        """
+        Queue all timestamp folders that the spool index has images still to be sent
+        of, oldest capture first. These are left over from a previous Liftbot run
+        (perhaps due to bad server connection), from uploads that failed in this run,
+        or full resolution images deferred to the full resolution upload hours.
+        Forget images deleted long ago.
+
+        """
+        for timestamp_folder_directory in self.spool_index.get_pending_folders(
+                self.get_uploadable_kinds()):
+            self.upload_scheduler.submit(timestamp_folder_directory, UploadJob.PRIORITY_BACKLOG)
+        self.spool_index.prune(self.DELETED_IMAGE_RETENTION_TIME)
+
+    def process_backlog(self):
+        """
+        Sweep loop. Recover the spool index and sweep once right away, then sweep
+        every sweep interval, until the DashboardHandler is closed.
+
+        """
         try:
-            os.system(self.CREATE_NEW_FOLDER_ON_DASHBOARD_COMMAND.format(
-                ssh_pass_file_name=self.ssh_pass_file_name,
-                dashboard_host_name=self.dashboard_host_name,
-                dashboard_host_ip=self.dashboard_host_ip,
-                connection_port=self.connection_port,
-                dashboard_folder_directory=self.dashboard_lb_saving_directory))
-        except TimeoutError:
-            logging.critical("Server connection lost when creating new folder ", 
-                            self.dashboard_lb_saving_directory)
+            self.recover_spool()
         except Exception:
-            logging.critical("Folder ",
-                            self.dashboard_lb_saving_directory," already exist on server")
-
-        date_specific_directories_list = self.get_all_subfolders(self.local_images_saving_directory)
-
-        # Check if there exists a date folder on host device
-        if len(date_specific_directories_list) > 0:
-
-            # The new image folders that the cameras have just captured in
-            # the curent run will be at the end of the list
-            latest_date_specific_folder = date_specific_directories_list[-1]
-
-            # Get folders that were not send to the server in the previous run, if any
-            unsend_image_folders_list = date_specific_directories_list[:-1]
-
-            # Send newest image folder to server
-            process_send_live_images = Process(target=self.send_single_folder_to_dashboard, args=
-                                               (latest_date_specific_folder,))
-            process_send_live_images.start()
-
-            # Check whether there are folders that were not send to the server in the previous run
-            #
-            # NOTE: As the check is performed on the date folder, there are 2 scenarios:
-            #
-            # 1. Date folder from the previous run exists, and it contain images that
-            # were not sent to the server. In this case, these folders will be send to the server
-            # 2. Date folder from the previous run exists, but it is empty. This usually happens if
-            # all timestamp folders were sent successfully to the server on the previous Liftbot
-            # run (as all timestamp folders would then be deleted, leaving an empty date folder). In
-            # this case, the folder will be deleted
-
-            if len(unsend_image_folders_list) > 0:
-                process_send_old_images = Process(target=self.send_multiple_folders_to_dashboard, args=
-                                                  (unsend_image_folders_list,))
-                process_send_old_images.start()
-
-            process_send_live_images.join()
-            if len(unsend_image_folders_list) > 0:
-                process_send_old_images.join()
-
-        # Do nothing if there is no date folder on host device
-        else:
-            pass
+            logging.exception("Unknown Error when recovering the spool index")
+        while True:
+            try:
+                self.sweep_backlog()
+            except Exception:
+                logging.exception("Unknown Error when scanning for images not sent to server")
+            if self.stop_event.wait(self.sweep_interval):
+                return
+
+    def get_upload_progress(self):
+        """
+        Get the progress of the queued uploads and uploads in progress.
+
+        Returns:
+            dict : see UploadScheduler.get_progress
+
+        """
+        return self.upload_scheduler.get_progress()
+
+    def start(self):
+        """
+        Start the upload scheduler, and the sweep for folders that were not sent yet.
+
+        """
+        self.upload_scheduler.start()
+        self.sweeper = threading.Thread(target=self.process_backlog, name="dashboard-sweeper",
+                                        daemon=True)
+        self.sweeper.start()
+
+    def close(self):
+        """
+        Stop the sweep, let the upload scheduler finish the transfers in progress,
+        and close the connection to the server. Folders still queued are sent by the
+        sweep of the next Liftbot run.
+
+        """
+        self.stop_event.set()
+        if self.sweeper is not None:
+            self.sweeper.join()
+        self.upload_scheduler.close()
+        self.dashboard_transport.close()
+        if self.is_spool_index_owned:
+            self.spool_index.close()
@@ -0,0 +1,722 @@
+"""
+This module handles the connection that DashboardHandler uses to create folders
+on the server and send image folders to it.
+
+SshTransport keeps a single authenticated SSH connection to the server alive as
+an SSH ControlMaster, and runs every mkdir and rsync through it. Only the
+ControlMaster authenticates with sshpass, so creating a folder or sending files
+no longer costs a new SSH handshake over the tunnel. If the connection drops,
+it is reestablished on the next use, waiting longer after every failed attempt.
+
+Files are sent in batches, with one rsync per batch fed by a manifest of the
+files. The transport reports which files of the batch are confirmed to be on
+the server, so that only those are erased from the host device.
+
+LocalDirectoryTransport stands in for the server with a directory on the host
+device, so that the upload path can be run without a server. It can emulate a
+slow link with a given bandwidth and round trip time, to see how uploads behave
+on a weak cellular link.
+
+HttpUploadTransport sends files over HTTP(S) instead, without an SSH account or a
+password file. Files are sent in chunks, several at a time, over persistent
+connections, and every chunk and file is checked against its SHA-256 on the
+server. A file cut off by a dropped link resumes from the last byte the server
+has, instead of starting over. upload_receiver is a small server for it that
+can run locally.
+
+Typical usage example:
+
+    dashboard_transport = SshTransport(ssh_pass_file_name, connection_port,
+                                       dashboard_host_name, dashboard_host_ip)
+    dashboard_transport.make_directory(dashboard_folder_directory)
+    confirmed_file_list = dashboard_transport.send_files(local_top_directory, relative_file_list,
+                                                         dashboard_directory_to_send)
+    dashboard_transport.close()
+
+    dashboard_transport = HttpUploadTransport(upload_url, token_file_name)
+
+"""
+
+import os
+import time
+import shlex
+import shutil
+import hashlib
+import logging
+import posixpath
+import threading
+import subprocess
+import http.client
+import urllib.parse
+import concurrent.futures
+
+class DashboardTransport:
+    """
+    A class that defines how DashboardHandler talks to the server. Subclasses
+    implement the actual connection.
+    """
+
+    def make_directory(self, dashboard_folder_directory):
+        """
+        Create a folder on the server, including its parent folders, if it doesn't exist.
+
+        Args:
+            dashboard_folder_directory (string) : the folder to create on the server
+
+        Returns:
+            bool : True if the folder exists on the server afterwards
+
+        """
+        raise NotImplementedError
+
+    def send_files(self, local_top_directory, relative_file_list, dashboard_directory_to_send,
+                   bandwidth_limit=None, progress_callback=None):
+        """
+        Send a batch of files on the host device to the server, keeping their paths
+        relative to a top directory. For example, 230717/130450/left.jpg below the
+        top directory is sent to 230717/130450/left.jpg below the folder on the server.
+
+        Args:
+            local_top_directory (string) : the directory the file paths are relative to
+            relative_file_list (list) : the paths of the files to send, relative to the
+                                        top directory
+            dashboard_directory_to_send (string) : the folder on the server to send them into
+            bandwidth_limit (float) : the highest bandwidth of the transfer in bytes per
+                                    second. None for no limit
+            progress_callback (function) : called with a relative file path and a number
+                                        of bytes of that file just sent
+
+        Returns:
+            list : the relative paths of the files confirmed to be on the server
+
+        """
+        raise NotImplementedError
+
+    def measure_round_trip_time(self):
+        """
+        Measure the round trip time to the server.
+
+        Returns:
+            float : the round trip time in seconds, or None if it could not be measured
+
+        """
+        return None
+
+    def close(self):
+        """
+        Close the connection to the server.
+
+        """
+
+class SshTransport(DashboardTransport):
+    """
+    A class that sends folders to the server through a persistent SSH ControlMaster.
+    """
+    CONTROL_PATH = "/tmp/kewazo-dashboard-{dashboard_host_name}@{dashboard_host_ip}-{connection_port}"
+    START_CONTROL_MASTER_COMMAND = "sshpass -f {ssh_pass_file_name} ssh -M -N -f -p {connection_port} -o ControlPath={control_path} -o ControlPersist=yes -o ServerAliveInterval=15 -o ServerAliveCountMax=3 -o StrictHostKeyChecking=no {dashboard_host_name}@{dashboard_host_ip}"
+    CONTROL_MASTER_COMMAND = "ssh -O {control_command} -o ControlPath={control_path} -p {connection_port} {dashboard_host_name}@{dashboard_host_ip}"
+
+    # Clients only ever use the ControlMaster. BatchMode makes them fail at once
+    # instead of asking for a password if the ControlMaster is gone
+    SSH_CLIENT_COMMAND = "ssh -p {connection_port} -o ControlPath={control_path} -o ControlMaster=no -o BatchMode=yes -o StrictHostKeyChecking=no"
+    REMOTE_COMMAND_TIMEOUT = 15 # Seconds
+    CONNECT_TIMEOUT = 30 # Seconds
+    SEND_TIMEOUT = 600 # Seconds
+    # rsync exit codes after which the files it itemized are on the server, while
+    # others failed: partial transfer due to error, and files vanished before sending
+    RSYNC_PARTIAL_TRANSFER_CODES = (23, 24)
+    RECONNECT_BACKOFF_MIN = 1 # Seconds to wait after the first failed connection attempt
+    RECONNECT_BACKOFF_MAX = 60 # Longest wait between connection attempts
+
+    def __init__(self, ssh_pass_file_name, connection_port, dashboard_host_name,
+                 dashboard_host_ip):
+        """
+        Initialize the transport. The connection is only opened on first use.
+
+        Args:
+            ssh_pass_file_name (.txt) : a file that contains the ssh password to connect to
+                                        the server
+            connection_port (int) : a number to indicate which port on the server to
+                                        connect to
+            dashboard_host_name (string) : the server's host name
+            dashboard_host_ip (string) : the server's host ip
+
+        """
+        self.ssh_pass_file_name = ssh_pass_file_name
+        self.connection_port = connection_port
+        self.dashboard_host_name = dashboard_host_name
+        self.dashboard_host_ip = dashboard_host_ip
+        self.control_path = self.CONTROL_PATH.format(dashboard_host_name=dashboard_host_name,
+                                                     dashboard_host_ip=dashboard_host_ip,
+                                                     connection_port=connection_port)
+        self.reconnect_backoff = 0
+        self.next_connect_time = 0.0
+        self.connect_lock = threading.Lock() # Only one thread starts the ControlMaster
+
+    def run_command(self, command, timeout, input_text=None):
+        """
+        Run a command on the host device.
+
+        Args:
+            command (list) : the command and its arguments
+            timeout (float) : the maximum time the command may take, in seconds
+            input_text (string) : the text to pass to the command on stdin
+
+        Returns:
+            subprocess.CompletedProcess : the result of the command, or None if it
+                                        timed out or could not be started
+
+        """
+        try:
+            return subprocess.run(command, input=input_text, capture_output=True, text=True,
+                                  timeout=timeout, check=False)
+        except subprocess.TimeoutExpired:
+            logging.warning("Command timed out after %s seconds: %s", timeout, command[0])
+        except OSError as error:
+            logging.critical("Could not run %s: %s", command[0], error)
+        return None
+
+    def control_master(self, control_command):
+        """
+        Send a control command ('check' or 'exit') to the ControlMaster.
+
+        Returns:
+            bool : True if the ControlMaster accepted the command
+
+        """
+        result = self.run_command(shlex.split(self.CONTROL_MASTER_COMMAND.format(
+            control_command=control_command, control_path=self.control_path,
+            connection_port=self.connection_port, dashboard_host_name=self.dashboard_host_name,
+            dashboard_host_ip=self.dashboard_host_ip)), self.REMOTE_COMMAND_TIMEOUT)
+        return result is not None and result.returncode == 0
+
+    def ensure_connected(self):
+        """
+        Check that the ControlMaster is alive, and start it if it is not. After a
+        failed attempt, the next attempt first waits until the backoff time has passed.
+
+        Returns:
+            bool : True if the ControlMaster is alive
+
+        """
+        with self.connect_lock:
+            return self.connect()
+
+    def connect(self):
+        """
+        Start the ControlMaster unless it is alive. Must be called with the connect
+        lock held.
+
+        Returns:
+            bool : True if the ControlMaster is alive
+
+        """
+        if os.path.exists(self.control_path) and self.control_master("check"):
+            return True
+        backoff_remaining = self.next_connect_time - time.monotonic()
+        if backoff_remaining > 0:
+            time.sleep(backoff_remaining)
+
+        result = self.run_command(shlex.split(self.START_CONTROL_MASTER_COMMAND.format(
+            ssh_pass_file_name=self.ssh_pass_file_name, connection_port=self.connection_port,
+            control_path=self.control_path, dashboard_host_name=self.dashboard_host_name,
+            dashboard_host_ip=self.dashboard_host_ip)), self.CONNECT_TIMEOUT)
+        if result is not None and result.returncode == 0:
+            logging.info("Connected to server %s", self.dashboard_host_ip)
+            self.reconnect_backoff = 0
+            return True
+
+        self.reconnect_backoff = min(max(self.reconnect_backoff * 2, self.RECONNECT_BACKOFF_MIN),
+                                     self.RECONNECT_BACKOFF_MAX)
+        self.next_connect_time = time.monotonic() + self.reconnect_backoff
+        logging.warning("Could not connect to server %s. Retrying in %s seconds",
+                        self.dashboard_host_ip, self.reconnect_backoff)
+        return False
+
+    def get_ssh_client_command(self):
+        """
+        Get the ssh command that runs over the ControlMaster.
+
+        Returns:
+            string : the ssh command, without the destination
+
+        """
+        return self.SSH_CLIENT_COMMAND.format(connection_port=self.connection_port,
+                                              control_path=self.control_path)
+
+    def make_directory(self, dashboard_folder_directory):
+        if not self.ensure_connected():
+            return False
+        result = self.run_command(
+            shlex.split(self.get_ssh_client_command()) + [
+                f"{self.dashboard_host_name}@{self.dashboard_host_ip}",
+                f"mkdir -p {shlex.quote(dashboard_folder_directory)}"],
+            self.REMOTE_COMMAND_TIMEOUT)
+        return result is not None and result.returncode == 0
+
+    def send_files(self, local_top_directory, relative_file_list, dashboard_directory_to_send,
+                   bandwidth_limit=None, progress_callback=None):
+        if not relative_file_list:
+            return []
+        if not self.ensure_connected():
+            return []
+
+        # Every file rsync handles is itemized on stdout, also the ones that were
+        # already complete on the server. The manifest goes through stdin
+        rsync_command = ["rsync", "-a", "--itemize-changes", "--itemize-changes",
+                         "--timeout=7", "--partial", "--append-verify", "--from0",
+                         "--files-from=-"]
+        if bandwidth_limit is not None:
+            # rsync takes the limit in KiB per second
+            rsync_command.append(f"--bwlimit={max(int(bandwidth_limit / 1024), 1)}")
+        rsync_command += ["-e", self.get_ssh_client_command(), local_top_directory + os.sep,
+                          f"{self.dashboard_host_name}@{self.dashboard_host_ip}:"
+                          f"{dashboard_directory_to_send}"]
+        result = self.run_command(rsync_command, self.SEND_TIMEOUT,
+                                  input_text="\0".join(relative_file_list))
+        if result is None:
+            return []
+        if result.returncode == 0:
+            confirmed_file_list = list(relative_file_list)
+        else:
+            logging.warning("rsync of %s files failed with exit code %s: %s",
+                            len(relative_file_list), result.returncode, result.stderr.strip())
+            if result.returncode not in self.RSYNC_PARTIAL_TRANSFER_CODES:
+                return []
+            confirmed_file_list = self.parse_confirmed_files(result.stdout, result.stderr,
+                                                             relative_file_list)
+
+        # rsync reports no progress while it runs, so progress is reported per
+        # confirmed file once it is done
+        if progress_callback is not None:
+            for relative_file in confirmed_file_list:
+                progress_callback(relative_file, os.path.getsize(
+                    os.path.join(local_top_directory, relative_file)))
+        return confirmed_file_list
+
+    def measure_round_trip_time(self):
+        """
+        Measure the round trip time to the server as the time to run an empty
+        command on the server over the ControlMaster.
+
+        """
+        if not os.path.exists(self.control_path):
+            return None
+        start_time = time.monotonic()
+        result = self.run_command(
+            shlex.split(self.get_ssh_client_command()) + [
+                f"{self.dashboard_host_name}@{self.dashboard_host_ip}", "true"],
+            self.REMOTE_COMMAND_TIMEOUT)
+        if result is None or result.returncode != 0:
+            return None
+        return time.monotonic() - start_time
+
+    @staticmethod
+    def parse_confirmed_files(itemized_output, error_output, relative_file_list):
+        """
+        Find the files of a partially failed rsync that are on the server. These are
+        the regular files rsync itemized, without those named in its error messages.
+
+        Args:
+            itemized_output (string) : the itemized changes rsync printed on stdout
+            error_output (string) : the error messages rsync printed on stderr
+            relative_file_list (list) : the relative paths of the files rsync was given
+
+        Returns:
+            list : the relative paths of the files confirmed to be on the server
+
+        """
+        itemized_file_set = set()
+        for line in itemized_output.splitlines():
+            # Lines look like '<f+++++++++ 230717/130450/left.jpg', with an 11
+            # character change code whose second character is the file type
+            change_code, file_name = line[:11], line[12:]
+            if len(change_code) == 11 and change_code[1] == "f":
+                itemized_file_set.add(file_name)
+        return [relative_file for relative_file in relative_file_list
+                if relative_file in itemized_file_set and relative_file not in error_output]
+
+    def close(self):
+        if os.path.exists(self.control_path):
+            self.control_master("exit")
+
+class TokenBucket:
+    """
+    A class that paces a stream of bytes to a rate. Shared by concurrent transfers,
+    it emulates a link of that bandwidth, on which transfers queue behind each other.
+    """
+
+    def __init__(self, rate):
+        """
+        Args:
+            rate (float) : the rate in bytes per second
+
+        """
+        self.rate = rate
+        self.next_free_time = 0.0 # Time at which all bytes accepted so far have passed
+        self.bucket_lock = threading.Lock()
+
+    def consume(self, byte_count):
+        """
+        Block until a number of bytes may pass.
+
+        """
+        with self.bucket_lock:
+            current_time = time.monotonic()
+            self.next_free_time = max(self.next_free_time, current_time) + byte_count / self.rate
+            waiting_time = self.next_free_time - current_time
+        time.sleep(waiting_time)
+
+    def get_queueing_delay(self):
+        """
+        Get the time until all bytes accepted so far have passed, in seconds.
+
+        """
+        with self.bucket_lock:
+            return max(self.next_free_time - time.monotonic(), 0.0)
+
+class LocalDirectoryTransport(DashboardTransport):
+    """
+    A class that stands in for the server with a directory on the host device.
+    Folders on the server are created below the root directory.
+    """
+    CHUNK_SIZE = 64 * 1024 # Bytes copied at a time on an emulated link
+
+    def __init__(self, root_directory, link_bandwidth=None, link_round_trip_time=0.0):
+        """
+        Args:
+            root_directory (string) : the directory that stands in for the server's
+                                    home directory
+            link_bandwidth (float) : the bandwidth of the emulated link in bytes per
+                                    second, shared by all transfers. None for no limit
+            link_round_trip_time (float) : the round trip time of the emulated link in
+                                        seconds, paid once per file
+
+        """
+        self.root_directory = root_directory
+        self.link_round_trip_time = link_round_trip_time
+        self.link_token_bucket = TokenBucket(link_bandwidth) if link_bandwidth else None
+
+    def get_local_path(self, dashboard_folder_directory):
+        """
+        Get the directory that stands in for a folder on the server.
+
+        """
+        return os.path.join(self.root_directory, os.path.normpath(dashboard_folder_directory))
+
+    def make_directory(self, dashboard_folder_directory):
+        try:
+            os.makedirs(self.get_local_path(dashboard_folder_directory), exist_ok=True)
+        except OSError:
+            logging.exception("Could not create folder %s", dashboard_folder_directory)
+            return False
+        return True
+
+    def send_files(self, local_top_directory, relative_file_list, dashboard_directory_to_send,
+                   bandwidth_limit=None, progress_callback=None):
+        transfer_token_bucket = TokenBucket(bandwidth_limit) if bandwidth_limit else None
+        confirmed_file_list = []
+        for relative_file in relative_file_list:
+            destination_file = os.path.join(self.get_local_path(dashboard_directory_to_send),
+                                            relative_file)
+            temporary_file = destination_file + ".part"
+            try:
+                os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+                time.sleep(self.link_round_trip_time)
+                with open(os.path.join(local_top_directory, relative_file), "rb") as source, \
+                        open(temporary_file, "wb") as destination:
+                    while True:
+                        chunk = source.read(self.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if transfer_token_bucket is not None:
+                            transfer_token_bucket.consume(len(chunk))
+                        if self.link_token_bucket is not None:
+                            self.link_token_bucket.consume(len(chunk))
+                        destination.write(chunk)
+                        if progress_callback is not None:
+                            progress_callback(relative_file, len(chunk))
+                os.replace(temporary_file, destination_file)
+            except OSError:
+                logging.exception("Could not send file %s", relative_file)
+                continue
+            confirmed_file_list.append(relative_file)
+        return confirmed_file_list
+
+    def measure_round_trip_time(self):
+        """
+        Get the round trip time of the emulated link, including the time a message
+        would queue behind the bytes already on the link.
+
+        """
+        queueing_delay = self.link_token_bucket.get_queueing_delay() \
+            if self.link_token_bucket is not None else 0.0
+        return self.link_round_trip_time + queueing_delay
+
+class HttpUploadTransport(DashboardTransport):
+    """
+    A class that sends files to the server in chunks over HTTP(S), so that a transfer
+    cut by a dropped link resumes where it stopped instead of starting over.
+
+    Every thread keeps its own persistent connection to the server. A file is sent
+    as chunks written at their offset in a partial file on the server, several at a
+    time. Every chunk carries the SHA-256 of its content, and the server checks it
+    before writing. The server tells how many bytes of a file it has from its start,
+    so a file sent again only sends the rest. Once all chunks are on the server, it
+    checks the SHA-256 of the whole file and only then moves it in place. See
+    upload_receiver for a server that speaks this protocol.
+    """
+    DIRECTORIES_PATH = "/directories/" # PUT creates the folder
+    FILES_PATH = "/files/" # HEAD gets the offset, PATCH sends a chunk, POST completes the file
+    PING_PATH = "/ping"
+    OFFSET_HEADER = "Upload-Offset" # Bytes of the file the server has from its start
+    LENGTH_HEADER = "Upload-Length" # Size of the whole file
+    COMPLETE_HEADER = "Upload-Complete" # "1" if the whole file is on the server
+    HASH_HEADER = "Content-SHA256" # Hex SHA-256 of the chunk, or of the whole file
+    DEFAULT_CHUNK_SIZE = 1024 * 1024 # Bytes sent per request
+    DEFAULT_CHUNK_CONCURRENCY = 4 # Chunks sent at once over all files
+    MAX_CHUNK_ATTEMPTS = 3 # Attempts to send a chunk before the file is left for later
+    RETRY_BACKOFF = 1 # Seconds to wait after the first failed attempt, doubled every time
+    REQUEST_TIMEOUT = 30 # Seconds without progress before a request fails
+    HASH_BLOCK_SIZE = 1024 * 1024 # Bytes read at a time to hash a file
+
+    def __init__(self, upload_url, token_file_name=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 chunk_concurrency=DEFAULT_CHUNK_CONCURRENCY):
+        """
+        Initialize the transport. Connections are only opened on first use.
+
+        Args:
+            upload_url (string) : the URL of the upload server, e.g.
+                                https://dashboard.example.com:8808. A path is kept
+                                in front of every request, for a server behind a
+                                reverse proxy
+            token_file_name (string) : a file that contains the bearer token to send to
+                                    the server. None to send no token
+            chunk_size (int) : the number of bytes sent per request
+            chunk_concurrency (int) : the number of chunks sent at once
+
+        """
+        parsed_upload_url = urllib.parse.urlsplit(upload_url)
+        if parsed_upload_url.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported upload URL {upload_url}")
+        self.upload_url = upload_url
+        self.is_https = parsed_upload_url.scheme == "https"
+        self.server_address = parsed_upload_url.netloc
+        self.base_path = parsed_upload_url.path.rstrip("/")
+        self.authorization = None
+        if token_file_name is not None:
+            with open(token_file_name, encoding="utf-8") as token_file:
+                self.authorization = "Bearer " + token_file.read().strip()
+        self.chunk_size = chunk_size
+        self.chunk_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=chunk_concurrency, thread_name_prefix="http-upload-chunk")
+        self.thread_local = threading.local()
+        self.connection_list = [] # Connections of all threads, to close them
+        self.connection_list_lock = threading.Lock()
+        self.progress_lock = threading.Lock() # Chunks report progress from several threads
+
+    def get_connection(self):
+        """
+        Get the persistent connection of the current thread, creating it on first use.
+
+        Returns:
+            http.client.HTTPConnection : the connection
+
+        """
+        connection = getattr(self.thread_local, "connection", None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.is_https \
+                else http.client.HTTPConnection
+            connection = connection_class(self.server_address, timeout=self.REQUEST_TIMEOUT)
+            self.thread_local.connection = connection
+            with self.connection_list_lock:
+                self.connection_list.append(connection)
+        return connection
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request over the persistent connection of the current thread. A
+        connection the server closed while idle is opened again once.
+
+        Args:
+            method (string) : the HTTP method
+            path (string) : the path below the upload URL, not quoted
+            body (bytes) : the body of the request
+            headers (dict) : more headers of the request
+
+        Returns:
+            tuple : the status (int) and headers (http.client.HTTPMessage) of the
+                    response, or None if the server could not be reached
+
+        """
+        request_headers = dict(headers or {})
+        if self.authorization is not None:
+            request_headers["Authorization"] = self.authorization
+        for attempt in range(2):
+            connection = self.get_connection()
+            try:
+                connection.request(method, self.base_path + urllib.parse.quote(path),
+                                   body=body, headers=request_headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status, response.headers
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                if attempt == 1 or not isinstance(error, (http.client.RemoteDisconnected,
+                                                          ConnectionResetError,
+                                                          BrokenPipeError)):
+                    logging.warning("%s %s failed: %s", method, path, error)
+                    return None
+        return None
+
+    def make_directory(self, dashboard_folder_directory):
+        response = self.request("PUT", self.DIRECTORIES_PATH + dashboard_folder_directory)
+        return response is not None and response[0] in (200, 201, 204)
+
+    @classmethod
+    def hash_file(cls, file_name):
+        """
+        Compute the SHA-256 of a file.
+
+        Returns:
+            string : the hex digest
+
+        """
+        file_hash = hashlib.sha256()
+        with open(file_name, "rb") as hashed_file:
+            while True:
+                block = hashed_file.read(cls.HASH_BLOCK_SIZE)
+                if not block:
+                    return file_hash.hexdigest()
+                file_hash.update(block)
+
+    def report_progress(self, progress_callback, relative_file, byte_count):
+        """
+        Call the progress callback, one thread at a time.
+
+        """
+        if progress_callback is None or byte_count == 0:
+            return
+        with self.progress_lock:
+            progress_callback(relative_file, byte_count)
+
+    def send_chunk(self, local_file, remote_file, chunk_offset, chunk_length, file_size,
+                   token_bucket, relative_file, progress_callback):
+        """
+        Send one chunk of a file, trying again a few times if it fails.
+
+        Returns:
+            bool : True if the server wrote the chunk
+
+        """
+        try:
+            with open(local_file, "rb") as chunk_file:
+                chunk_file.seek(chunk_offset)
+                chunk = chunk_file.read(chunk_length)
+        except OSError:
+            logging.exception("Could not read %s", local_file)
+            return False
+        chunk_headers = {self.OFFSET_HEADER: str(chunk_offset),
+                         self.LENGTH_HEADER: str(file_size),
+                         self.HASH_HEADER: hashlib.sha256(chunk).hexdigest(),
+                         "Content-Type": "application/offset+octet-stream"}
+        for attempt in range(self.MAX_CHUNK_ATTEMPTS):
+            if token_bucket is not None:
+                token_bucket.consume(len(chunk))
+            response = self.request("PATCH", self.FILES_PATH + remote_file, body=chunk,
+                                    headers=chunk_headers)
+            if response is not None and response[0] == 204:
+                self.report_progress(progress_callback, relative_file, len(chunk))
+                return True
+            # A request the server refuses does not get better by sending it again
+            if response is not None and 400 <= response[0] < 500:
+                logging.warning("Server refused chunk at %s of %s with status %s",
+                                chunk_offset, relative_file, response[0])
+                return False
+            time.sleep(self.RETRY_BACKOFF * 2 ** attempt)
+        return False
+
+    def send_file(self, local_top_directory, relative_file, dashboard_directory_to_send,
+                  token_bucket, progress_callback):
+        """
+        Send the part of a file that is not on the server yet, and complete it.
+
+        Returns:
+            bool : True if the whole file is confirmed to be on the server
+
+        """
+        local_file = os.path.join(local_top_directory, relative_file)
+        remote_file = posixpath.join(dashboard_directory_to_send, relative_file)
+        try:
+            file_size = os.path.getsize(local_file)
+            file_hash = self.hash_file(local_file)
+        except OSError:
+            logging.exception("Could not read %s", local_file)
+            return False
+
+        response = self.request("HEAD", self.FILES_PATH + remote_file)
+        if response is None:
+            return False
+        status, response_headers = response
+        upload_offset = 0
+        if status == 200:
+            if response_headers.get(self.COMPLETE_HEADER) == "1" and \
+                    response_headers.get(self.HASH_HEADER) == file_hash:
+                self.report_progress(progress_callback, relative_file, file_size)
+                return True
+            upload_offset = int(response_headers.get(self.OFFSET_HEADER, 0))
+            if upload_offset > file_size or \
+                    response_headers.get(self.COMPLETE_HEADER) == "1":
+                upload_offset = 0
+        elif status != 404:
+            logging.warning("Server answered %s for %s", status, relative_file)
+            return False
+        if upload_offset > 0:
+            logging.info("Resuming %s at byte %s of %s", relative_file, upload_offset, file_size)
+            self.report_progress(progress_callback, relative_file, upload_offset)
+
+        chunk_future_list = [
+            self.chunk_executor.submit(self.send_chunk, local_file, remote_file, chunk_offset,
+                                       min(self.chunk_size, file_size - chunk_offset),
+                                       file_size, token_bucket, relative_file,
+                                       progress_callback)
+            for chunk_offset in range(upload_offset, file_size, self.chunk_size)]
+        if not all([chunk_future.result() for chunk_future in chunk_future_list]):
+            return False
+
+        response = self.request("POST", self.FILES_PATH + remote_file,
+                                headers={self.LENGTH_HEADER: str(file_size),
+                                         self.HASH_HEADER: file_hash})
+        if response is None:
+            return False
+        if response[0] == 409:
+            logging.warning("SHA-256 of %s on server does not match. Sending it again",
+                            relative_file)
+            return False
+        return response[0] in (200, 201, 204)
+
+    def send_files(self, local_top_directory, relative_file_list, dashboard_directory_to_send,
+                   bandwidth_limit=None, progress_callback=None):
+        transfer_token_bucket = TokenBucket(bandwidth_limit) if bandwidth_limit else None
+        return [relative_file for relative_file in relative_file_list
+                if self.send_file(local_top_directory, relative_file, dashboard_directory_to_send,
+                                  transfer_token_bucket, progress_callback)]
+
+    def measure_round_trip_time(self):
+        """
+        Measure the round trip time to the server as the time to answer a ping over
+        a persistent connection.
+
+        """
+        start_time = time.monotonic()
+        response = self.request("GET", self.PING_PATH)
+        if response is None or response[0] not in (200, 204):
+            return None
+        return time.monotonic() - start_time
+
+    def close(self):
+        self.chunk_executor.shutdown(wait=True)
+        with self.connection_list_lock:
+            for connection in self.connection_list:
+                connection.close()
+            self.connection_list.clear()
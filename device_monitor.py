@@ -0,0 +1,165 @@
+"""
+This module watches the USB bus for DepthAI cameras being attached and detached
+while the camera system runs, and adds or retires the matching Camera objects of
+a CameraHandler.
+
+Vibration on the platform can make a camera drop off the USB bus and enumerate
+again. Cameras are told apart by the MX ID of their DepthAI device, which stays
+the same across enumerations, so a camera that comes back gets its position on
+the TP back. The DeviceMonitor lists the connected devices at a fixed interval:
+
+- A device with a new MX ID that is not in use by another process is added as a
+  Camera, and captures images from the next capture on.
+- A device that was not listed for a few polls in a row is retired. A capture in
+  progress is finished first, then its device session is closed. A device that
+  only disappears for a moment, e.g. while it boots and enumerates again, is not
+  retired, and its device session reconnects on the next capture.
+- A device that enumerated again under a new USB path while its device session
+  is not open is reopened under the new path.
+
+Typical usage example:
+
+    device_monitor = DeviceMonitor(camera_handler)
+    device_monitor.start()
+    device_monitor.get_metrics()
+    device_monitor.close()
+
+"""
+
+import logging
+import threading
+import collections
+import depthai as dai
+from metrics import REGISTRY
+
+class DeviceMonitor:
+    """
+    A class that adds and retires the cameras of a CameraHandler as DepthAI devices
+    are attached and detached.
+    """
+    DEFAULT_POLL_INTERVAL = 1.0 # Seconds between two listings of the connected devices
+    DEFAULT_DETACH_POLL_COUNT = 3 # Polls a device must be missing in a row to be retired
+
+    def __init__(self, camera_handler, poll_interval=DEFAULT_POLL_INTERVAL,
+                 detach_poll_count=DEFAULT_DETACH_POLL_COUNT, device_lister=None):
+        """
+        Args:
+            camera_handler (CameraHandler) : the handler to add and retire cameras of
+            poll_interval (float) : the time between two listings of the connected
+                                    devices, in seconds
+            detach_poll_count (int) : the number of polls in a row a device must be
+                                    missing from the listing to be retired
+            device_lister (callable) : a callable that returns the DeviceInfo objects of
+                                    all connected devices. Defaults to
+                                    dai.Device.getAllConnectedDevices
+
+        """
+        self.camera_handler = camera_handler
+        self.poll_interval = poll_interval
+        self.detach_poll_count = detach_poll_count
+        self.device_lister = device_lister if device_lister is not None \
+            else dai.Device.getAllConnectedDevices
+        self.missing_poll_count = collections.Counter() # Polls in a row missing, per MX ID
+        self.event_count = collections.Counter()
+        self.stop_event = threading.Event()
+        self.monitor_thread = threading.Thread(target=self.process_polls,
+                                               name="device-monitor", daemon=True)
+
+    def poll(self):
+        """
+        List the connected devices once, and add and retire cameras accordingly.
+
+        """
+        connected_device_info_by_mx_id = {oak_device_info.getMxId(): oak_device_info
+                                          for oak_device_info in self.device_lister()}
+
+        for mx_id, oak_device_info in connected_device_info_by_mx_id.items():
+            self.missing_poll_count.pop(mx_id, None)
+            kewazo_camera_object = self.camera_handler.get_camera_by_mx_id(mx_id)
+            if kewazo_camera_object is None:
+                # A booted device that has no camera is used by another process
+                if oak_device_info.state == dai.XLinkDeviceState.X_LINK_BOOTED:
+                    continue
+                kewazo_camera_object = self.camera_handler.add_camera(oak_device_info)
+                if kewazo_camera_object is not None:
+                    self.record_event("attached", kewazo_camera_object.camera_name)
+                continue
+            self.update_device_info(kewazo_camera_object, oak_device_info)
+
+        for kewazo_camera_object in self.camera_handler.kewazo_camera_object_list:
+            if kewazo_camera_object.oak_device_info is None:
+                continue
+            mx_id = kewazo_camera_object.oak_device_info.getMxId()
+            if mx_id in connected_device_info_by_mx_id:
+                continue
+            self.missing_poll_count[mx_id] += 1
+            if self.missing_poll_count[mx_id] < self.detach_poll_count:
+                continue
+            del self.missing_poll_count[mx_id]
+            if self.camera_handler.retire_camera(mx_id) is not None:
+                self.record_event("detached", kewazo_camera_object.camera_name)
+
+    def update_device_info(self, kewazo_camera_object, oak_device_info):
+        """
+        Reopen a camera under the USB path its device enumerated again under, the
+        next time it captures. Devices with an open session are left alone, as a
+        booted device is listed under a different path than an unbooted one.
+
+        """
+        device_session = kewazo_camera_object.device_session
+        with device_session.session_lock:
+            if device_session.is_healthy() or \
+                    device_session.oak_device_info.name == oak_device_info.name:
+                return
+            logging.warning("Camera %s enumerated again at %s", kewazo_camera_object.camera_name,
+                            oak_device_info.name)
+            kewazo_camera_object.oak_device_info = oak_device_info
+            device_session.oak_device_info = oak_device_info
+        self.record_event("reenumerated", kewazo_camera_object.camera_name)
+
+    def record_event(self, event, camera_name):
+        """
+        Count an attach, detach or enumeration of a camera.
+
+        """
+        self.event_count[event] += 1
+        REGISTRY.increment("camera_" + event, camera=camera_name)
+
+    def process_polls(self):
+        """
+        Monitor loop. Poll the connected devices every poll interval until closed.
+
+        """
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Unknown Error when polling for DepthAI devices")
+
+    def get_metrics(self):
+        """
+        Get the state of the monitor.
+
+        Returns:
+            dict : the number of cameras capturing images, and the number of cameras
+                attached, detached and enumerated again so far
+
+        """
+        return dict(self.event_count,
+                    cameras=len(self.camera_handler.kewazo_camera_object_list))
+
+    def start(self):
+        """
+        Start polling in the background.
+
+        """
+        self.monitor_thread.start()
+
+    def close(self):
+        """
+        Stop polling. Cameras are left to be closed by the CameraHandler.
+
+        """
+        self.stop_event.set()
+        if self.monitor_thread.is_alive():
+            self.monitor_thread.join()
@@ -0,0 +1,212 @@
+"""
+This module tells whether a captured frame is a near-duplicate of the frames a
+camera captured recently, so that a payload that did not change between two
+lifts is not stored and sent again.
+
+Every frame is reduced to a 64-bit perceptual hash computed on a small grayscale
+copy of the frame. Two frames showing the same scene get hashes that differ in
+only a few bits, even with some sensor noise, exposure changes or JPEG artifacts,
+while a change of the payload flips many bits. Two hashes are supported:
+
+- dHash compares the brightness of horizontally adjacent pixels of a 9 x 8 copy.
+  It is the cheapest and copes well with exposure changes.
+- pHash keeps the signs of the low frequencies of the discrete cosine transform
+  of a 32 x 32 copy, relative to their median. It is more robust to noise and
+  small shifts.
+
+The DuplicateDetector keeps the hashes of the last frames kept for every camera
+in a fixed-size NumPy ring buffer, and compares a new hash against all of them
+at once. A frame whose Hamming distance to any of them is within the threshold
+is a near-duplicate. Near-duplicates are not added to the cache, so that a
+payload changing slowly over many lifts is still kept once it drifted far enough
+from the last kept frame.
+
+Typical usage example:
+
+    duplicate_detector = DuplicateDetector(hash_method=DuplicateDetector.HASH_DHASH)
+    is_duplicate, hamming_distance = duplicate_detector.check(camera_name, frame)
+    duplicate_detector.get_metrics()
+
+"""
+
+import threading
+import collections
+import cv2
+import numpy as np
+
+DUPLICATE_FILE_SUFFIX = "_duplicate" # Added to the image file name of marked near-duplicates
+
+class PerceptualHasher:
+    """
+    A class that computes 64-bit perceptual hashes of frames.
+    """
+    HASH_SIZE = 8 # The hashes have HASH_SIZE x HASH_SIZE bits
+    PHASH_IMAGE_SIZE = 32 # Width and height of the copy the DCT is computed on
+    SAMPLING_STRIDE = 8 # Look at 1 of every 8 x 8 pixels before scaling down
+
+    # Orthonormal DCT-II matrix, so that the 2D DCT of a copy is two matrix products
+    DCT_MATRIX = np.sqrt(2 / PHASH_IMAGE_SIZE) * np.cos(
+        np.pi * np.arange(PHASH_IMAGE_SIZE)[:, np.newaxis]
+        * (2 * np.arange(PHASH_IMAGE_SIZE)[np.newaxis, :] + 1) / (2 * PHASH_IMAGE_SIZE))
+    DCT_MATRIX[0] /= np.sqrt(2)
+
+    @classmethod
+    def get_small_grayscale(cls, frame, width, height):
+        """
+        Scale a frame down to a small grayscale copy. Large frames are sampled with a
+        stride first, so that scaling a 12 MP still down costs little.
+
+        Args:
+            frame (numpy.ndarray) : a BGR frame, or a single channel frame
+            width (int) : the width of the copy
+            height (int) : the height of the copy
+
+        Returns:
+            numpy.ndarray : the float32 grayscale copy
+
+        """
+        if min(frame.shape[:2]) >= cls.SAMPLING_STRIDE * cls.PHASH_IMAGE_SIZE:
+            frame = frame[::cls.SAMPLING_STRIDE, ::cls.SAMPLING_STRIDE]
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_BGR2GRAY)
+        return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    @classmethod
+    def dhash(cls, frame):
+        """
+        Compute the difference hash of a frame.
+
+        Returns:
+            numpy.ndarray : the 64 bits of the hash, packed in 8 uint8
+
+        """
+        small_frame = cls.get_small_grayscale(frame, cls.HASH_SIZE + 1, cls.HASH_SIZE)
+        return np.packbits(small_frame[:, 1:] > small_frame[:, :-1])
+
+    @classmethod
+    def phash(cls, frame):
+        """
+        Compute the DCT based perceptual hash of a frame.
+
+        Returns:
+            numpy.ndarray : the 64 bits of the hash, packed in 8 uint8
+
+        """
+        small_frame = cls.get_small_grayscale(frame, cls.PHASH_IMAGE_SIZE, cls.PHASH_IMAGE_SIZE)
+        low_frequencies = (cls.DCT_MATRIX @ small_frame @ cls.DCT_MATRIX.T)[
+            :cls.HASH_SIZE, :cls.HASH_SIZE]
+        # The DC coefficient only holds the mean brightness, so it is left out of the median
+        return np.packbits(low_frequencies > np.median(low_frequencies.ravel()[1:]))
+
+class DuplicateDetector:
+    """
+    A class that detects near-duplicate frames by comparing their perceptual hash
+    against a bounded cache of recent hashes of every camera.
+    """
+    HASH_DHASH = "dhash"
+    HASH_PHASH = "phash"
+    HASH_FUNCTIONS = {HASH_DHASH: PerceptualHasher.dhash, HASH_PHASH: PerceptualHasher.phash}
+    ACTION_SKIP = "skip" # Do not save near-duplicates
+    ACTION_MARK = "mark" # Save near-duplicates with DUPLICATE_FILE_SUFFIX in their name
+    DEFAULT_HAMMING_THRESHOLD = 6 # Highest number of differing bits of a near-duplicate
+    DEFAULT_CACHE_SIZE = 4 # Number of recent hashes kept per camera
+
+    # Number of set bits of every byte value
+    BIT_COUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(
+        axis=1).astype(np.uint8)
+
+    def __init__(self, hash_method=HASH_DHASH, hamming_threshold=DEFAULT_HAMMING_THRESHOLD,
+                 cache_size=DEFAULT_CACHE_SIZE, action=ACTION_MARK):
+        """
+        Initialize the detector with empty caches.
+
+        Args:
+            hash_method (string) : HASH_DHASH or HASH_PHASH
+            hamming_threshold (int) : the highest number of bits, out of 64, in which
+                                    the hash of a near-duplicate may differ from a
+                                    recent hash
+            cache_size (int) : the number of recent hashes kept per camera
+            action (string) : what to do with near-duplicates, ACTION_MARK or
+                            ACTION_SKIP. Only skip once the threshold is tuned for the
+                            scene, as skipped images cannot be recovered
+
+        """
+        if hash_method not in self.HASH_FUNCTIONS:
+            raise ValueError(f"Unknown hash method {hash_method}")
+        if action not in (self.ACTION_SKIP, self.ACTION_MARK):
+            raise ValueError(f"Unknown duplicate action {action}")
+        self.hash_method = hash_method
+        self.hash_function = self.HASH_FUNCTIONS[hash_method]
+        self.hamming_threshold = hamming_threshold
+        self.cache_size = cache_size
+        self.action = action
+
+        # Cameras run their captures in parallel threads
+        self.cache_lock = threading.Lock()
+        self.hash_cache = {} # Ring buffer of recent hashes, per camera
+        self.cache_index = collections.Counter() # Next slot of the ring buffer, per camera
+        self.cached_hash_count = collections.Counter() # Filled slots, per camera
+        self.checked_count = collections.Counter()
+        self.duplicate_count = collections.Counter()
+
+    def check(self, camera_name, frame):
+        """
+        Tell whether a frame is a near-duplicate of a recent frame of the same camera.
+        Frames that are not are added to the camera's cache.
+
+        Args:
+            camera_name (string) : the camera the frame was captured by
+            frame (numpy.ndarray) : the captured frame. A small copy, such as a preview
+                                    frame, is enough
+
+        Returns:
+            tuple : whether the frame is a near-duplicate, and the smallest Hamming
+                    distance to a recent hash, or None if the cache was empty
+
+        """
+        frame_hash = self.hash_function(frame)
+        with self.cache_lock:
+            self.checked_count[camera_name] += 1
+            if camera_name not in self.hash_cache:
+                self.hash_cache[camera_name] = np.zeros((self.cache_size, frame_hash.size),
+                                                        dtype=np.uint8)
+            cached_hashes = self.hash_cache[camera_name][:self.cached_hash_count[camera_name]]
+            hamming_distance = None
+            if len(cached_hashes):
+                hamming_distance = int(self.BIT_COUNT[cached_hashes ^ frame_hash].sum(axis=1).min())
+                if hamming_distance <= self.hamming_threshold:
+                    self.duplicate_count[camera_name] += 1
+                    return True, hamming_distance
+
+            self.hash_cache[camera_name][self.cache_index[camera_name]] = frame_hash
+            self.cache_index[camera_name] = (self.cache_index[camera_name] + 1) % self.cache_size
+            self.cached_hash_count[camera_name] = min(self.cached_hash_count[camera_name] + 1,
+                                                      self.cache_size)
+            return False, hamming_distance
+
+    def reset(self, camera_name=None):
+        """
+        Forget the recent hashes of a camera, or of all cameras.
+
+        """
+        with self.cache_lock:
+            for cached_camera_name in ([camera_name] if camera_name is not None
+                                       else list(self.hash_cache)):
+                self.hash_cache.pop(cached_camera_name, None)
+                self.cache_index.pop(cached_camera_name, None)
+                self.cached_hash_count.pop(cached_camera_name, None)
+
+    def get_metrics(self):
+        """
+        Get the counters of the detector.
+
+        Returns:
+            dict : the number of frames checked and of near-duplicates found, in total
+                and per camera
+
+        """
+        with self.cache_lock:
+            return {"checked": sum(self.checked_count.values()),
+                    "duplicates": sum(self.duplicate_count.values()),
+                    "checked_per_camera": dict(self.checked_count),
+                    "duplicates_per_camera": dict(self.duplicate_count)}
@@ -0,0 +1,142 @@
+"""
+This module defines how captured frames are encoded before they are written to
+the host device and sent over the metered uplink.
+
+An EncodingProfile holds the image format (JPEG or WebP), the quality, the
+maximum image dimension, and for JPEG the chroma subsampling and whether the
+JPEG is progressive. Every deployment picks a profile for the full resolution
+images, and optionally a preview profile for a small low resolution copy of
+every image. The preview copy is named after the full resolution image with
+PREVIEW_FILE_SUFFIX, and is sent to the server first so that dashboards get
+images in near real time, while the full resolution images can wait for
+off-peak hours.
+
+Typical usage example:
+
+    encoding_profile = ENCODING_PROFILES["compact"]
+    encoded_image = encoding_profile.encode(frame)
+    image_file_directory = encoding_profile.get_image_file_directory(image_file_directory)
+
+"""
+
+import os
+import cv2
+
+PREVIEW_FILE_SUFFIX = "_preview" # Added to the image file name of preview copies
+
+class EncodingProfile:
+    """
+    A class that encodes frames with a set of encoding settings.
+    """
+    FORMAT_JPEG = "jpeg"
+    FORMAT_WEBP = "webp"
+    FILE_EXTENSIONS = {FORMAT_JPEG: ".jpg", FORMAT_WEBP: ".webp"}
+    CHROMA_SUBSAMPLING_FACTORS = {"444": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+                                  "422": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+                                  "420": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420}
+
+    def __init__(self, name, image_format=FORMAT_JPEG, quality=95, max_dimension=None,
+                 progressive=False, chroma_subsampling="420"):
+        """
+        Args:
+            name (string) : the name of the profile
+            image_format (string) : FORMAT_JPEG or FORMAT_WEBP
+            quality (int) : the encoding quality, from 1 to 100
+            max_dimension (int) : the longest side of the encoded image in pixels. Larger
+                                frames are scaled down, keeping their aspect ratio. None
+                                to keep the full resolution
+            progressive (bool) : whether to encode a progressive JPEG
+            chroma_subsampling (string) : the JPEG chroma subsampling, '444', '422' or '420'
+
+        """
+        if image_format not in self.FILE_EXTENSIONS:
+            raise ValueError(f"Unknown image format {image_format}")
+        if chroma_subsampling not in self.CHROMA_SUBSAMPLING_FACTORS:
+            raise ValueError(f"Unknown chroma subsampling {chroma_subsampling}")
+        self.name = name
+        self.image_format = image_format
+        self.quality = quality
+        self.max_dimension = max_dimension
+        self.progressive = progressive
+        self.chroma_subsampling = chroma_subsampling
+        self.file_extension = self.FILE_EXTENSIONS[image_format]
+
+        if image_format == self.FORMAT_WEBP:
+            self.encode_parameters = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            self.encode_parameters = [
+                cv2.IMWRITE_JPEG_QUALITY, quality,
+                cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive),
+                cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                self.CHROMA_SUBSAMPLING_FACTORS[chroma_subsampling]]
+
+    def resize(self, frame):
+        """
+        Scale a frame down so that its longest side fits the maximum dimension.
+
+        Args:
+            frame (numpy.ndarray) : the frame to scale
+
+        Returns:
+            numpy.ndarray : the scaled frame, or the same frame if it already fits
+
+        """
+        height, width = frame.shape[:2]
+        if self.max_dimension is None or max(height, width) <= self.max_dimension:
+            return frame
+        scale = self.max_dimension / max(height, width)
+        return cv2.resize(frame, (max(round(width * scale), 1), max(round(height * scale), 1)),
+                          interpolation=cv2.INTER_AREA)
+
+    def encode(self, frame):
+        """
+        Scale and encode a frame.
+
+        Args:
+            frame (numpy.ndarray) : the BGR frame to encode
+
+        Returns:
+            numpy.ndarray : the encoded image, or None if it could not be encoded
+
+        """
+        is_encoded, encoded_image = cv2.imencode(self.file_extension, self.resize(frame),
+                                                 self.encode_parameters)
+        return encoded_image if is_encoded else None
+
+    def get_image_file_directory(self, image_file_directory):
+        """
+        Get the path of an image encoded with this profile, by replacing its file
+        extension with the one of the profile's format.
+
+        """
+        return os.path.splitext(image_file_directory)[0] + self.file_extension
+
+    def get_preview_file_directory(self, image_file_directory):
+        """
+        Get the path of the preview copy of an image encoded with this profile.
+
+        """
+        return os.path.splitext(image_file_directory)[0] + PREVIEW_FILE_SUFFIX + \
+            self.file_extension
+
+    def __repr__(self):
+        return (f"EncodingProfile({self.name!r}, {self.image_format}, quality={self.quality}, "
+                f"max_dimension={self.max_dimension}, progressive={self.progressive}, "
+                f"chroma_subsampling={self.chroma_subsampling})")
+
+def is_preview_file(image_file_name):
+    """
+    Check whether an image file is the preview copy of an image.
+
+    """
+    return os.path.splitext(image_file_name)[0].endswith(PREVIEW_FILE_SUFFIX)
+
+# Profiles to pick from per deployment
+ENCODING_PROFILES = {
+    "original": EncodingProfile("original", quality=95), # OpenCV's default JPEG encoding
+    "balanced": EncodingProfile("balanced", quality=85),
+    "compact": EncodingProfile("compact", quality=80, max_dimension=2048, progressive=True),
+    "webp": EncodingProfile("webp", image_format=EncodingProfile.FORMAT_WEBP, quality=80,
+                            max_dimension=2048),
+    "preview": EncodingProfile("preview", quality=70, max_dimension=640, progressive=True),
+}
@@ -0,0 +1,429 @@
+"""
+This module measures how long every stage of the camera system takes, from the
+CAN frame that triggers a capture to the image confirmed on the server, and how
+many events and bytes go through it.
+
+Stages record their duration in histograms with time_stage or observe_stage, and
+events are counted with increment. The state reported by the get_metrics and
+get_progress methods of the other handlers can be added as collectors and is
+exported as gauges. Everything is kept in a single MetricsRegistry, REGISTRY,
+shared by all modules like the logging module, so that no handler needs to be
+given a registry.
+
+The registry is rendered in the Prometheus text exposition format, and can be
+served on a local HTTP endpoint by a MetricsServer, or written to a file every
+few seconds by a MetricsFileWriter, e.g. for node_exporter's textfile collector.
+
+The stages recorded are:
+
+- can_frame: from a CAN frame received to its RM speed handled
+- trigger_decision: filtering an RM speed and deciding whether to capture
+- device_open: booting a camera and uploading the pipeline
+- capture: from the capture event sent to the still received
+- brightness: measuring the brightness of a still
+- gamma: solving and applying gamma correction
+- imwrite: encoding and writing an image to the host device
+- upload: sending a batch of images to the server
+- delete: erasing sent images from the host device
+- written_to_uploaded: from an image written to the host device to it confirmed
+  on the server
+
+Typical usage example:
+
+    with REGISTRY.time_stage("capture"):
+        capture a still
+    REGISTRY.increment("images_uploaded", len(confirmed_file_list))
+
+    metrics_server = MetricsServer(REGISTRY, port)
+    metrics_server.start()
+    metrics_server.close()
+
+"""
+
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+import contextlib
+import http.server
+
+class Histogram:
+    """
+    A class that counts observations in cumulative buckets, like a Prometheus histogram.
+    """
+    # Upper bounds of the buckets in seconds, from USB and disk operations to uploads
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                       2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets (tuple) : the upper bounds of the buckets, in increasing order. An
+                            infinite bucket is always added
+
+        """
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Count an observation in its bucket.
+
+        """
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_cumulative_counts(self):
+        """
+        Get the number of observations up to every bucket bound.
+
+        Returns:
+            list : tuples of the bucket bound as a string and the number of observations
+                less than or equal to it, ending with the infinite bucket
+
+        """
+        cumulative_counts = []
+        cumulative_count = 0
+        for bucket, bucket_count in zip(self.buckets + (float("inf"),), self.bucket_counts):
+            cumulative_count += bucket_count
+            cumulative_counts.append(("+Inf" if bucket == float("inf") else repr(bucket),
+                                      cumulative_count))
+        return cumulative_counts
+
+class MetricsRegistry:
+    """
+    A class that keeps the stage duration histograms, the event counters and the
+    gauge collectors of the camera system.
+    """
+    METRIC_PREFIX = "kewazo"
+    INVALID_NAME_CHARACTERS = re.compile(r"[^a-zA-Z0-9_]")
+
+    def __init__(self, buckets=Histogram.DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets (tuple) : the upper bounds of the stage duration buckets, in seconds
+
+        """
+        self.buckets = buckets
+        # Stages are recorded from the CAN, camera, storage and upload threads
+        self.registry_lock = threading.Lock()
+        self.stage_histograms = {} # Histogram of every stage and label set
+        self.event_counters = {} # Count of every event and label set
+        self.collectors = {} # Function returning a dict of gauge values, per name
+
+    @staticmethod
+    def get_label_key(labels):
+        """
+        Get a hashable key for a set of labels.
+
+        """
+        return tuple(sorted(labels.items()))
+
+    def observe_stage(self, stage, duration, **labels):
+        """
+        Record the duration of a stage.
+
+        Args:
+            stage (string) : the name of the stage
+            duration (float) : the duration of the stage, in seconds
+            labels : labels to tell apart the same stage of e.g. different cameras
+
+        """
+        key = (stage, self.get_label_key(labels))
+        with self.registry_lock:
+            histogram = self.stage_histograms.get(key)
+            if histogram is None:
+                histogram = self.stage_histograms[key] = Histogram(self.buckets)
+            histogram.observe(duration)
+
+    @contextlib.contextmanager
+    def time_stage(self, stage, **labels):
+        """
+        Record the duration of the code in a with statement as a stage, also when
+        it raises.
+
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start_time, **labels)
+
+    def increment(self, event, count=1, **labels):
+        """
+        Count events, e.g. images written or bytes sent.
+
+        Args:
+            event (string) : the name of the event
+            count (int) : the number of events
+            labels : labels to tell apart the same event of e.g. different cameras
+
+        """
+        key = (event, self.get_label_key(labels))
+        with self.registry_lock:
+            self.event_counters[key] = self.event_counters.get(key, 0) + count
+
+    def add_collector(self, name, collect_function):
+        """
+        Export the numbers returned by a function as gauges every time the registry
+        is rendered. Values that are not numbers are left out.
+
+        Args:
+            name (string) : the prefix of the gauge names
+            collect_function (function) : returns a dict of values, e.g. get_metrics
+                                        of a StorageHandler
+
+        """
+        with self.registry_lock:
+            self.collectors[name] = collect_function
+
+    def remove_collector(self, name):
+        """
+        Stop exporting the gauges of a collector.
+
+        """
+        with self.registry_lock:
+            self.collectors.pop(name, None)
+
+    @classmethod
+    def get_metric_name(cls, *name_parts):
+        """
+        Get a valid Prometheus metric name from its parts.
+
+        """
+        return cls.INVALID_NAME_CHARACTERS.sub("_", "_".join((cls.METRIC_PREFIX,) + name_parts))
+
+    @staticmethod
+    def format_labels(label_key, **extra_labels):
+        """
+        Format labels in the Prometheus text format, e.g. {stage="capture",le="0.1"}.
+
+        """
+        label_list = list(label_key) + list(extra_labels.items())
+        if not label_list:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                                               .replace('"', '\\"').replace("\n", "\\n"))
+                              for name, value in label_list) + "}"
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        Returns:
+            string : the metrics, one sample per line
+
+        """
+        with self.registry_lock:
+            stage_histograms = {key: (histogram.get_cumulative_counts(), histogram.sum,
+                                      histogram.count)
+                                for key, histogram in self.stage_histograms.items()}
+            event_counters = dict(self.event_counters)
+            collectors = dict(self.collectors)
+
+        line_list = []
+        histogram_name = self.get_metric_name("stage_duration_seconds")
+        line_list.append(f"# HELP {histogram_name} Duration of every stage of the camera system")
+        line_list.append(f"# TYPE {histogram_name} histogram")
+        for (stage, label_key), (cumulative_counts, duration_sum, count) in sorted(
+                stage_histograms.items()):
+            stage_label_key = (("stage", stage),) + label_key
+            for bucket, cumulative_count in cumulative_counts:
+                line_list.append(f"{histogram_name}_bucket"
+                                 f"{self.format_labels(stage_label_key, le=bucket)} "
+                                 f"{cumulative_count}")
+            line_list.append(f"{histogram_name}_sum{self.format_labels(stage_label_key)} "
+                             f"{duration_sum!r}")
+            line_list.append(f"{histogram_name}_count{self.format_labels(stage_label_key)} "
+                             f"{count}")
+
+        event_names = sorted({event for event, _ in event_counters})
+        for event in event_names:
+            counter_name = self.get_metric_name(event, "total")
+            line_list.append(f"# TYPE {counter_name} counter")
+            for (counted_event, label_key), count in sorted(event_counters.items()):
+                if counted_event == event:
+                    line_list.append(f"{counter_name}{self.format_labels(label_key)} {count}")
+
+        for collector_name, collect_function in sorted(collectors.items()):
+            try:
+                value_dictionary = collect_function()
+            except Exception:
+                logging.exception("Could not collect metrics of %s", collector_name)
+                continue
+            for value_name, value in sorted(value_dictionary.items()):
+                # Booleans are numbers in Python, but not meaningful gauges
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                gauge_name = self.get_metric_name(collector_name, value_name)
+                line_list.append(f"# TYPE {gauge_name} gauge")
+                line_list.append(f"{gauge_name} {value!r}")
+        return "\n".join(line_list) + "\n"
+
+    def get_stage_statistics(self):
+        """
+        Get the number of times every stage was recorded and its average duration,
+        over all label sets.
+
+        Returns:
+            dict : the count, total duration and mean duration in seconds of every stage
+
+        """
+        stage_statistics = {}
+        with self.registry_lock:
+            for (stage, _), histogram in self.stage_histograms.items():
+                statistics = stage_statistics.setdefault(stage, {"count": 0, "sum": 0.0})
+                statistics["count"] += histogram.count
+                statistics["sum"] += histogram.sum
+        for statistics in stage_statistics.values():
+            statistics["mean"] = statistics["sum"] / statistics["count"] \
+                if statistics["count"] else 0.0
+        return stage_statistics
+
+    def reset(self):
+        """
+        Forget all stage durations and event counts. Collectors are kept.
+
+        """
+        with self.registry_lock:
+            self.stage_histograms.clear()
+            self.event_counters.clear()
+
+# The registry shared by all modules of the camera system
+REGISTRY = MetricsRegistry()
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A class that answers GET /metrics with the registry of its server.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def do_GET(self):
+        """
+        Send the rendered registry, or 404 for any other path than /metrics.
+
+        """
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.metrics_registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", self.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Keep scrapes out of the log.
+
+        """
+        return
+
+class MetricsServer:
+    """
+    A class that serves a registry over HTTP on the host device, for a Prometheus
+    server or curl to scrape.
+    """
+    DEFAULT_PORT = 9108
+    DEFAULT_HOST = "127.0.0.1" # Only reachable from the host device itself
+
+    def __init__(self, metrics_registry=REGISTRY, port=DEFAULT_PORT, host=DEFAULT_HOST):
+        """
+        Args:
+            metrics_registry (MetricsRegistry) : the registry to serve
+            port (int) : the TCP port to listen on
+            host (string) : the address to listen on. "0.0.0.0" to be reachable from
+                        other devices
+
+        """
+        self.http_server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.metrics_registry = metrics_registry
+        self.server_thread = threading.Thread(target=self.http_server.serve_forever,
+                                              name="metrics-server", daemon=True)
+
+    def start(self):
+        """
+        Start serving in the background.
+
+        """
+        self.server_thread.start()
+        logging.info("Serving metrics on port %s", self.http_server.server_address[1])
+
+    def close(self):
+        """
+        Stop serving.
+
+        """
+        if self.server_thread.is_alive():
+            self.http_server.shutdown()
+            self.server_thread.join()
+        self.http_server.server_close()
+
+class MetricsFileWriter:
+    """
+    A class that writes a registry to a file at a fixed interval. The file is
+    replaced atomically, so a reader never sees it half written.
+    """
+    DEFAULT_WRITE_INTERVAL = 15 # Seconds between two writes
+
+    def __init__(self, metrics_file_name, metrics_registry=REGISTRY,
+                 write_interval=DEFAULT_WRITE_INTERVAL):
+        """
+        Args:
+            metrics_file_name (string) : the file to write the metrics to
+            metrics_registry (MetricsRegistry) : the registry to write
+            write_interval (float) : the time between two writes, in seconds
+
+        """
+        self.metrics_file_name = metrics_file_name
+        self.metrics_registry = metrics_registry
+        self.write_interval = write_interval
+        self.stop_event = threading.Event()
+        self.writer_thread = threading.Thread(target=self.process_writes,
+                                              name="metrics-writer", daemon=True)
+
+    def write(self):
+        """
+        Write the rendered registry to the file.
+
+        """
+        temporary_file_name = self.metrics_file_name + ".part"
+        try:
+            with open(temporary_file_name, "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(self.metrics_registry.render())
+            os.replace(temporary_file_name, self.metrics_file_name)
+        except OSError:
+            logging.exception("Could not write metrics to %s", self.metrics_file_name)
+
+    def process_writes(self):
+        """
+        Writer loop. Write the registry every write interval until closed.
+
+        """
+        while not self.stop_event.wait(self.write_interval):
+            self.write()
+
+    def start(self):
+        """
+        Start writing in the background.
+
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.metrics_file_name)), exist_ok=True)
+        self.writer_thread.start()
+
+    def close(self):
+        """
+        Stop writing, after writing the registry one last time.
+
+        """
+        self.stop_event.set()
+        if self.writer_thread.is_alive():
+            self.writer_thread.join()
+        self.write()
@@ -0,0 +1,117 @@
+"""
+This module decides from the stream of RM speeds when the RM starts moving, so
+that the cameras capture images exactly once per start.
+
+RM speeds received from CAN are noisy, and sometimes show very high values
+like 400000 when the RM is not moving. The RmMotionDetector first rejects
+such invalid values, then filters the valid ones with a median over a short
+window kept in a fixed-size deque. A single spike within the window cannot
+change the median. The window only holds a handful of values, so the median is
+taken in pure Python, which keeps NumPy out of the startup path: the detector
+follows the RM from the moment CAN is up. The filtered speed then drives a state machine with
+hysteresis: the RM is considered moving once the filtered speed stays above the
+start threshold for a few samples, and stationary again only once it drops
+below a lower stop threshold.
+
+Typical usage example:
+
+    motion_detector = RmMotionDetector(start_speed_threshold)
+    if motion_detector.update(rm_speed):
+        capture images
+
+"""
+
+import statistics
+import collections
+
+class RmMotionDetector:
+    """
+    A class that detects RM starts from a stream of RM speeds with median filtering,
+    outlier rejection and hysteresis.
+    """
+    DEFAULT_WINDOW_SIZE = 5 # Number of valid RM speeds the median is taken over
+    DEFAULT_MIN_MOVING_SAMPLES = 2 # Filtered samples above start threshold that make a start
+    DEFAULT_MAX_RM_SPEED = 400 # Highest absolute RM speed the RM can actually reach
+    DEFAULT_GARBAGE_SPEED = 400000 # Absolute RM speed sent via CAN while the RM is stationary
+
+    def __init__(self, start_speed_threshold, stop_speed_threshold=None,
+                 window_size=DEFAULT_WINDOW_SIZE, min_moving_samples=DEFAULT_MIN_MOVING_SAMPLES,
+                 max_rm_speed=DEFAULT_MAX_RM_SPEED, garbage_speed=DEFAULT_GARBAGE_SPEED):
+        """
+        Initialize the detector with the RM stationary.
+
+        Args:
+            start_speed_threshold (int) : the absolute filtered RM speed above which the
+                                        RM is moving
+            stop_speed_threshold (int) : the absolute filtered RM speed below which a
+                                        moving RM is stationary again. Defaults to half of
+                                        the start threshold
+            window_size (int) : the number of valid RM speeds the median is taken over
+            min_moving_samples (int) : the number of consecutive filtered RM speeds above
+                                    the start threshold needed to detect a start
+            max_rm_speed (int) : the highest absolute RM speed the RM can reach. Higher
+                                values are rejected as invalid
+            garbage_speed (int) : the absolute RM speed from which a value is known to be
+                                sent while the RM is stationary
+
+        """
+        self.start_speed_threshold = start_speed_threshold
+        self.stop_speed_threshold = stop_speed_threshold if stop_speed_threshold is not None \
+            else start_speed_threshold / 2
+        self.window_size = window_size
+        self.min_moving_samples = min_moving_samples
+        self.max_rm_speed = max_rm_speed
+        self.garbage_speed = garbage_speed
+
+        self.speed_window = collections.deque(maxlen=window_size) # Latest valid RM speeds
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all RM speeds and consider the RM stationary.
+
+        """
+        self.speed_window.clear()
+        self.is_moving = False
+        self.moving_sample_count = 0
+        self.invalid_sample_count = 0 # Consecutive invalid RM speeds
+        self.filtered_speed = 0.0
+
+    def update(self, rm_speed):
+        """
+        Add an RM speed and check whether the RM just started moving.
+
+        Args:
+            rm_speed (int) : the RM speed decoded from CAN
+
+        Returns:
+            bool : True only for the RM speed at which an RM start is detected
+
+        """
+        # Reject invalid values. A full window of consecutive garbage values means
+        # the RM is stationary, as it only sends those while standing still
+        if abs(rm_speed) > self.max_rm_speed:
+            self.invalid_sample_count += 1
+            if abs(rm_speed) >= self.garbage_speed and \
+                    self.invalid_sample_count >= self.window_size:
+                self.reset()
+            return False
+        self.invalid_sample_count = 0
+
+        self.speed_window.append(rm_speed)
+        self.filtered_speed = abs(float(statistics.median(self.speed_window)))
+
+        if self.is_moving:
+            if self.filtered_speed < self.stop_speed_threshold:
+                self.is_moving = False
+                self.moving_sample_count = 0
+            return False
+
+        if self.filtered_speed > self.start_speed_threshold:
+            self.moving_sample_count += 1
+        else:
+            self.moving_sample_count = 0
+        if self.moving_sample_count >= self.min_moving_samples:
+            self.is_moving = True
+            return True
+        return False
@@ -0,0 +1,336 @@
+"""
+This module profiles the camera system while it runs in the field, to find CPU
+hotspots and slow memory growth without attaching a debugger or restarting.
+
+The RuntimeProfiler is off by default. It is started from the configuration of
+CentralHandler, or toggled on a running camera system with a signal:
+
+    kill -USR2 <pid of central_handler.py>
+
+While it runs, it does two things:
+
+- It samples the stack of every thread at a fixed interval, and charges the CPU
+  time the thread used since the previous sample to its current stack. The CPU
+  time of every thread is read from its own CPU clock, so threads waiting on a
+  queue, a lock or the network cost nothing. The stacks with the most CPU time
+  are written in the collapsed stack format, one line per stack, which can be
+  turned into a flame graph with flamegraph.pl or speedscope.
+- It takes tracemalloc snapshots, and writes the source lines whose allocated
+  memory grew the most since the previous report and since profiling started,
+  along with the resident set size (RSS) of the process.
+
+Reports are written every report interval and when profiling stops, to
+profile_cpu.log and profile_memory.log under the log folder. Both files are
+rotated once they reach a maximum size and only a few old files are kept, so
+that profiling for days cannot fill the SD card.
+
+Typical usage example:
+
+    runtime_profiler = RuntimeProfiler(log_directory)
+    runtime_profiler.install_signal_handler()
+    runtime_profiler.start()
+    runtime_profiler.stop()
+
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import logging.handlers
+import threading
+import collections
+import tracemalloc
+
+class RuntimeProfiler:
+    """
+    A class that samples the CPU time of every thread by stack, and tracks memory
+    allocations, writing periodic reports to size-capped rotating files.
+    """
+    DEFAULT_SAMPLE_INTERVAL = 0.02 # Seconds between two stack samples
+    DEFAULT_REPORT_INTERVAL = 300 # Seconds between two reports
+    DEFAULT_MAX_FILE_SIZE = 5 * 2 ** 20 # Bytes of a report file before it is rotated
+    DEFAULT_BACKUP_COUNT = 3 # Rotated report files kept, per report file
+    CPU_LOG_FILE_NAME = "profile_cpu.log"
+    MEMORY_LOG_FILE_NAME = "profile_memory.log"
+    MAX_STACK_DEPTH = 40 # Innermost frames kept per stack
+    MAX_REPORTED_STACKS = 200 # Stacks with the most CPU time written per report
+    MAX_REPORTED_ALLOCATIONS = 25 # Source lines with the most memory growth written per report
+    TRACEMALLOC_FRAME_COUNT = 1 # Frames stored per allocation. More cost more memory
+    TRACEMALLOC_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+                           tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                           tracemalloc.Filter(False, "<unknown>"))
+
+    def __init__(self, log_directory, sample_interval=DEFAULT_SAMPLE_INTERVAL,
+                 report_interval=DEFAULT_REPORT_INTERVAL, max_file_size=DEFAULT_MAX_FILE_SIZE,
+                 backup_count=DEFAULT_BACKUP_COUNT, is_memory_tracked=True):
+        """
+        Args:
+            log_directory (string) : the folder to write the reports to
+            sample_interval (float) : the time between two stack samples, in seconds
+            report_interval (float) : the time between two reports, in seconds
+            max_file_size (int) : the size a report file may reach before it is
+                                rotated, in bytes
+            backup_count (int) : the number of rotated files kept per report file
+            is_memory_tracked (bool) : whether to trace memory allocations with
+                                    tracemalloc, which slows down allocations
+
+        """
+        self.log_directory = log_directory
+        self.sample_interval = sample_interval
+        self.report_interval = report_interval
+        self.max_file_size = max_file_size
+        self.backup_count = backup_count
+        self.is_memory_tracked = is_memory_tracked
+
+        self.profiler_lock = threading.Lock() # Serializes start, stop and toggle
+        self.stop_event = threading.Event()
+        self.sampler_thread = None
+        self.cpu_logger = logging.getLogger("profiler.cpu")
+        self.memory_logger = logging.getLogger("profiler.memory")
+        for report_logger in (self.cpu_logger, self.memory_logger):
+            # Reports go to their own files only, never to the debug log
+            report_logger.propagate = False
+            report_logger.setLevel(logging.INFO)
+        self.report_handler_list = []
+        self.reset_samples()
+        self.first_snapshot = None
+        self.previous_snapshot = None
+        self.is_tracemalloc_started = False
+
+    def reset_samples(self):
+        """
+        Forget the stack samples since the last report.
+
+        """
+        self.stack_cpu_time = collections.Counter() # CPU seconds per collapsed stack
+        self.thread_cpu_time = collections.Counter() # CPU seconds per thread name
+        self.last_thread_cpu_time = {} # CPU clock of every thread at its last sample
+        self.sample_count = 0
+        self.sampling_time = 0.0 # Seconds spent sampling, the profiler's own overhead
+        self.report_start_time = time.monotonic()
+
+    def is_running(self):
+        """
+        Check whether the profiler is sampling.
+
+        """
+        return self.sampler_thread is not None and self.sampler_thread.is_alive()
+
+    def start(self):
+        """
+        Start sampling and tracking memory in the background. Do nothing if the
+        profiler is already running.
+
+        """
+        with self.profiler_lock:
+            if self.is_running():
+                return
+            os.makedirs(self.log_directory, exist_ok=True)
+            for report_logger, log_file_name in ((self.cpu_logger, self.CPU_LOG_FILE_NAME),
+                                                 (self.memory_logger, self.MEMORY_LOG_FILE_NAME)):
+                report_handler = logging.handlers.RotatingFileHandler(
+                    os.path.join(self.log_directory, log_file_name),
+                    maxBytes=self.max_file_size, backupCount=self.backup_count)
+                report_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                report_logger.addHandler(report_handler)
+                self.report_handler_list.append((report_logger, report_handler))
+
+            self.reset_samples()
+            if self.is_memory_tracked:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(self.TRACEMALLOC_FRAME_COUNT)
+                    self.is_tracemalloc_started = True
+                self.first_snapshot = self.take_snapshot()
+                self.previous_snapshot = self.first_snapshot
+            self.stop_event.clear()
+            self.sampler_thread = threading.Thread(target=self.process_samples,
+                                                   name="runtime-profiler", daemon=True)
+            self.sampler_thread.start()
+        logging.warning("Runtime profiling started. Reports in %s", self.log_directory)
+
+    def stop(self):
+        """
+        Stop sampling after writing a last report, and stop tracking memory. Do nothing
+        if the profiler is not running.
+
+        """
+        with self.profiler_lock:
+            if not self.is_running():
+                return
+            self.stop_event.set()
+            self.sampler_thread.join()
+            self.sampler_thread = None
+            if self.is_tracemalloc_started:
+                tracemalloc.stop()
+                self.is_tracemalloc_started = False
+            self.first_snapshot = None
+            self.previous_snapshot = None
+            for report_logger, report_handler in self.report_handler_list:
+                report_logger.removeHandler(report_handler)
+                report_handler.close()
+            self.report_handler_list = []
+        logging.warning("Runtime profiling stopped")
+
+    def toggle(self):
+        """
+        Start the profiler if it is not running, stop it otherwise.
+
+        """
+        if self.is_running():
+            self.stop()
+        else:
+            self.start()
+
+    def install_signal_handler(self, signal_number=signal.SIGUSR2):
+        """
+        Toggle the profiler whenever the process receives a signal. Must be called
+        from the main thread.
+
+        Args:
+            signal_number (int) : the signal to toggle the profiler on
+
+        """
+        def handle_signal(received_signal_number, frame):
+            # Toggling joins the sampler thread, which must not hold up the main thread
+            threading.Thread(target=self.toggle, name="runtime-profiler-toggle",
+                             daemon=True).start()
+
+        signal.signal(signal_number, handle_signal)
+
+    def process_samples(self):
+        """
+        Sampler loop. Sample all stacks every sample interval and write a report every
+        report interval, until stopped. A last report is written when stopped.
+
+        """
+        while not self.stop_event.wait(self.sample_interval):
+            sampling_start_time = time.perf_counter()
+            try:
+                self.sample_threads()
+            except Exception:
+                logging.exception("Could not sample thread stacks")
+            self.sampling_time += time.perf_counter() - sampling_start_time
+            if time.monotonic() - self.report_start_time >= self.report_interval:
+                self.write_reports()
+        self.write_reports()
+
+    @staticmethod
+    def get_thread_cpu_time(thread_id):
+        """
+        Read the CPU clock of a thread.
+
+        Args:
+            thread_id (int) : the identifier of the thread, as in threading.get_ident
+
+        Returns:
+            float : the CPU time the thread used so far in seconds, or None if it
+                    cannot be read, e.g. because the thread just ended
+
+        """
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+        except (OSError, AttributeError, OverflowError):
+            return None
+
+    def get_collapsed_stack(self, thread_name, frame):
+        """
+        Get the stack of a frame in the collapsed stack format, outermost frame first.
+
+        Returns:
+            string : the thread name and the function and line of every frame,
+                    separated by semicolons
+
+        """
+        frame_name_list = []
+        while frame is not None and len(frame_name_list) < self.MAX_STACK_DEPTH:
+            frame_name_list.append(f"{frame.f_code.co_name} "
+                                   f"({os.path.basename(frame.f_code.co_filename)}:"
+                                   f"{frame.f_lineno})")
+            frame = frame.f_back
+        frame_name_list.append(thread_name)
+        return ";".join(reversed(frame_name_list))
+
+    def sample_threads(self):
+        """
+        Charge the CPU time every thread used since its last sample to its current
+        stack. The sampler thread itself is left out.
+
+        """
+        thread_name_dictionary = {thread.ident: thread.name for thread in threading.enumerate()}
+        sampler_thread_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_thread_id:
+                continue
+            thread_cpu_time = self.get_thread_cpu_time(thread_id)
+            if thread_cpu_time is None:
+                continue
+            cpu_time = thread_cpu_time - self.last_thread_cpu_time.get(thread_id,
+                                                                       thread_cpu_time)
+            self.last_thread_cpu_time[thread_id] = thread_cpu_time
+            if cpu_time <= 0:
+                continue
+            thread_name = thread_name_dictionary.get(thread_id, f"thread-{thread_id}")
+            self.stack_cpu_time[self.get_collapsed_stack(thread_name, frame)] += cpu_time
+            self.thread_cpu_time[thread_name] += cpu_time
+        self.sample_count += 1
+
+    @staticmethod
+    def get_resident_set_size():
+        """
+        Get the memory of the process held in RAM.
+
+        Returns:
+            int : the resident set size in bytes, or None if it cannot be read
+
+        """
+        try:
+            with open("/proc/self/statm", encoding="ascii") as statm_file:
+                return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def take_snapshot(self):
+        """
+        Take a tracemalloc snapshot without the allocations of tracemalloc itself
+        and of the import system.
+
+        """
+        return tracemalloc.take_snapshot().filter_traces(self.TRACEMALLOC_FILTERS)
+
+    def write_reports(self):
+        """
+        Write the CPU report and the memory report, and start a new report interval.
+
+        """
+        report_time = time.monotonic() - self.report_start_time
+        line_list = [f"CPU PROFILE over {report_time:.1f} s, {self.sample_count} samples, "
+                     f"sampling took {self.sampling_time:.3f} s"]
+        for thread_name, cpu_time in self.thread_cpu_time.most_common():
+            line_list.append(f"# thread {thread_name} {cpu_time * 1000:.0f} ms "
+                             f"({cpu_time / max(report_time, 1e-9) * 100:.1f} % CPU)")
+        # Collapsed stacks with the CPU time in milliseconds, for flamegraph.pl
+        for collapsed_stack, cpu_time in self.stack_cpu_time.most_common(
+                self.MAX_REPORTED_STACKS):
+            line_list.append(f"{collapsed_stack} {max(round(cpu_time * 1000), 1)}")
+        self.cpu_logger.info("\n".join(line_list))
+        self.reset_samples()
+
+        if self.previous_snapshot is None:
+            return
+        snapshot = self.take_snapshot()
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        resident_set_size = self.get_resident_set_size()
+        line_list = [f"MEMORY PROFILE RSS "
+                     f"{resident_set_size / 2 ** 20 if resident_set_size else float('nan'):.1f} "
+                     f"MiB, traced {current_memory / 2 ** 20:.1f} MiB, traced peak "
+                     f"{peak_memory / 2 ** 20:.1f} MiB, {threading.active_count()} threads"]
+        for title, base_snapshot in (("since last report", self.previous_snapshot),
+                                     ("since profiling started", self.first_snapshot)):
+            line_list.append(f"# growth {title}")
+            for statistic_difference in snapshot.compare_to(
+                    base_snapshot, "lineno")[:self.MAX_REPORTED_ALLOCATIONS]:
+                line_list.append(str(statistic_difference))
+        self.memory_logger.info("\n".join(line_list))
+        self.previous_snapshot = snapshot
@@ -0,0 +1,275 @@
+"""
+This module keeps an index of the captured images on the host device and how
+far each of them got on its way to the server, in a small SQLite database.
+
+Every image goes through the states captured (written to the host device),
+queued (handed to the uploader), uploaded (confirmed on the server) and deleted
+(erased from the host device). CameraHandler records images once they are
+written, and DashboardHandler takes the images to send from the index instead
+of scanning the saving directories. The index orders them by capture time and
+tells exactly which images were complete. As every change of state is committed
+before the camera system acts on it, the index tells after a power loss exactly
+which images still have to be sent, and which were sent but not erased yet.
+
+Image paths are stored relative to the top directory for saving images on the
+host device, e.g. 230717/130450/left.jpg. Preview copies of images are recorded
+as a separate kind of image, so that they can be sent on their own.
+
+Typical usage example:
+
+    spool_index = SpoolIndex(database_file_name, local_images_saving_directory)
+    spool_index.record_folder(timestamp_folder_directory)
+    spool_index.get_pending_folders()
+    spool_index.set_state(relative_file_list, SpoolIndex.STATE_UPLOADED)
+    spool_index.close()
+
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from encoding_profile import is_preview_file
+
+class SpoolIndex:
+    """
+    A class that records the state of every captured image in an SQLite database.
+    """
+    STATE_CAPTURED = "captured"
+    STATE_QUEUED = "queued"
+    STATE_UPLOADED = "uploaded"
+    STATE_DELETED = "deleted"
+    PENDING_STATES = (STATE_CAPTURED, STATE_QUEUED) # Images still to be sent
+    KIND_FULL = "full" # Full resolution images
+    KIND_PREVIEW = "preview" # Low resolution preview copies
+    ALL_KINDS = (KIND_PREVIEW, KIND_FULL)
+    DATABASE_FILE_NAME = ".spool_index.sqlite3"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            image_file TEXT PRIMARY KEY,
+            folder TEXT NOT NULL,
+            captured_time REAL NOT NULL,
+            size INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            updated_time REAL NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'full'
+        );
+        CREATE INDEX IF NOT EXISTS images_by_state ON images (state, captured_time);
+        CREATE INDEX IF NOT EXISTS images_by_folder ON images (folder, state);
+    """
+
+    def __init__(self, database_file_name, local_images_saving_directory):
+        """
+        Open the index, and create it if it doesn't exist.
+
+        Args:
+            database_file_name (string) : the SQLite database file of the index
+            local_images_saving_directory (string) : the top folder that contains all
+                                                    the images on the host device
+
+        """
+        self.local_images_saving_directory = local_images_saving_directory
+        os.makedirs(os.path.dirname(os.path.abspath(database_file_name)), exist_ok=True)
+        # The connection is shared by the capture and upload threads, one at a time
+        self.index_lock = threading.Lock()
+        self.connection = sqlite3.connect(database_file_name, check_same_thread=False,
+                                          isolation_level=None)
+        with self.index_lock:
+            # WAL keeps the database consistent on power loss, and FULL makes every
+            # committed change of state survive it
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=FULL")
+            self.connection.executescript(self.SCHEMA)
+            # Indexes created before preview copies existed only hold full images
+            column_name_list = [column[1] for column in
+                                self.connection.execute("PRAGMA table_info(images)")]
+            if "kind" not in column_name_list:
+                self.connection.execute(
+                    "ALTER TABLE images ADD COLUMN kind TEXT NOT NULL DEFAULT 'full'")
+
+    def get_relative_path(self, directory):
+        """
+        Get the path of a file or folder relative to the top folder for saving images.
+
+        """
+        return os.path.relpath(directory, self.local_images_saving_directory)
+
+    def get_local_path(self, relative_path):
+        """
+        Get the path on the host device of a file or folder in the index.
+
+        """
+        return os.path.join(self.local_images_saving_directory, relative_path)
+
+    def record_folder(self, timestamp_folder_directory, state=STATE_CAPTURED):
+        """
+        Record all complete images of a timestamp folder. Images already in the index
+        keep their state, except that captured images are moved to the given state
+        if it is queued. Hidden files are images not completely written and are
+        skipped.
+
+        Args:
+            timestamp_folder_directory (string) : the timestamp folder on the host device
+            state (string) : STATE_CAPTURED or STATE_QUEUED
+
+        Returns:
+            int : the number of images recorded for the first time
+
+        """
+        try:
+            image_file_name_list = sorted(os.listdir(timestamp_folder_directory))
+        except FileNotFoundError:
+            return 0
+        folder = self.get_relative_path(timestamp_folder_directory)
+        current_time = time.time()
+        row_list = []
+        for image_file_name in image_file_name_list:
+            if image_file_name.startswith("."):
+                continue
+            image_file_directory = os.path.join(timestamp_folder_directory, image_file_name)
+            try:
+                image_stat = os.stat(image_file_directory)
+            except FileNotFoundError:
+                continue
+            row_list.append((os.path.join(folder, image_file_name), folder, image_stat.st_mtime,
+                             image_stat.st_size, state, current_time,
+                             self.KIND_PREVIEW if is_preview_file(image_file_name)
+                             else self.KIND_FULL))
+
+        with self.index_lock, self.connection:
+            self.connection.execute("BEGIN")
+            recorded_count = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO images (image_file, folder, captured_time, size, state, "
+                "updated_time, kind) VALUES (?, ?, ?, ?, ?, ?, ?)", row_list)
+            recorded_count = self.connection.total_changes - recorded_count
+            if state == self.STATE_QUEUED:
+                self.connection.execute(
+                    "UPDATE images SET state = ?, updated_time = ? WHERE folder = ? AND state = ?",
+                    (self.STATE_QUEUED, current_time, folder, self.STATE_CAPTURED))
+        return recorded_count
+
+    @staticmethod
+    def get_kind_condition(kind_list):
+        """
+        Get an SQL condition that matches images of the given kinds.
+
+        """
+        return "kind IN (" + ", ".join("?" * len(kind_list)) + ")"
+
+    def get_pending_folders(self, kind_list=ALL_KINDS):
+        """
+        Get the timestamp folders with images of the given kinds still to be sent,
+        oldest capture first.
+
+        Args:
+            kind_list (tuple) : the kinds of images to look for
+
+        Returns:
+            list : the timestamp folders on the host device
+
+        """
+        with self.index_lock:
+            row_list = self.connection.execute(
+                "SELECT folder FROM images WHERE state IN (?, ?) AND "
+                f"{self.get_kind_condition(kind_list)} "
+                "GROUP BY folder ORDER BY MIN(captured_time)",
+                self.PENDING_STATES + tuple(kind_list)).fetchall()
+        return [self.get_local_path(folder) for (folder,) in row_list]
+
+    def get_pending_images(self, timestamp_folder_directory, kind_list=ALL_KINDS):
+        """
+        Get the images of the given kinds of a timestamp folder still to be sent,
+        preview copies first, then in order of capture.
+
+        Returns:
+            list : tuples of the image path relative to the top folder for saving images,
+                and the image size in bytes
+
+        """
+        with self.index_lock:
+            return self.connection.execute(
+                "SELECT image_file, size FROM images WHERE folder = ? AND state IN (?, ?) "
+                f"AND {self.get_kind_condition(kind_list)} "
+                "ORDER BY kind = ?, captured_time, image_file",
+                (self.get_relative_path(timestamp_folder_directory),) + self.PENDING_STATES +
+                tuple(kind_list) + (self.KIND_FULL,)).fetchall()
+
+    def get_images_in_state(self, state):
+        """
+        Get all images in a state, oldest capture first.
+
+        Returns:
+            list : the image paths relative to the top folder for saving images
+
+        """
+        with self.index_lock:
+            row_list = self.connection.execute(
+                "SELECT image_file FROM images WHERE state = ? ORDER BY captured_time",
+                (state,)).fetchall()
+        return [image_file for (image_file,) in row_list]
+
+    def is_recorded(self, relative_image_file):
+        """
+        Check whether an image is in the index, in any state.
+
+        """
+        with self.index_lock:
+            return self.connection.execute("SELECT 1 FROM images WHERE image_file = ?",
+                                           (relative_image_file,)).fetchone() is not None
+
+    def set_state(self, relative_image_file_list, state):
+        """
+        Change the state of images in one transaction.
+
+        Args:
+            relative_image_file_list (list) : the image paths relative to the top folder
+                                            for saving images
+            state (string) : the new state
+
+        """
+        current_time = time.time()
+        with self.index_lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "UPDATE images SET state = ?, updated_time = ? WHERE image_file = ?",
+                [(state, current_time, relative_image_file)
+                 for relative_image_file in relative_image_file_list])
+
+    def prune(self, retention_time):
+        """
+        Forget deleted images after a while, so that the index does not keep growing.
+
+        Args:
+            retention_time (float) : the time to keep deleted images in the index,
+                                    in seconds
+
+        Returns:
+            int : the number of images forgotten
+
+        """
+        with self.index_lock, self.connection:
+            return self.connection.execute(
+                "DELETE FROM images WHERE state = ? AND updated_time < ?",
+                (self.STATE_DELETED, time.time() - retention_time)).rowcount
+
+    def get_state_counts(self):
+        """
+        Get the number of images in every state.
+
+        Returns:
+            dict : the number of images per state
+
+        """
+        with self.index_lock:
+            return dict(self.connection.execute(
+                "SELECT state, COUNT(*) FROM images GROUP BY state").fetchall())
+
+    def close(self):
+        """
+        Close the database.
+
+        """
+        with self.index_lock:
+            self.connection.close()
@@ -0,0 +1,490 @@
+"""
+This module handles encoding captured images and writing them to the host device
+in the background, so that capturing does not wait for the SD card.
+
+Cameras hand over captured frames to the StorageHandler, which puts them in a
+bounded queue. A small pool of worker threads takes frames from the queue,
+encodes them to JPEG and writes them to disk. Images that were already encoded
+on the camera are written as they are. Images are first written to a
+hidden temporary file and then renamed, so other parts of the camera system
+never see a partially written image. The file is synced before, and its folder
+after the rename, so that an image recorded in the spool index is complete on
+disk even after a power cut.
+
+When the queue is full, the StorageHandler either blocks the camera until there
+is room (backpressure), or drops the oldest frame waiting in the queue to make
+room for the new one.
+
+Frames are encoded with the deployment's encoding profile, and a low resolution
+preview copy of every image is written as well if a preview profile is set,
+see encoding_profile. Images encoded on the camera are written as they are,
+and their preview copy is made from a reduced resolution decode.
+
+Once all images of a folder have been submitted, the folder can be sealed. The
+StorageHandler then calls back as soon as the last image of that folder is
+written, so that other parts of the camera system can act on complete folders
+without watching the disk. A folder can also be held, e.g. while a capture that
+may still submit images to it runs, and is only called back once all its holds
+are released.
+
+Typical usage example:
+
+    storage_handler = StorageHandler(queue_size, worker_count, backpressure_policy,
+                                     encoding_profile, preview_profile)
+    storage_handler.submit(image_file_directory, frame)
+    storage_handler.submit_encoded(image_file_directory, encoded_image)
+    storage_handler.hold_folder(folder_directory)
+    storage_handler.seal_folder(folder_directory, callback)
+    storage_handler.release_folder(folder_directory)
+    storage_handler.get_metrics()
+    storage_handler.close()
+
+"""
+
+import os
+import time
+import threading
+import collections
+import logging
+import cv2
+import numpy as np
+from metrics import REGISTRY
+
+class ImageWriteJob:
+    """
+    A class that holds a captured frame waiting to be encoded and written.
+    """
+
+    def __init__(self, image_file_directory, frame=None, encoded_image=None):
+        """
+        Args:
+            image_file_directory (string) : the path to write the image to. The file
+                                            extension decides the encoding
+            frame (numpy.ndarray) : the captured frame, to be encoded
+            encoded_image (bytes-like) : the already encoded image, used if frame is None
+
+        """
+        self.image_file_directory = image_file_directory
+        self.frame = frame
+        self.encoded_image = encoded_image
+        self.submitted_time = time.monotonic()
+
+class StorageHandler:
+    """
+    A class that encodes and writes images with a pool of worker threads, fed by
+    a bounded queue.
+    """
+    BACKPRESSURE_BLOCK = "block" # Block the camera until there is room in the queue
+    BACKPRESSURE_DROP_OLDEST = "drop_oldest" # Drop the oldest waiting frame
+    DEFAULT_QUEUE_SIZE = 8
+    DEFAULT_WORKER_COUNT = 2
+    TEMPORARY_FILE_NAMING = ".{image_file_name}.part"
+    # Decoding at a quarter of the resolution is much faster than a full decode
+    # and still larger than any preview
+    PREVIEW_DECODE_FLAG = cv2.IMREAD_REDUCED_COLOR_4
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, worker_count=DEFAULT_WORKER_COUNT,
+                 backpressure_policy=BACKPRESSURE_BLOCK, encoding_profile=None,
+                 preview_profile=None):
+        """
+        Initialize the queue and start the worker threads.
+
+        Args:
+            queue_size (int) : the maximum number of frames waiting to be written
+            worker_count (int) : the number of worker threads encoding and writing images
+            backpressure_policy (string) : what to do when the queue is full, either
+                                        BACKPRESSURE_BLOCK or BACKPRESSURE_DROP_OLDEST
+            encoding_profile (EncodingProfile) : the profile to encode frames with. None
+                                                to encode by the file extension with
+                                                OpenCV's default settings
+            preview_profile (EncodingProfile) : the profile to encode a preview copy of
+                                            every image with. None for no preview copy
+
+        """
+        if backpressure_policy not in (self.BACKPRESSURE_BLOCK, self.BACKPRESSURE_DROP_OLDEST):
+            raise ValueError(f"Unknown backpressure policy {backpressure_policy}")
+        self.queue_size = queue_size
+        self.backpressure_policy = backpressure_policy
+        self.encoding_profile = encoding_profile
+        self.preview_profile = preview_profile
+        self.write_queue = collections.deque()
+        self.queue_condition = threading.Condition()
+        self.jobs_in_progress = 0
+        self.is_closed = False
+        # Jobs not finished yet and holds not released yet, per folder
+        self.pending_jobs_per_folder = collections.Counter()
+        self.folder_callbacks = {} # Callbacks of sealed folders waiting for their jobs
+
+        self.submitted_count = 0
+        self.written_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+        self.max_queue_depth = 0
+        self.total_write_latency = 0.0 # Seconds from submission to image on disk
+
+        self.worker_list = []
+        for worker_id in range(worker_count):
+            worker = threading.Thread(target=self.process_write_queue,
+                                      name=f"image-writer-{worker_id}", daemon=True)
+            worker.start()
+            self.worker_list.append(worker)
+
+    def submit(self, image_file_directory, frame):
+        """
+        Hand over a frame to be encoded and written in the background.
+
+        Args:
+            image_file_directory (string) : the path to write the image to
+            frame (numpy.ndarray) : the captured frame
+
+        Returns:
+            bool : True if the frame was accepted, False if the StorageHandler is closed
+
+        """
+        return self.enqueue(ImageWriteJob(image_file_directory, frame=frame))
+
+    def submit_encoded(self, image_file_directory, encoded_image):
+        """
+        Hand over an image encoded on the camera to be written in the background.
+
+        Args:
+            image_file_directory (string) : the path to write the image to
+            encoded_image (bytes-like) : the encoded image
+
+        Returns:
+            bool : True if the image was accepted, False if the StorageHandler is closed
+
+        """
+        return self.enqueue(ImageWriteJob(image_file_directory, encoded_image=encoded_image))
+
+    def enqueue(self, write_job):
+        """
+        Put a job in the write queue, applying the backpressure policy if it is full.
+        A folder completed by dropping its last job is called back after the queue
+        condition was released.
+
+        Args:
+            write_job (ImageWriteJob) : the job to put in the queue
+
+        Returns:
+            bool : True if the job was accepted, False if the StorageHandler is closed
+
+        """
+        dropped_folder_callback = None
+        with self.queue_condition:
+            if self.is_closed:
+                return False
+            if len(self.write_queue) >= self.queue_size:
+                if self.backpressure_policy == self.BACKPRESSURE_DROP_OLDEST:
+                    dropped_job = self.write_queue.popleft()
+                    self.dropped_count += 1
+                    logging.warning("Write queue full. Dropped image %s",
+                                    dropped_job.image_file_directory)
+                    dropped_folder_callback = self.finish_job(dropped_job)
+                else:
+                    self.queue_condition.wait_for(
+                        lambda: len(self.write_queue) < self.queue_size or self.is_closed)
+                    if self.is_closed:
+                        return False
+            self.write_queue.append(write_job)
+            self.pending_jobs_per_folder[os.path.dirname(write_job.image_file_directory)] += 1
+            self.submitted_count += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.write_queue))
+            self.queue_condition.notify_all()
+        if dropped_folder_callback is not None:
+            self.run_folder_callback(*dropped_folder_callback)
+        return True
+
+    def process_write_queue(self):
+        """
+        Worker loop. Take frames from the queue and write them until the
+        StorageHandler is closed and the queue is empty.
+
+        """
+        while True:
+            with self.queue_condition:
+                self.queue_condition.wait_for(lambda: self.write_queue or self.is_closed)
+                if not self.write_queue:
+                    return
+                write_job = self.write_queue.popleft()
+                self.jobs_in_progress += 1
+                self.queue_condition.notify_all()
+
+            with REGISTRY.time_stage("imwrite"):
+                if write_job.frame is not None:
+                    is_written = self.write_image(write_job.image_file_directory,
+                                                  write_job.frame, self.encoding_profile)
+                else:
+                    is_written = self.write_encoded_image(write_job.image_file_directory,
+                                                          write_job.encoded_image)
+            REGISTRY.increment("images_written" if is_written else "image_write_failures")
+            if is_written and self.preview_profile is not None:
+                with REGISTRY.time_stage("preview_write"):
+                    self.write_preview(write_job.image_file_directory, self.preview_profile,
+                                       frame=write_job.frame,
+                                       encoded_image=write_job.encoded_image)
+
+            with self.queue_condition:
+                self.jobs_in_progress -= 1
+                if is_written:
+                    self.written_count += 1
+                    self.total_write_latency += time.monotonic() - write_job.submitted_time
+                else:
+                    self.failed_count += 1
+                folder_callback = self.finish_job(write_job)
+                self.queue_condition.notify_all()
+            # The callback can take a while, e.g. to commit to the spool index, so it
+            # runs without blocking the cameras and the other workers
+            if folder_callback is not None:
+                self.run_folder_callback(*folder_callback)
+
+    def finish_job(self, write_job):
+        """
+        Count a job of a folder as finished, whether it was written, failed or
+        dropped. Must be called with the queue condition held. The callback of a
+        sealed folder is returned instead of run, so the caller can run it after
+        releasing the queue condition.
+
+        Args:
+            write_job (ImageWriteJob) : the finished job
+
+        Returns:
+            tuple : the callback and the folder directory, if it was the last job of
+                    a sealed folder, otherwise None
+
+        """
+        return self.finish_folder_job(os.path.dirname(write_job.image_file_directory))
+
+    def finish_folder_job(self, folder_directory):
+        """
+        Count a job or a hold of a folder as finished. Must be called with the queue
+        condition held.
+
+        Returns:
+            tuple : the callback and the folder directory, if it was the last job of
+                    a sealed folder, otherwise None
+
+        """
+        self.pending_jobs_per_folder[folder_directory] -= 1
+        if self.pending_jobs_per_folder[folder_directory] > 0:
+            return None
+        del self.pending_jobs_per_folder[folder_directory]
+        callback = self.folder_callbacks.pop(folder_directory, None)
+        if callback is None:
+            return None
+        return callback, folder_directory
+
+    @staticmethod
+    def run_folder_callback(callback, folder_directory):
+        """
+        Call back for a complete folder, logging instead of raising errors so that
+        a faulty callback cannot stop a worker thread.
+
+        """
+        try:
+            callback(folder_directory)
+        except Exception:
+            logging.exception("Error in callback for folder %s", folder_directory)
+
+    def hold_folder(self, folder_directory, hold_count=1):
+        """
+        Keep a folder from being called back once it is sealed, until every hold is
+        released, e.g. while a capture may still submit images to it.
+
+        Args:
+            folder_directory (string) : the folder the images are written to
+            hold_count (int) : the number of holds to take
+
+        """
+        with self.queue_condition:
+            self.pending_jobs_per_folder[folder_directory] += hold_count
+
+    def release_folder(self, folder_directory):
+        """
+        Release a hold of a folder, and call back if the folder is sealed and this
+        was the last hold and nothing of it is waiting any more.
+
+        Args:
+            folder_directory (string) : the folder the images are written to
+
+        """
+        with self.queue_condition:
+            folder_callback = self.finish_folder_job(folder_directory)
+        if folder_callback is not None:
+            self.run_folder_callback(*folder_callback)
+
+    def seal_folder(self, folder_directory, callback):
+        """
+        Declare that all images of a folder have been submitted, and get called back
+        once they are all finished. The callback runs immediately if nothing of the
+        folder is waiting, otherwise on the worker thread that finishes the last image,
+        so it should return quickly.
+
+        Args:
+            folder_directory (string) : the folder the images are written to
+            callback (function) : called with the folder directory
+
+        """
+        with self.queue_condition:
+            if self.pending_jobs_per_folder[folder_directory] > 0:
+                self.folder_callbacks[folder_directory] = callback
+                return
+            del self.pending_jobs_per_folder[folder_directory]
+        self.run_folder_callback(callback, folder_directory)
+
+    @classmethod
+    def write_image(cls, image_file_directory, frame, encoding_profile=None):
+        """
+        Encode a frame and write it to disk.
+
+        Args:
+            image_file_directory (string) : the path to write the image to. With an
+                                            encoding profile, its file extension is
+                                            replaced by the one of the profile's format
+            frame (numpy.ndarray) : the frame to encode
+            encoding_profile (EncodingProfile) : the profile to encode the frame with.
+                                                None to encode by the file extension
+
+        Returns:
+            bool : True if the image was written
+
+        """
+        try:
+            if encoding_profile is not None:
+                image_file_directory = encoding_profile.get_image_file_directory(
+                    image_file_directory)
+                encoded_image = encoding_profile.encode(frame)
+                is_encoded = encoded_image is not None
+            else:
+                is_encoded, encoded_image = cv2.imencode(
+                    os.path.splitext(image_file_directory)[1], frame)
+        except Exception:
+            logging.exception("Could not encode image %s", image_file_directory)
+            return False
+        if not is_encoded:
+            logging.critical("Could not encode image %s", image_file_directory)
+            return False
+        return cls.write_encoded_image(image_file_directory, encoded_image)
+
+    @classmethod
+    def write_preview(cls, image_file_directory, preview_profile, frame=None,
+                      encoded_image=None):
+        """
+        Encode a low resolution preview copy of an image and write it to disk, next
+        to the image.
+
+        Args:
+            image_file_directory (string) : the path of the image
+            preview_profile (EncodingProfile) : the profile to encode the preview with
+            frame (numpy.ndarray) : the frame of the image
+            encoded_image (bytes-like) : the encoded image, decoded if frame is None
+
+        Returns:
+            bool : True if the preview was written
+
+        """
+        preview_file_directory = preview_profile.get_preview_file_directory(image_file_directory)
+        try:
+            if frame is None:
+                frame = cv2.imdecode(np.frombuffer(encoded_image, dtype=np.uint8),
+                                     cls.PREVIEW_DECODE_FLAG)
+            encoded_preview = preview_profile.encode(frame) if frame is not None else None
+        except Exception:
+            logging.exception("Could not encode preview %s", preview_file_directory)
+            return False
+        if encoded_preview is None:
+            logging.critical("Could not encode preview %s", preview_file_directory)
+            return False
+        return cls.write_encoded_image(preview_file_directory, encoded_preview)
+
+    @classmethod
+    def write_encoded_image(cls, image_file_directory, encoded_image):
+        """
+        Write an encoded image to disk. The image is written to a hidden
+        temporary file first, synced, and renamed once it is complete. The folder
+        is synced after the rename, so the new name survives a power cut.
+
+        Args:
+            image_file_directory (string) : the path to write the image to
+            encoded_image (bytes-like) : the encoded image
+
+        Returns:
+            bool : True if the image was written
+
+        """
+        saving_directory, image_file_name = os.path.split(image_file_directory)
+        temporary_file_directory = os.path.join(
+            saving_directory, cls.TEMPORARY_FILE_NAMING.format(image_file_name=image_file_name))
+        try:
+            with open(temporary_file_directory, "wb") as image_file:
+                image_file.write(memoryview(encoded_image))
+                image_file.flush()
+                os.fsync(image_file.fileno())
+            os.replace(temporary_file_directory, image_file_directory)
+            cls.sync_directory(saving_directory)
+        except Exception:
+            logging.exception("Could not write image %s", image_file_directory)
+            return False
+        logging.info("%s SAVED", image_file_directory)
+        return True
+
+    @staticmethod
+    def sync_directory(directory):
+        """
+        Flush the entries of a directory, such as a renamed file, to disk.
+
+        """
+        directory_descriptor = os.open(directory or ".", os.O_RDONLY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
+
+    def get_metrics(self):
+        """
+        Get the current state of the write queue.
+
+        Returns:
+            dict : the queue depth, the maximum queue depth seen so far, the number of
+                frames being written, and the number of frames submitted, written,
+                failed and dropped so far, and the average time from submission to
+                image on disk in seconds
+
+        """
+        with self.queue_condition:
+            return {"queue_depth": len(self.write_queue),
+                    "max_queue_depth": self.max_queue_depth,
+                    "jobs_in_progress": self.jobs_in_progress,
+                    "submitted": self.submitted_count,
+                    "written": self.written_count,
+                    "failed": self.failed_count,
+                    "dropped": self.dropped_count,
+                    "average_write_latency": (self.total_write_latency / self.written_count
+                                              if self.written_count else 0.0)}
+
+    def wait_until_idle(self, timeout=None):
+        """
+        Block until all submitted frames are written.
+
+        Args:
+            timeout (float) : the maximum time to wait, in seconds. None to wait forever
+
+        Returns:
+            bool : True if all submitted frames were written before the timeout
+
+        """
+        with self.queue_condition:
+            return self.queue_condition.wait_for(
+                lambda: not self.write_queue and self.jobs_in_progress == 0, timeout)
+
+    def close(self):
+        """
+        Stop accepting frames, write the frames still in the queue and stop the
+        worker threads.
+
+        """
+        with self.queue_condition:
+            self.is_closed = True
+            self.queue_condition.notify_all()
+        for worker in self.worker_list:
+            worker.join()
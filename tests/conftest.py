@@ -0,0 +1,15 @@
+"""
+Shared setup of the tests. The modules of the camera system sit at the top of the
+repository and import each other as top-level modules, so the repository is put
+on the import path.
+
+Typical usage example:
+
+    python3 -m pytest tests
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,118 @@
+"""
+Tests of adding and retiring cameras of the CameraHandler while images are
+captured, e.g. when a camera is detached from the USB bus.
+"""
+
+import threading
+import pytest
+from camera_handler import CameraHandler
+from capture_scheduler import CaptureScheduler
+
+CAMERA_POSITION_MAPPING = {0: "left", 1: "right"}
+
+class FakeCamera:
+    """
+    A camera whose capture returns at once, or blocks until it is released, as on
+    a device that was detached during the capture.
+    """
+
+    def __init__(self, camera_name, is_hanging=False):
+        self.camera_name = camera_name
+        self.is_hanging = is_hanging
+        self.release_event = threading.Event()
+        self.capture_count = 0
+        self.is_closed = False
+
+    def process_image(self, timestamp_saving_directory, date, timestamp):
+        self.capture_count += 1
+        if self.is_hanging:
+            self.release_event.wait(5.0)
+
+    def close(self):
+        self.is_closed = True
+
+class FakeDeviceInfo:
+    """
+    A DeviceInfo of a DepthAI device that is never opened.
+    """
+
+    def __init__(self, mx_id):
+        self.mx_id = mx_id
+
+    def getMxId(self):
+        return self.mx_id
+
+@pytest.fixture
+def make_camera_handler(tmp_path):
+    """
+    Make CameraHandlers that give up on captures after 0.3 s, and close them after
+    the test.
+    """
+    camera_handler_list = []
+
+    def make(kewazo_camera_object_list):
+        camera_handler = CameraHandler(
+            "LB1", str(tmp_path / "images"), 100, CAMERA_POSITION_MAPPING,
+            kewazo_camera_object_list=kewazo_camera_object_list,
+            capture_scheduler=CaptureScheduler(worker_count=2, camera_timeout=0.3))
+        camera_handler_list.append(camera_handler)
+        return camera_handler
+
+    yield make
+    for camera_handler in camera_handler_list:
+        camera_handler.close()
+
+def test_retired_camera_with_hung_capture_does_not_block_triggers(make_camera_handler):
+    left_camera = FakeCamera("left")
+    right_camera = FakeCamera("right", is_hanging=True)
+    camera_handler = make_camera_handler([left_camera, right_camera])
+    camera_handler.camera_object_by_mx_id = {"MX_LEFT": left_camera, "MX_RIGHT": right_camera}
+    try:
+        # The right camera is detached during the capture, which is given up on
+        camera_handler.process_images()
+        retire_thread = threading.Thread(target=camera_handler.retire_camera,
+                                         args=("MX_RIGHT",))
+        retire_thread.start()
+        retire_thread.join(2.0)
+        assert not retire_thread.is_alive()
+        assert camera_handler.kewazo_camera_object_list == [left_camera]
+        assert not right_camera.is_closed
+
+        trigger_thread = threading.Thread(target=camera_handler.process_images)
+        trigger_thread.start()
+        trigger_thread.join(2.0)
+        assert not trigger_thread.is_alive()
+        assert left_camera.capture_count == 2
+        assert right_camera.capture_count == 1
+    finally:
+        right_camera.release_event.set()
+
+    assert camera_handler.capture_scheduler.wait_for_camera(right_camera, 5.0)
+    for retire_thread in camera_handler.retire_thread_list:
+        retire_thread.join(5.0)
+    assert right_camera.is_closed
+
+def test_reattached_cameras_keep_their_positions(make_camera_handler):
+    camera_handler = make_camera_handler([])
+    for mx_id in ("MX_A", "MX_B"):
+        camera_handler.add_camera(FakeDeviceInfo(mx_id))
+    assert camera_handler.get_camera_by_mx_id("MX_A").camera_name == "left"
+    assert camera_handler.get_camera_by_mx_id("MX_B").camera_name == "right"
+
+    # Both cameras drop off, and are found again in the opposite order
+    camera_handler.retire_camera("MX_A")
+    camera_handler.retire_camera("MX_B")
+    assert camera_handler.kewazo_camera_object_list == []
+    for mx_id in ("MX_B", "MX_A"):
+        camera_handler.add_camera(FakeDeviceInfo(mx_id))
+    assert camera_handler.get_camera_by_mx_id("MX_A").camera_name == "left"
+    assert camera_handler.get_camera_by_mx_id("MX_B").camera_name == "right"
+
+def test_new_device_takes_position_of_retired_device(make_camera_handler):
+    camera_handler = make_camera_handler([])
+    for mx_id in ("MX_A", "MX_B"):
+        camera_handler.add_camera(FakeDeviceInfo(mx_id))
+    # The left camera is replaced by another device
+    camera_handler.retire_camera("MX_A")
+    assert camera_handler.add_camera(FakeDeviceInfo("MX_C")).camera_name == "left"
+    assert camera_handler.add_camera(FakeDeviceInfo("MX_A")) is None
@@ -0,0 +1,74 @@
+"""
+Tests of the RmSpeedListener on a virtual CAN bus.
+"""
+
+import time
+import can
+import pytest
+from can_bus_handler import CanBusHandler, RmSpeedListener
+
+RM_CAN_ID = 0x3A0
+
+def make_rm_speed_message(rm_speed):
+    """
+    Build a CAN message from the RM that carries an RM speed in its last 4 bytes.
+    """
+    return can.Message(arbitration_id=RM_CAN_ID, is_extended_id=False,
+                       data=b"\x00\x00\x00\x00" + rm_speed.to_bytes(4, "little", signed=True))
+
+@pytest.fixture
+def virtual_can(request):
+    """
+    Listen on a virtual CAN channel with an RmSpeedListener, and yield the listener
+    and a bus to send RM messages on.
+    """
+    channel = f"test_{request.node.name}"
+    receiving_bus = CanBusHandler.setup_can([RM_CAN_ID], channel=channel, interface="virtual")
+    sending_bus = can.interface.Bus(channel=channel, interface="virtual")
+    rm_speed_listener = RmSpeedListener()
+    notifier = can.Notifier(receiving_bus, [rm_speed_listener])
+    yield rm_speed_listener, sending_bus
+    notifier.stop()
+    sending_bus.shutdown()
+    receiving_bus.shutdown()
+
+def wait_for_received_count(rm_speed_listener, received_count, timeout=2.0):
+    """
+    Wait until the listener received a number of CAN messages.
+    """
+    deadline = time.monotonic() + timeout
+    while rm_speed_listener.get_metrics()["received"] < received_count:
+        assert time.monotonic() < deadline, "CAN messages did not arrive"
+        time.sleep(0.01)
+
+def test_decode_rm_speed_is_little_endian_and_signed():
+    assert CanBusHandler.decode_rm_speed(make_rm_speed_message(-120)) == -120
+    assert CanBusHandler.decode_rm_speed(make_rm_speed_message(400000)) == 400000
+
+def test_wait_for_latest_takes_the_freshest_speed(virtual_can):
+    rm_speed_listener, sending_bus = virtual_can
+    for rm_speed in (10, 20, 30):
+        sending_bus.send(make_rm_speed_message(rm_speed))
+    wait_for_received_count(rm_speed_listener, 3)
+
+    _, rm_speed = rm_speed_listener.wait_for_latest(timeout=1.0)
+
+    assert rm_speed == 30
+    assert rm_speed_listener.get_metrics()["overrun"] == 2
+    assert [speed for _, speed in rm_speed_listener.get_recent_speeds()] == [10, 20, 30]
+
+def test_wait_for_latest_does_not_return_a_speed_twice(virtual_can):
+    rm_speed_listener, sending_bus = virtual_can
+    sending_bus.send(make_rm_speed_message(50))
+    wait_for_received_count(rm_speed_listener, 1)
+
+    assert rm_speed_listener.wait_for_latest(timeout=1.0)[1] == 50
+    assert rm_speed_listener.wait_for_latest(timeout=0.05) is None
+
+def test_messages_without_speed_are_dropped(virtual_can):
+    rm_speed_listener, sending_bus = virtual_can
+    sending_bus.send(can.Message(arbitration_id=RM_CAN_ID, is_extended_id=False, data=b""))
+    wait_for_received_count(rm_speed_listener, 1)
+
+    assert rm_speed_listener.get_metrics()["dropped"] == 1
+    assert rm_speed_listener.wait_for_latest(timeout=0.05) is None
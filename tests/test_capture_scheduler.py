@@ -0,0 +1,124 @@
+"""
+Tests of the CaptureScheduler timeout, replacement workers and busy cameras.
+"""
+
+import threading
+import pytest
+from capture_scheduler import CaptureScheduler, CaptureJob
+
+class FakeCamera:
+    """
+    A camera whose capture takes a set time, or blocks until it is released.
+    """
+
+    def __init__(self, camera_name, capture_time=0.0):
+        self.camera_name = camera_name
+        self.capture_time = capture_time
+        self.release_event = threading.Event()
+        self.capture_count = 0
+
+    def process_image(self, outcome):
+        self.capture_count += 1
+        if self.capture_time is None:
+            self.release_event.wait(5.0)
+        else:
+            self.release_event.wait(self.capture_time)
+        return outcome
+
+@pytest.fixture
+def capture_scheduler():
+    """
+    A started CaptureScheduler with one worker, that gives up on captures after 0.3 s.
+    """
+    capture_scheduler = CaptureScheduler(worker_count=1, camera_timeout=0.3)
+    capture_scheduler.start()
+    yield capture_scheduler
+    capture_scheduler.close()
+
+class CallbackRecorder:
+    """
+    A finished callback that records the jobs it is called with.
+    """
+
+    def __init__(self):
+        self.job_list = []
+        self.callback_condition = threading.Condition()
+
+    def __call__(self, job):
+        with self.callback_condition:
+            self.job_list.append(job)
+            self.callback_condition.notify_all()
+
+    def wait_for_call_count(self, call_count):
+        with self.callback_condition:
+            return self.callback_condition.wait_for(lambda: len(self.job_list) >= call_count,
+                                                    5.0)
+
+def test_all_cameras_capture(capture_scheduler):
+    camera_list = [FakeCamera("LB1_left"), FakeCamera("LB1_right")]
+    callback_recorder = CallbackRecorder()
+    job_list = capture_scheduler.capture(camera_list, ("saved",), callback_recorder)
+
+    assert [job.state for job in job_list] == [CaptureJob.STATE_DONE] * 2
+    assert [job.outcome for job in job_list] == ["saved"] * 2
+    assert callback_recorder.wait_for_call_count(2)
+    assert sorted(job.camera_object.camera_name for job in callback_recorder.job_list) == \
+        ["LB1_left", "LB1_right"]
+
+def test_timeout_gives_up_and_replacement_worker_keeps_capturing(capture_scheduler):
+    stuck_camera = FakeCamera("LB1_stuck", capture_time=None)
+    other_camera = FakeCamera("LB1_other")
+    callback_recorder = CallbackRecorder()
+    try:
+        stuck_job, = capture_scheduler.capture([stuck_camera], ("saved",), callback_recorder)
+        assert stuck_job.state == CaptureJob.STATE_TIMED_OUT
+        assert capture_scheduler.get_metrics()["timed_out"] == 1
+        # The only worker is stuck, the replacement worker takes the next capture
+        other_job, = capture_scheduler.capture([other_camera], ("saved",))
+        assert other_job.state == CaptureJob.STATE_DONE
+        assert callback_recorder.job_list == []
+    finally:
+        stuck_camera.release_event.set()
+
+    assert callback_recorder.wait_for_call_count(1)
+    assert callback_recorder.job_list == [stuck_job]
+    assert stuck_job.outcome == "saved"
+
+def test_busy_camera_is_skipped_and_waited_for(capture_scheduler):
+    stuck_camera = FakeCamera("LB1_stuck", capture_time=None)
+    callback_recorder = CallbackRecorder()
+    try:
+        capture_scheduler.capture([stuck_camera], ("saved",))
+        skipped_job, = capture_scheduler.capture([stuck_camera], ("saved",),
+                                                 callback_recorder)
+        assert skipped_job.state == CaptureJob.STATE_SKIPPED
+        assert callback_recorder.job_list == [skipped_job]
+        assert stuck_camera.capture_count == 1
+        assert not capture_scheduler.wait_for_camera(stuck_camera, timeout=0.1)
+    finally:
+        stuck_camera.release_event.set()
+
+    assert capture_scheduler.wait_for_camera(stuck_camera, timeout=5.0)
+    assert capture_scheduler.get_metrics()["busy_cameras"] == 0
+    job, = capture_scheduler.capture([stuck_camera], ("saved",))
+    assert job.state == CaptureJob.STATE_DONE
+
+def test_queued_capture_is_given_up_on_without_starting():
+    capture_scheduler = CaptureScheduler(worker_count=1, hub_bandwidth=1, camera_timeout=0.3)
+    capture_scheduler.start()
+    first_camera = FakeCamera("LB1_first", capture_time=None)
+    second_camera = FakeCamera("LB1_second")
+    # Both cameras on one hub that carries one capture at once
+    second_camera.camera_name = first_camera.camera_name
+    callback_recorder = CallbackRecorder()
+    try:
+        first_job, second_job = capture_scheduler.capture([first_camera, second_camera],
+                                                          ("saved",), callback_recorder)
+        assert first_job.state == second_job.state == CaptureJob.STATE_TIMED_OUT
+        assert second_job.started_time is None
+        assert second_camera.capture_count == 0
+        assert callback_recorder.job_list == [second_job]
+    finally:
+        first_camera.release_event.set()
+        capture_scheduler.close()
+    assert callback_recorder.wait_for_call_count(2)
@@ -0,0 +1,82 @@
+"""
+Tests of the CentralHandler setting the CAN bus up again after bus errors.
+"""
+
+import time
+import can
+import pytest
+from central_handler import CentralHandler
+from test_can_bus_handler import RM_CAN_ID, make_rm_speed_message
+
+@pytest.fixture
+def central_handler(request):
+    """
+    A CentralHandler reading a virtual CAN channel, and a bus to send RM messages on.
+    """
+    channel = f"test_{request.node.name}"
+    central_handler = CentralHandler("LB1", "ssh_pass", 22, "dashboard", "127.0.0.1",
+                                     "./images", 60, {0: "left"}, [RM_CAN_ID],
+                                     can_channel=channel, can_interface="virtual")
+    central_handler.can_notifier = can.Notifier(central_handler.can_handler,
+                                                [central_handler.rm_speed_listener])
+    sending_bus = can.interface.Bus(channel=channel, interface="virtual")
+    yield central_handler, sending_bus
+    if central_handler.can_notifier is not None:
+        central_handler.can_notifier.stop()
+    if central_handler.can_handler is not None:
+        central_handler.can_handler.shutdown()
+    sending_bus.shutdown()
+
+def break_can_bus(can_bus):
+    """
+    Make a CAN bus raise an error once, then read nothing any more, as a bus whose
+    CAN interface went down.
+    """
+    has_raised = []
+
+    def broken_recv(timeout=None):
+        if not has_raised:
+            has_raised.append(True)
+            raise can.CanOperationError("Network is down")
+        time.sleep(timeout or 0.01)
+        return None
+    can_bus.recv = broken_recv
+
+def wait_for_bus_error(rm_speed_listener, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while rm_speed_listener.get_metrics()["bus_errors"] == 0:
+        assert time.monotonic() < deadline, "Bus error was not reported"
+        time.sleep(0.01)
+
+def test_messages_arrive_after_reconnecting(central_handler):
+    central_handler, sending_bus = central_handler
+    rm_speed_listener = central_handler.rm_speed_listener
+    assert not central_handler.is_can_reconnect_needed()
+
+    break_can_bus(central_handler.can_handler)
+    wait_for_bus_error(rm_speed_listener)
+    sending_bus.send(make_rm_speed_message(10))
+    assert rm_speed_listener.wait_for_latest(timeout=0.2) is None
+    assert central_handler.is_can_reconnect_needed()
+
+    assert central_handler.reconnect_can()
+    assert not central_handler.is_can_reconnect_needed()
+    sending_bus.send(make_rm_speed_message(20))
+    assert rm_speed_listener.wait_for_latest(timeout=2.0)[1] == 20
+
+def test_failed_reconnect_is_tried_again(central_handler, monkeypatch):
+    central_handler, sending_bus = central_handler
+    break_can_bus(central_handler.can_handler)
+    wait_for_bus_error(central_handler.rm_speed_listener)
+
+    def failing_setup_can(**kwargs):
+        raise can.CanInitializationError("No such device")
+    with monkeypatch.context() as patch_context:
+        patch_context.setattr("central_handler.CanBusHandler.setup_can", failing_setup_can)
+        assert not central_handler.reconnect_can()
+    assert central_handler.can_notifier is None
+    assert central_handler.is_can_reconnect_needed()
+
+    assert central_handler.reconnect_can(is_first_attempt=False)
+    sending_bus.send(make_rm_speed_message(30))
+    assert central_handler.rm_speed_listener.wait_for_latest(timeout=2.0)[1] == 30
@@ -0,0 +1,73 @@
+"""
+Tests of how the SshTransport finds the files of a partially failed rsync that
+are on the server.
+"""
+
+import subprocess
+import pytest
+from dashboard_transport import SshTransport
+
+RELATIVE_FILE_LIST = ["230717/130450/LB1_left.jpg", "230717/130450/LB1_right.jpg",
+                      "230717/130455/LB1_left.jpg"]
+
+# Itemized by rsync -ii: a new file, a file already on the server, and a folder
+ITEMIZED_OUTPUT = ("cd+++++++++ 230717/130450/\n"
+                   "<f+++++++++ 230717/130450/LB1_left.jpg\n"
+                   ".f          230717/130450/LB1_right.jpg\n")
+
+class FakeRsyncTransport(SshTransport):
+    """
+    An SshTransport that is always connected and answers every command with the
+    given rsync result instead of running it.
+    """
+
+    def __init__(self, returncode, stdout="", stderr=""):
+        super().__init__("ssh_pass", 22, "liftbot", "127.0.0.1")
+        self.result = subprocess.CompletedProcess([], returncode, stdout, stderr)
+
+    def ensure_connected(self):
+        return True
+
+    def run_command(self, command, timeout, input_text=None):
+        return self.result
+
+def test_parse_confirmed_files_keeps_itemized_regular_files():
+    confirmed_file_list = SshTransport.parse_confirmed_files(ITEMIZED_OUTPUT, "",
+                                                             RELATIVE_FILE_LIST)
+
+    assert confirmed_file_list == RELATIVE_FILE_LIST[:2]
+
+def test_parse_confirmed_files_drops_files_named_in_errors():
+    error_output = ('rsync: [sender] read errors mapping "/images/230717/130450/LB1_left.jpg":'
+                    ' Input/output error (5)\n')
+
+    confirmed_file_list = SshTransport.parse_confirmed_files(ITEMIZED_OUTPUT, error_output,
+                                                             RELATIVE_FILE_LIST)
+
+    assert confirmed_file_list == ["230717/130450/LB1_right.jpg"]
+
+@pytest.mark.parametrize("returncode, error_output", [
+    (23, 'rsync: [sender] send_files failed to open "/images/230717/130455/LB1_left.jpg": '
+         'Permission denied (13)\n'),
+    (24, 'file has vanished: "/images/230717/130455/LB1_left.jpg"\n')])
+def test_send_files_confirms_itemized_files_on_partial_transfer(tmp_path, returncode,
+                                                                error_output):
+    fake_rsync_transport = FakeRsyncTransport(returncode, ITEMIZED_OUTPUT, error_output)
+
+    confirmed_file_list = fake_rsync_transport.send_files(str(tmp_path), RELATIVE_FILE_LIST,
+                                                          "images/LB1")
+
+    assert confirmed_file_list == RELATIVE_FILE_LIST[:2]
+
+def test_send_files_confirms_nothing_on_other_errors(tmp_path):
+    fake_rsync_transport = FakeRsyncTransport(12, ITEMIZED_OUTPUT,
+                                              "rsync error: error in rsync protocol data stream")
+
+    assert fake_rsync_transport.send_files(str(tmp_path), RELATIVE_FILE_LIST,
+                                           "images/LB1") == []
+
+def test_send_files_confirms_everything_on_success(tmp_path):
+    fake_rsync_transport = FakeRsyncTransport(0, ITEMIZED_OUTPUT)
+
+    assert fake_rsync_transport.send_files(str(tmp_path), RELATIVE_FILE_LIST,
+                                           "images/LB1") == RELATIVE_FILE_LIST
@@ -0,0 +1,57 @@
+"""
+Tests of the RmMotionDetector filtering and hysteresis.
+"""
+
+from motion_detector import RmMotionDetector
+
+def feed(motion_detector, rm_speed_list):
+    """
+    Feed RM speeds to a detector and get the indexes at which it saw an RM start.
+    """
+    return [rm_speed_index for rm_speed_index, rm_speed in enumerate(rm_speed_list)
+            if motion_detector.update(rm_speed)]
+
+def test_start_needs_consecutive_filtered_speeds_above_threshold():
+    motion_detector = RmMotionDetector(start_speed_threshold=60)
+
+    # The median of 0, 100 stays 50 and of 0, 100, 100 is 100: the start needs
+    # 2 filtered samples above 60, at the 4th speed
+    assert feed(motion_detector, [0, 100, 100, 100, 100]) == [3]
+    assert motion_detector.is_moving
+
+def test_single_spike_does_not_start():
+    motion_detector = RmMotionDetector(start_speed_threshold=60)
+
+    assert feed(motion_detector, [0, 0, 0, 300, 0, 0, 0]) == []
+    assert not motion_detector.is_moving
+
+def test_one_start_per_movement_with_hysteresis():
+    motion_detector = RmMotionDetector(start_speed_threshold=60)
+    feed(motion_detector, [100] * 5)
+
+    # Between the stop threshold of 30 and the start threshold the RM stays moving
+    assert feed(motion_detector, [45] * 5) == []
+    assert motion_detector.is_moving
+
+    # Below the stop threshold the RM stops, and the next movement is a new start
+    assert feed(motion_detector, [0] * 5) == []
+    assert not motion_detector.is_moving
+    assert len(feed(motion_detector, [100] * 5)) == 1
+
+def test_invalid_speeds_are_rejected_and_garbage_resets():
+    motion_detector = RmMotionDetector(start_speed_threshold=60)
+    feed(motion_detector, [100] * 5)
+
+    # Out of range values are ignored, a few garbage values keep the state
+    assert feed(motion_detector, [5000, -400000]) == []
+    assert motion_detector.is_moving
+
+    # A full window of garbage values means the RM is stationary
+    feed(motion_detector, [400000] * RmMotionDetector.DEFAULT_WINDOW_SIZE)
+    assert not motion_detector.is_moving
+    assert motion_detector.filtered_speed == 0.0
+
+def test_negative_speeds_move_the_rm_too():
+    motion_detector = RmMotionDetector(start_speed_threshold=60)
+
+    assert feed(motion_detector, [-100] * 5) == [1]
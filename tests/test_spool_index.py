@@ -0,0 +1,91 @@
+"""
+Tests of the SpoolIndex surviving a restart of the camera system, and of the
+recovery of the saving directories from it at startup.
+"""
+
+import os
+import time
+import pytest
+from spool_index import SpoolIndex
+from dashboard_handler import DashboardHandler
+from dashboard_transport import LocalDirectoryTransport
+
+def write_images(timestamp_folder_directory, image_file_name_list):
+    """
+    Write small fake images to a timestamp folder.
+    """
+    os.makedirs(timestamp_folder_directory, exist_ok=True)
+    for image_file_name in image_file_name_list:
+        with open(os.path.join(timestamp_folder_directory, image_file_name), "wb") as image_file:
+            image_file.write(b"\xff\xd8" + image_file_name.encode() + b"\xff\xd9")
+
+@pytest.fixture
+def images_directory(tmp_path):
+    """
+    The top folder for saving images, with the database file of the spool index in it.
+    """
+    return str(tmp_path / "images")
+
+def open_spool_index(images_directory):
+    """
+    Open the spool index in the top folder for saving images.
+    """
+    return SpoolIndex(os.path.join(images_directory, SpoolIndex.DATABASE_FILE_NAME),
+                      images_directory)
+
+def test_states_survive_reopening(images_directory):
+    timestamp_folder_directory = os.path.join(images_directory, "230717", "130450")
+    write_images(timestamp_folder_directory, ["LB1_left.jpg", "LB1_right.jpg",
+                                              ".LB1_back.jpg.part"])
+    spool_index = open_spool_index(images_directory)
+    assert spool_index.record_folder(timestamp_folder_directory, SpoolIndex.STATE_QUEUED) == 2
+    spool_index.set_state(["230717/130450/LB1_left.jpg"], SpoolIndex.STATE_UPLOADED)
+    spool_index.close()
+
+    spool_index = open_spool_index(images_directory)
+    try:
+        assert spool_index.get_state_counts() == {SpoolIndex.STATE_QUEUED: 1,
+                                                  SpoolIndex.STATE_UPLOADED: 1}
+        assert spool_index.get_pending_folders() == [timestamp_folder_directory]
+        assert [relative_file for relative_file, _ in spool_index.get_pending_images(
+            timestamp_folder_directory)] == ["230717/130450/LB1_right.jpg"]
+        assert spool_index.get_images_in_state(SpoolIndex.STATE_UPLOADED) == \
+            ["230717/130450/LB1_left.jpg"]
+        # Recording the folder again keeps the states
+        assert spool_index.record_folder(timestamp_folder_directory) == 0
+        assert spool_index.get_state_counts()[SpoolIndex.STATE_UPLOADED] == 1
+    finally:
+        spool_index.close()
+
+def test_recover_spool_after_restart(images_directory, tmp_path):
+    sent_folder_directory = os.path.join(images_directory, "230717", "130450")
+    write_images(sent_folder_directory, ["LB1_left.jpg", "LB1_right.jpg"])
+    spool_index = open_spool_index(images_directory)
+    spool_index.record_folder(sent_folder_directory, SpoolIndex.STATE_QUEUED)
+    # The last run stopped after the images were confirmed, before they were erased
+    spool_index.set_state(["230717/130450/LB1_left.jpg", "230717/130450/LB1_right.jpg"],
+                          SpoolIndex.STATE_UPLOADED)
+    spool_index.close()
+
+    # Images written by a camera system without a spool index, long enough ago
+    unindexed_folder_directory = os.path.join(images_directory, "230717", "130500")
+    write_images(unindexed_folder_directory, ["LB1_left.jpg"])
+    settled_time = time.time() - DashboardHandler.FOLDER_SETTLE_TIME - 1
+    os.utime(unindexed_folder_directory, (settled_time, settled_time))
+
+    spool_index = open_spool_index(images_directory)
+    dashboard_handler = DashboardHandler(
+        "LB1", None, None, None, None, "images", images_directory,
+        dashboard_transport=LocalDirectoryTransport(str(tmp_path / "server")),
+        spool_index=spool_index)
+    try:
+        dashboard_handler.recover_spool()
+
+        # The folder itself is only erased once it settled
+        assert os.listdir(sent_folder_directory) == []
+        assert spool_index.get_state_counts() == {SpoolIndex.STATE_DELETED: 2,
+                                                  SpoolIndex.STATE_CAPTURED: 1}
+        assert spool_index.get_pending_folders() == [unindexed_folder_directory]
+    finally:
+        dashboard_handler.close()
+        spool_index.close()
@@ -0,0 +1,202 @@
+"""
+Tests of the HttpUploadTransport sending files to the UploadReceiver, resuming
+from the offset the receiver reports.
+"""
+
+import os
+import socket
+import pytest
+from upload_receiver import UploadReceiver
+from dashboard_transport import HttpUploadTransport
+
+TOKEN = "secret-token"
+CHUNK_SIZE = 1024 # Bytes per chunk, small to send a file in several chunks
+RELATIVE_FILE = "230717/130450/LB1_left.jpg"
+DASHBOARD_DIRECTORY = "LB1/images"
+
+class RecordingTransport(HttpUploadTransport):
+    """
+    An HttpUploadTransport that records the offsets of the chunks it sends.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_offset_list = []
+
+    def request(self, method, path, body=None, headers=None):
+        if method == "PATCH":
+            self.chunk_offset_list.append(int(headers[self.OFFSET_HEADER]))
+        return super().request(method, path, body, headers)
+
+@pytest.fixture
+def upload_receiver(tmp_path):
+    """
+    A started UploadReceiver on a free port that requires the token.
+    """
+    upload_receiver = UploadReceiver(str(tmp_path / "server"), port=0, token=TOKEN,
+                                     max_chunk_size=CHUNK_SIZE)
+    upload_receiver.start()
+    yield upload_receiver
+    upload_receiver.close()
+
+@pytest.fixture
+def local_top_directory(tmp_path):
+    """
+    The top folder for saving images, with an image of a few chunks in it.
+    """
+    local_file = tmp_path / "images" / RELATIVE_FILE
+    local_file.parent.mkdir(parents=True)
+    local_file.write_bytes(os.urandom(CHUNK_SIZE * 4 + 100))
+    return str(tmp_path / "images")
+
+def make_transport(upload_receiver, tmp_path, token=TOKEN):
+    """
+    Make a transport to the receiver that sends the token.
+    """
+    token_file = tmp_path / "token"
+    token_file.write_text(token + "\n", encoding="utf-8")
+    # Chunks are sent one at a time, so that their order is known
+    return RecordingTransport(f"http://127.0.0.1:{upload_receiver.get_port()}",
+                              str(token_file), chunk_size=CHUNK_SIZE, chunk_concurrency=1)
+
+def read_local_file(local_top_directory):
+    with open(os.path.join(local_top_directory, RELATIVE_FILE), "rb") as local_file:
+        return local_file.read()
+
+def get_server_file(upload_receiver):
+    return upload_receiver.get_local_path(f"{DASHBOARD_DIRECTORY}/{RELATIVE_FILE}")
+
+def test_transfer_resumes_from_head_offset(upload_receiver, local_top_directory, tmp_path):
+    content = read_local_file(local_top_directory)
+    server_file = get_server_file(upload_receiver)
+    # A transfer cut after the first two chunks, which arrived out of order
+    upload_receiver.write_chunk(server_file, CHUNK_SIZE, content[CHUNK_SIZE:CHUNK_SIZE * 2])
+    upload_receiver.write_chunk(server_file, 0, content[:CHUNK_SIZE])
+
+    progress_list = []
+    http_upload_transport = make_transport(upload_receiver, tmp_path)
+    try:
+        confirmed_file_list = http_upload_transport.send_files(
+            local_top_directory, [RELATIVE_FILE], DASHBOARD_DIRECTORY,
+            progress_callback=lambda relative_file, byte_count: progress_list.append(byte_count))
+    finally:
+        http_upload_transport.close()
+
+    assert confirmed_file_list == [RELATIVE_FILE]
+    assert http_upload_transport.chunk_offset_list == [CHUNK_SIZE * 2, CHUNK_SIZE * 3,
+                                                       CHUNK_SIZE * 4]
+    assert progress_list[0] == CHUNK_SIZE * 2
+    assert sum(progress_list) == len(content)
+    with open(server_file, "rb") as received_file:
+        assert received_file.read() == content
+    assert not os.path.exists(server_file + UploadReceiver.PARTIAL_FILE_SUFFIX)
+    assert not os.path.exists(server_file + UploadReceiver.RANGES_FILE_SUFFIX)
+
+def test_complete_file_is_not_sent_again(upload_receiver, local_top_directory, tmp_path):
+    http_upload_transport = make_transport(upload_receiver, tmp_path)
+    try:
+        assert http_upload_transport.send_files(local_top_directory, [RELATIVE_FILE],
+                                                DASHBOARD_DIRECTORY) == [RELATIVE_FILE]
+        http_upload_transport.chunk_offset_list.clear()
+        assert http_upload_transport.send_files(local_top_directory, [RELATIVE_FILE],
+                                                DASHBOARD_DIRECTORY) == [RELATIVE_FILE]
+    finally:
+        http_upload_transport.close()
+    assert http_upload_transport.chunk_offset_list == []
+
+def test_corrupted_partial_file_is_sent_again(upload_receiver, local_top_directory, tmp_path):
+    content = read_local_file(local_top_directory)
+    server_file = get_server_file(upload_receiver)
+    # A first chunk that was damaged on the disk of the server after it was checked
+    upload_receiver.write_chunk(server_file, 0, bytes(CHUNK_SIZE))
+
+    http_upload_transport = make_transport(upload_receiver, tmp_path)
+    try:
+        # Completing the file answers 409, and the partial file is dropped
+        assert http_upload_transport.send_files(local_top_directory, [RELATIVE_FILE],
+                                                DASHBOARD_DIRECTORY) == []
+        assert not os.path.exists(server_file + UploadReceiver.PARTIAL_FILE_SUFFIX)
+        assert not os.path.exists(server_file)
+        http_upload_transport.chunk_offset_list.clear()
+        assert http_upload_transport.send_files(local_top_directory, [RELATIVE_FILE],
+                                                DASHBOARD_DIRECTORY) == [RELATIVE_FILE]
+    finally:
+        http_upload_transport.close()
+    assert http_upload_transport.chunk_offset_list[0] == 0
+    with open(server_file, "rb") as received_file:
+        assert received_file.read() == content
+
+def test_wrong_token_is_refused(upload_receiver, local_top_directory, tmp_path):
+    http_upload_transport = make_transport(upload_receiver, tmp_path, token="wrong-token")
+    try:
+        assert http_upload_transport.send_files(local_top_directory, [RELATIVE_FILE],
+                                                DASHBOARD_DIRECTORY) == []
+        assert http_upload_transport.measure_round_trip_time() is None
+    finally:
+        http_upload_transport.close()
+    assert http_upload_transport.chunk_offset_list == []
+    assert not os.path.exists(os.path.dirname(get_server_file(upload_receiver)))
+
+def send_raw_request(upload_receiver, method, headers):
+    """
+    Send the headers of a request without its body over a new connection, and read
+    the response until the receiver closes the connection.
+
+    Returns:
+        tuple : the status (bytes) and the whole response (bytes)
+
+    """
+    request = (f"{method} {HttpUploadTransport.FILES_PATH}{DASHBOARD_DIRECTORY}/{RELATIVE_FILE}"
+               " HTTP/1.1\r\nHost: 127.0.0.1\r\n" +
+               "".join(f"{header_name}: {header_value}\r\n"
+                       for header_name, header_value in headers.items()) + "\r\n")
+    with socket.create_connection(("127.0.0.1", upload_receiver.get_port()), timeout=5) \
+            as client_socket:
+        client_socket.sendall(request.encode("ascii"))
+        response = client_socket.makefile("rb").read()
+    status_line, _, _ = response.partition(b"\r\n")
+    return status_line.split()[1], response
+
+def make_chunk_headers(content_length):
+    """
+    Make the headers of a chunk at the start of a file, with the given Content-Length.
+    """
+    chunk_headers = {"Authorization": f"Bearer {TOKEN}",
+                     HttpUploadTransport.OFFSET_HEADER: "0",
+                     HttpUploadTransport.LENGTH_HEADER: str(CHUNK_SIZE * 4)}
+    if content_length is not None:
+        chunk_headers["Content-Length"] = content_length
+    return chunk_headers
+
+def test_chunk_larger_than_max_chunk_size_is_refused(upload_receiver):
+    # Only the headers are sent, the receiver must answer without reading the body
+    status, response = send_raw_request(upload_receiver, "PATCH",
+                                        make_chunk_headers(str(CHUNK_SIZE * 4)))
+    assert status == b"413"
+    assert b"Connection: close" in response
+    assert not os.path.exists(get_server_file(upload_receiver) +
+                              UploadReceiver.PARTIAL_FILE_SUFFIX)
+
+@pytest.mark.parametrize("content_length, expected_status", [
+    ("-1", b"400"), ("abc", b"400"), (None, b"411")])
+def test_chunk_without_valid_content_length_is_refused(upload_receiver, content_length,
+                                                       expected_status):
+    # A negative Content-Length must not make the receiver read until the client closes
+    status, response = send_raw_request(upload_receiver, "PATCH",
+                                        make_chunk_headers(content_length))
+    assert status == expected_status
+    assert b"Connection: close" in response
+    assert not os.path.exists(get_server_file(upload_receiver) +
+                              UploadReceiver.PARTIAL_FILE_SUFFIX)
+
+@pytest.mark.parametrize("method", ["PATCH", "POST"])
+def test_invalid_content_length_without_token_is_refused(upload_receiver, method):
+    status, response = send_raw_request(upload_receiver, method, {"Content-Length": "abc"})
+    assert status == b"401"
+    assert b"Connection: close" in response
+
+def test_invalid_content_length_is_refused_when_completing(upload_receiver):
+    headers = make_chunk_headers("-5")
+    headers[HttpUploadTransport.HASH_HEADER] = "0" * 64
+    status, _ = send_raw_request(upload_receiver, "POST", headers)
+    assert status == b"400"
@@ -0,0 +1,90 @@
+"""
+Tests of the UploadScheduler priorities and of the ConcurrencyController.
+"""
+
+import threading
+from upload_scheduler import UploadScheduler, UploadJob, ConcurrencyController
+
+class BlockingSender:
+    """
+    A send function that records every batch it is given, and holds the batches of
+    backlog jobs until it is released.
+    """
+
+    def __init__(self):
+        self.batch_list = []
+        self.batch_condition = threading.Condition()
+        self.backlog_release_event = threading.Event()
+
+    def __call__(self, upload_job_list, bandwidth_limit):
+        with self.batch_condition:
+            self.batch_list.append([job.timestamp_folder_directory for job in upload_job_list])
+            self.batch_condition.notify_all()
+        if upload_job_list[0].priority == UploadJob.PRIORITY_BACKLOG:
+            self.backlog_release_event.wait(5.0)
+        return 0
+
+    def wait_for_batch_count(self, batch_count):
+        with self.batch_condition:
+            return self.batch_condition.wait_for(lambda: len(self.batch_list) >= batch_count,
+                                                 5.0)
+
+def test_live_job_is_sent_while_backlog_blocks_all_transfers():
+    blocking_sender = BlockingSender()
+    upload_scheduler = UploadScheduler(blocking_sender, max_concurrency=1)
+    upload_scheduler.start()
+    try:
+        upload_scheduler.submit("backlog/1", UploadJob.PRIORITY_BACKLOG)
+        assert blocking_sender.wait_for_batch_count(1)
+        upload_scheduler.submit("backlog/2", UploadJob.PRIORITY_BACKLOG)
+        upload_scheduler.submit("live/1", UploadJob.PRIORITY_LIVE)
+
+        # The live job takes the reserved slot, the second backlog job waits
+        assert blocking_sender.wait_for_batch_count(2)
+        assert blocking_sender.batch_list == [["backlog/1"], ["live/1"]]
+    finally:
+        blocking_sender.backlog_release_event.set()
+        upload_scheduler.close()
+
+def test_queued_jobs_of_the_same_priority_are_sent_in_one_batch():
+    blocking_sender = BlockingSender()
+    upload_scheduler = UploadScheduler(blocking_sender, max_concurrency=1)
+    upload_scheduler.start()
+    try:
+        upload_scheduler.submit("backlog/1", UploadJob.PRIORITY_BACKLOG)
+        assert blocking_sender.wait_for_batch_count(1)
+        for folder_number in range(2, 5):
+            upload_scheduler.submit(f"backlog/{folder_number}", UploadJob.PRIORITY_BACKLOG)
+        # A folder already queued is not queued twice
+        assert not upload_scheduler.submit("backlog/3", UploadJob.PRIORITY_BACKLOG)
+        blocking_sender.backlog_release_event.set()
+
+        assert blocking_sender.wait_for_batch_count(2)
+        assert blocking_sender.batch_list[1] == ["backlog/2", "backlog/3", "backlog/4"]
+    finally:
+        blocking_sender.backlog_release_event.set()
+        upload_scheduler.close()
+
+def evaluate_window(concurrency_controller, byte_count, round_trip_time):
+    """
+    Evaluate a measurement window of one second in which a number of bytes was sent.
+    """
+    concurrency_controller.window_start_time -= 1.0
+    concurrency_controller.evaluate(concurrency_controller.window_start_byte_count + byte_count,
+                                    round_trip_time)
+
+def test_concurrency_grows_while_throughput_grows_and_backs_off_on_congestion():
+    concurrency_controller = ConcurrencyController(max_concurrency=4)
+
+    evaluate_window(concurrency_controller, 1000, 0.05)
+    assert concurrency_controller.concurrency_limit == 2
+    evaluate_window(concurrency_controller, 2000, 0.05)
+    assert concurrency_controller.concurrency_limit == 3
+
+    # One more transfer that does not raise the throughput is taken back
+    evaluate_window(concurrency_controller, 2000, 0.05)
+    assert concurrency_controller.concurrency_limit == 2
+
+    # A round trip time far above the lowest one seen means congestion
+    evaluate_window(concurrency_controller, 2000, 0.5)
+    assert concurrency_controller.concurrency_limit == 1
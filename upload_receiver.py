@@ -0,0 +1,501 @@
+"""
+This module is a small reference server that receives images sent by an
+HttpUploadTransport and stores them below a root directory. It can run on the
+server instead of an SSH account for rsync, or on the host device itself to
+test the upload path.
+
+Files are received in chunks, which may arrive in any order and at the same
+time. Every chunk is checked against its SHA-256 and written at its offset into
+a partial file next to the final file, and its range is recorded in a ranges
+file. The offset the receiver reports for a file is the number of bytes it has
+from the start of the file without a gap, so a client that lost its connection
+sends only the rest. Once all chunks are in, the client completes the file: the
+receiver checks its size and SHA-256 and moves it in place, or drops it if it
+does not match so that it is sent again from the start.
+
+The protocol:
+
+- GET /ping answers 204, to measure the round trip time
+- PUT /directories/<folder> creates a folder and its parents
+- HEAD /files/<file> answers the Upload-Offset of the file, or 404 if none of it
+  was received. A complete file is answered with Upload-Complete: 1 and its
+  Content-SHA256
+- PATCH /files/<file> writes a chunk at its Upload-Offset, checked against its
+  Content-SHA256. Chunks larger than the maximum chunk size are answered 413,
+  chunks without a Content-Length 411. A PUT, PATCH or POST with a Content-Length
+  that is not a number or negative is answered 400
+- POST /files/<file> completes a file of Upload-Length bytes with the
+  Content-SHA256 of the whole file
+
+If a token is given, every request must carry it as Authorization: Bearer.
+
+Typical usage example:
+
+    upload_receiver = UploadReceiver(root_directory, port, token)
+    upload_receiver.start()
+    upload_receiver.close()
+
+    python3 upload_receiver.py --root-directory ./received --port 8808
+
+"""
+
+import os
+import hmac
+import hashlib
+import logging
+import argparse
+import threading
+import contextlib
+import collections
+import http.server
+import urllib.parse
+from dashboard_transport import HttpUploadTransport
+
+class UploadRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    A class that answers the requests of an HttpUploadTransport for the
+    UploadReceiver of its server.
+    """
+    protocol_version = "HTTP/1.1" # Keep connections open between requests
+
+    def check_authorization(self):
+        """
+        Check the bearer token of the request, and answer 401 if it is wrong.
+
+        Returns:
+            bool : True if the request may go on
+
+        """
+        token = self.server.upload_receiver.token
+        if token is None:
+            return True
+        authorization = self.headers.get("Authorization", "")
+        if hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+            return True
+        self.discard_body()
+        self.send_empty_response(401)
+        return False
+
+    def get_content_length(self):
+        """
+        Get the length of the body of the request from its Content-Length.
+
+        Returns:
+            int : the length of the body, 0 if there is no Content-Length, or None if
+                it is not a number or negative
+
+        """
+        content_length = self.headers.get("Content-Length")
+        if content_length is None:
+            return 0
+        try:
+            body_length = int(content_length)
+        except ValueError:
+            return None
+        return body_length if body_length >= 0 else None
+
+    def discard_body(self):
+        """
+        Read the body of the request, so that the connection can be used again. A
+        body larger than a chunk, or of unknown length, is not read, and the
+        connection is closed instead.
+
+        Returns:
+            bool : False if the Content-Length is not a number or negative
+
+        """
+        body_length = self.get_content_length()
+        if body_length is None or body_length > self.server.upload_receiver.max_chunk_size:
+            self.close_connection = True
+        elif body_length > 0:
+            self.rfile.read(body_length)
+        return body_length is not None
+
+    def send_empty_response(self, status, headers=None):
+        """
+        Answer with a status and headers, without a body.
+
+        """
+        self.send_response(status)
+        for header_name, header_value in (headers or {}).items():
+            self.send_header(header_name, header_value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def get_local_path(self, path_prefix):
+        """
+        Get the path below the root directory that the request path stands for.
+
+        Returns:
+            string : the local path, or None if the request path does not start with
+                    the prefix or leaves the root directory
+
+        """
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if not path.startswith(path_prefix):
+            return None
+        return self.server.upload_receiver.get_local_path(path[len(path_prefix):])
+
+    def do_GET(self):
+        """
+        Answer a ping.
+
+        """
+        if not self.check_authorization():
+            return
+        if urllib.parse.urlsplit(self.path).path != HttpUploadTransport.PING_PATH:
+            self.send_empty_response(404)
+            return
+        self.send_empty_response(204)
+
+    def do_PUT(self):
+        """
+        Create a folder.
+
+        """
+        if not self.check_authorization():
+            return
+        local_folder = self.get_local_path(HttpUploadTransport.DIRECTORIES_PATH)
+        if not self.discard_body() or local_folder is None:
+            self.send_empty_response(400)
+            return
+        try:
+            os.makedirs(local_folder, exist_ok=True)
+        except OSError:
+            logging.exception("Could not create folder %s", local_folder)
+            self.send_empty_response(500)
+            return
+        self.send_empty_response(204)
+
+    def do_HEAD(self):
+        """
+        Answer how much of a file was received.
+
+        """
+        if not self.check_authorization():
+            return
+        local_file = self.get_local_path(HttpUploadTransport.FILES_PATH)
+        if local_file is None:
+            self.send_empty_response(400)
+            return
+        upload_state = self.server.upload_receiver.get_upload_state(local_file)
+        if upload_state is None:
+            self.send_empty_response(404)
+            return
+        self.send_empty_response(200, upload_state)
+
+    def do_PATCH(self):
+        """
+        Write a chunk of a file.
+
+        """
+        if not self.check_authorization():
+            return
+        local_file = self.get_local_path(HttpUploadTransport.FILES_PATH)
+        chunk_length = self.get_content_length()
+        if chunk_length is None or "Content-Length" not in self.headers:
+            # The end of the body is not known, so the connection cannot be used again
+            self.close_connection = True
+            self.send_empty_response(400 if chunk_length is None else 411)
+            return
+        try:
+            chunk_offset = int(self.headers[HttpUploadTransport.OFFSET_HEADER])
+            file_size = int(self.headers[HttpUploadTransport.LENGTH_HEADER])
+        except (TypeError, ValueError):
+            self.discard_body()
+            self.send_empty_response(400)
+            return
+        if chunk_length > self.server.upload_receiver.max_chunk_size:
+            # The body is not read, so the connection cannot be used again
+            self.close_connection = True
+            self.send_empty_response(413)
+            return
+        chunk = self.rfile.read(chunk_length)
+        if local_file is None or chunk_offset < 0 or chunk_offset + len(chunk) > file_size:
+            self.send_empty_response(400)
+            return
+        if hashlib.sha256(chunk).hexdigest() != self.headers.get(HttpUploadTransport.HASH_HEADER):
+            logging.warning("Chunk at %s of %s does not match its SHA-256", chunk_offset,
+                            local_file)
+            self.send_empty_response(422)
+            return
+        try:
+            upload_offset = self.server.upload_receiver.write_chunk(local_file, chunk_offset,
+                                                                    chunk)
+        except OSError:
+            logging.exception("Could not write chunk at %s of %s", chunk_offset, local_file)
+            self.send_empty_response(500)
+            return
+        self.send_empty_response(204, {HttpUploadTransport.OFFSET_HEADER: str(upload_offset)})
+
+    def do_POST(self):
+        """
+        Complete a file.
+
+        """
+        if not self.check_authorization():
+            return
+        if not self.discard_body():
+            self.send_empty_response(400)
+            return
+        local_file = self.get_local_path(HttpUploadTransport.FILES_PATH)
+        try:
+            file_size = int(self.headers[HttpUploadTransport.LENGTH_HEADER])
+        except (TypeError, ValueError):
+            self.send_empty_response(400)
+            return
+        file_hash = self.headers.get(HttpUploadTransport.HASH_HEADER)
+        if local_file is None or file_hash is None:
+            self.send_empty_response(400)
+            return
+        try:
+            status = self.server.upload_receiver.complete_file(local_file, file_size, file_hash)
+        except OSError:
+            logging.exception("Could not complete %s", local_file)
+            status = 500
+        self.send_empty_response(status)
+
+    def log_message(self, format, *args):
+        """
+        Log requests at debug level only.
+
+        """
+        logging.debug("%s %s", self.address_string(), format % args)
+
+class UploadReceiver:
+    """
+    A class that receives chunked uploads over HTTP and stores them below a root
+    directory.
+    """
+    DEFAULT_PORT = 8808
+    DEFAULT_HOST = "127.0.0.1" # Only reachable from the device itself
+    PARTIAL_FILE_SUFFIX = ".part" # Added to a file until it is complete
+    RANGES_FILE_SUFFIX = ".part.ranges" # Holds the ranges of the partial file received
+
+    def __init__(self, root_directory, port=DEFAULT_PORT, token=None, host=DEFAULT_HOST,
+                 max_chunk_size=HttpUploadTransport.DEFAULT_CHUNK_SIZE):
+        """
+        Args:
+            root_directory (string) : the directory to store the received files below
+            port (int) : the TCP port to listen on. 0 for any free port
+            token (string) : the bearer token every request must carry. None to
+                            accept all requests
+            host (string) : the address to listen on. "0.0.0.0" to be reachable from
+                        other devices
+            max_chunk_size (int) : the largest chunk accepted, in bytes. Must be at least
+                                the chunk size of the clients
+
+        """
+        self.root_directory = os.path.abspath(root_directory)
+        self.token = token
+        self.max_chunk_size = max_chunk_size
+        # Requests for the same file are handled one at a time. A lock is kept as long
+        # as a request uses it, so that all requests for a file share the same lock
+        self.file_lock_dictionary = {}
+        self.file_lock_user_count = collections.Counter()
+        self.file_lock_dictionary_lock = threading.Lock()
+        self.http_server = http.server.ThreadingHTTPServer((host, port), UploadRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.upload_receiver = self
+        self.server_thread = threading.Thread(target=self.http_server.serve_forever,
+                                              name="upload-receiver", daemon=True)
+
+    def get_port(self):
+        """
+        Get the TCP port the receiver listens on.
+
+        """
+        return self.http_server.server_address[1]
+
+    def get_local_path(self, relative_path):
+        """
+        Get the path below the root directory of a path sent by a client.
+
+        Returns:
+            string : the local path, or None if it leaves the root directory
+
+        """
+        local_path = os.path.normpath(os.path.join(self.root_directory,
+                                                   relative_path.lstrip("/")))
+        if os.path.commonpath([self.root_directory, local_path]) != self.root_directory or \
+                local_path == self.root_directory:
+            return None
+        return local_path
+
+    @contextlib.contextmanager
+    def lock_file(self, local_file):
+        """
+        Hold the lock of a file. The lock is forgotten once no request uses it.
+
+        """
+        with self.file_lock_dictionary_lock:
+            file_lock = self.file_lock_dictionary.setdefault(local_file, threading.Lock())
+            self.file_lock_user_count[local_file] += 1
+        try:
+            with file_lock:
+                yield
+        finally:
+            with self.file_lock_dictionary_lock:
+                self.file_lock_user_count[local_file] -= 1
+                if self.file_lock_user_count[local_file] <= 0:
+                    del self.file_lock_user_count[local_file]
+                    del self.file_lock_dictionary[local_file]
+
+    def read_ranges(self, local_file):
+        """
+        Read the ranges of a partial file received so far.
+
+        Returns:
+            list : tuples of the start and end of every range, sorted
+
+        """
+        try:
+            with open(local_file + self.RANGES_FILE_SUFFIX, encoding="ascii") as ranges_file:
+                return sorted(tuple(int(number) for number in line.split())
+                              for line in ranges_file if line.strip())
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def get_contiguous_length(range_list):
+        """
+        Get the number of bytes received from the start of a file without a gap.
+
+        """
+        contiguous_length = 0
+        for range_start, range_end in range_list:
+            if range_start > contiguous_length:
+                break
+            contiguous_length = max(contiguous_length, range_end)
+        return contiguous_length
+
+    def get_upload_state(self, local_file):
+        """
+        Get the headers that tell a client how much of a file was received.
+
+        Returns:
+            dict : the headers, or None if none of the file was received
+
+        """
+        with self.lock_file(local_file):
+            if os.path.exists(local_file + self.PARTIAL_FILE_SUFFIX):
+                return {HttpUploadTransport.OFFSET_HEADER:
+                        str(self.get_contiguous_length(self.read_ranges(local_file)))}
+            if os.path.isfile(local_file):
+                return {HttpUploadTransport.OFFSET_HEADER: str(os.path.getsize(local_file)),
+                        HttpUploadTransport.COMPLETE_HEADER: "1",
+                        HttpUploadTransport.HASH_HEADER:
+                        HttpUploadTransport.hash_file(local_file)}
+        return None
+
+    def write_chunk(self, local_file, chunk_offset, chunk):
+        """
+        Write a chunk at its offset into the partial file, and record its range.
+
+        Returns:
+            int : the number of bytes received from the start of the file without a gap
+
+        """
+        partial_file = local_file + self.PARTIAL_FILE_SUFFIX
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        with self.lock_file(local_file):
+            file_descriptor = os.open(partial_file, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(file_descriptor, chunk, chunk_offset)
+            finally:
+                os.close(file_descriptor)
+            with open(local_file + self.RANGES_FILE_SUFFIX, "a", encoding="ascii") as ranges_file:
+                ranges_file.write(f"{chunk_offset} {chunk_offset + len(chunk)}\n")
+            return self.get_contiguous_length(self.read_ranges(local_file))
+
+    def complete_file(self, local_file, file_size, file_hash):
+        """
+        Check the size and SHA-256 of a partial file and move it in place. A partial
+        file that does not match is dropped, so that it is sent again.
+
+        Returns:
+            int : the status to answer, 201 if the file is complete, 409 if it does not
+                match, or 404 if it was not received
+
+        """
+        partial_file = local_file + self.PARTIAL_FILE_SUFFIX
+        with self.lock_file(local_file):
+            if not os.path.exists(partial_file):
+                if file_size != 0:
+                    # Completed before, but the client did not get the answer
+                    if os.path.isfile(local_file) and \
+                            HttpUploadTransport.hash_file(local_file) == file_hash:
+                        return 201
+                    return 404
+                os.makedirs(os.path.dirname(local_file), exist_ok=True)
+                open(partial_file, "wb").close()
+            if self.get_contiguous_length(self.read_ranges(local_file)) < file_size or \
+                    os.path.getsize(partial_file) != file_size or \
+                    HttpUploadTransport.hash_file(partial_file) != file_hash:
+                logging.warning("%s does not match its size or SHA-256. Dropped", local_file)
+                os.remove(partial_file)
+                self.remove_ranges_file(local_file)
+                return 409
+            with open(partial_file, "rb") as received_file:
+                os.fsync(received_file.fileno())
+            os.replace(partial_file, local_file)
+            self.remove_ranges_file(local_file)
+        return 201
+
+    def remove_ranges_file(self, local_file):
+        """
+        Remove the ranges file of a partial file, if there is one.
+
+        """
+        try:
+            os.remove(local_file + self.RANGES_FILE_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def start(self):
+        """
+        Start receiving in the background.
+
+        """
+        os.makedirs(self.root_directory, exist_ok=True)
+        self.server_thread.start()
+        logging.info("Receiving uploads into %s on port %s", self.root_directory,
+                     self.get_port())
+
+    def close(self):
+        """
+        Stop receiving.
+
+        """
+        if self.server_thread.is_alive():
+            self.http_server.shutdown()
+            self.server_thread.join()
+        self.http_server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Receive images sent by HttpUploadTransport")
+    parser.add_argument("--root-directory", default="./received")
+    parser.add_argument("--port", type=int, default=UploadReceiver.DEFAULT_PORT)
+    parser.add_argument("--host", default=UploadReceiver.DEFAULT_HOST)
+    parser.add_argument("--token-file", help="File that contains the bearer token to require")
+    parser.add_argument("--max-chunk-size", type=int,
+                        default=HttpUploadTransport.DEFAULT_CHUNK_SIZE,
+                        help="Largest chunk accepted, in bytes")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    receiver_token = None
+    if args.token_file:
+        with open(args.token_file, encoding="utf-8") as receiver_token_file:
+            receiver_token = receiver_token_file.read().strip()
+    upload_receiver = UploadReceiver(args.root_directory, args.port, receiver_token, args.host,
+                                     args.max_chunk_size)
+    upload_receiver.start()
+    try:
+        upload_receiver.server_thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        upload_receiver.close()
@@ -0,0 +1,378 @@
+"""
+This module schedules sending timestamp folders to the server over a link whose
+bandwidth and latency change all the time, such as a cellular link.
+
+Folders are queued as upload jobs with a priority. Live images captured in the
+current run always go before the backlog left from previous runs, and a slot is
+kept free for live images so that they never wait behind a long backlog
+transfer. Each worker sends the job it takes together with more queued jobs of
+the same priority in one batch.
+
+The number of concurrent transfers adapts to the link. While jobs are waiting,
+the ConcurrencyController measures the throughput of all transfers and the round
+trip time to the server at regular intervals. It tries one more concurrent
+transfer as long as that raises the throughput, goes back if it does not, and
+reduces the concurrency when the round trip time grows far above the lowest one
+seen, which means the link is congested. An optional bandwidth cap is shared by
+all concurrent transfers.
+
+Typical usage example:
+
+    upload_scheduler = UploadScheduler(send_function, round_trip_time_function,
+                                       max_concurrency, bandwidth_limit)
+    upload_scheduler.start()
+    upload_scheduler.submit(timestamp_folder_directory, UploadJob.PRIORITY_LIVE)
+    upload_scheduler.get_progress()
+    upload_scheduler.close()
+
+"""
+
+import time
+import itertools
+import threading
+import logging
+
+class UploadJob:
+    """
+    A class that holds a timestamp folder waiting to be sent, and the progress of
+    sending it.
+    """
+    PRIORITY_LIVE = 0 # Images captured in the current run
+    PRIORITY_BACKLOG = 1 # Images left from previous runs or failed uploads
+    STATE_QUEUED = "queued"
+    STATE_SENDING = "sending"
+    STATE_DONE = "done"
+
+    def __init__(self, timestamp_folder_directory, priority, sequence_number):
+        """
+        Args:
+            timestamp_folder_directory (string) : the timestamp folder on the host device
+            priority (int) : PRIORITY_LIVE or PRIORITY_BACKLOG
+            sequence_number (int) : the order in which the job was submitted, used to
+                                    keep jobs of the same priority in order
+
+        """
+        self.timestamp_folder_directory = timestamp_folder_directory
+        self.priority = priority
+        self.sequence_number = sequence_number
+        self.state = self.STATE_QUEUED
+        self.bytes_total = 0 # Set by the send function once it lists the images
+        self.bytes_sent = 0
+        self.submitted_time = time.monotonic()
+        self.finished_time = None
+
+    def get_progress(self):
+        """
+        Get the progress of the job.
+
+        Returns:
+            dict : the folder, priority, state, bytes sent and bytes total of the job
+
+        """
+        return {"folder": self.timestamp_folder_directory,
+                "priority": self.priority,
+                "state": self.state,
+                "bytes_sent": self.bytes_sent,
+                "bytes_total": self.bytes_total}
+
+class ConcurrencyController:
+    """
+    A class that adapts the number of concurrent transfers to the measured
+    throughput and round trip time of the link.
+    """
+    EVALUATION_INTERVAL = 5.0 # Seconds of measurements between concurrency changes
+    MIN_THROUGHPUT_GAIN = 0.1 # Relative throughput gain that keeps one more transfer
+    RTT_INFLATION_LIMIT = 2.0 # Round trip time relative to the lowest seen that means congestion
+    PROBE_INTERVAL = 6 # Evaluations at a stable concurrency before trying one more
+
+    def __init__(self, max_concurrency, initial_concurrency=1):
+        """
+        Args:
+            max_concurrency (int) : the highest number of concurrent transfers
+            initial_concurrency (int) : the number of concurrent transfers to start with
+
+        """
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = min(initial_concurrency, max_concurrency)
+        self.min_round_trip_time = None
+        self.last_round_trip_time = None
+        self.previous_throughput = 0.0
+        self.last_throughput = 0.0
+        self.is_probing = False # Whether the last change added a transfer
+        self.stable_evaluation_count = self.PROBE_INTERVAL # Probe at the first evaluation
+        self.reset_window(0)
+
+    def reset_window(self, progress_byte_count):
+        """
+        Start a new measurement window.
+
+        Args:
+            progress_byte_count (int) : the number of bytes sent by all transfers so far
+
+        """
+        self.window_start_time = time.monotonic()
+        self.window_start_byte_count = progress_byte_count
+
+    def is_evaluation_due(self):
+        """
+        Check whether the measurement window is long enough to evaluate.
+
+        """
+        return time.monotonic() - self.window_start_time >= self.EVALUATION_INTERVAL
+
+    def evaluate(self, progress_byte_count, round_trip_time):
+        """
+        Change the concurrency based on the throughput of the measurement window and
+        the round trip time, then start a new window.
+
+        Args:
+            progress_byte_count (int) : the number of bytes sent by all transfers so far
+            round_trip_time (float) : the round trip time to the server in seconds, or
+                                    None if it could not be measured
+
+        Returns:
+            int : the new concurrency limit
+
+        """
+        throughput = (progress_byte_count - self.window_start_byte_count) / \
+            max(time.monotonic() - self.window_start_time, 1e-6)
+        self.last_throughput = throughput
+        self.last_round_trip_time = round_trip_time
+        if round_trip_time is not None:
+            self.min_round_trip_time = round_trip_time if self.min_round_trip_time is None \
+                else min(self.min_round_trip_time, round_trip_time)
+
+        is_congested = round_trip_time is not None and \
+            round_trip_time > self.min_round_trip_time * self.RTT_INFLATION_LIMIT
+        if is_congested or (self.is_probing and throughput <
+                            self.previous_throughput * (1 + self.MIN_THROUGHPUT_GAIN)):
+            # The link is congested, or the last added transfer did not pay off
+            self.concurrency_limit = max(self.concurrency_limit - 1, 1)
+            self.is_probing = False
+            self.stable_evaluation_count = 0
+        elif self.is_probing or self.stable_evaluation_count >= self.PROBE_INTERVAL:
+            self.is_probing = self.concurrency_limit < self.max_concurrency
+            self.concurrency_limit = min(self.concurrency_limit + 1, self.max_concurrency)
+            self.stable_evaluation_count = 0
+        else:
+            self.stable_evaluation_count += 1
+
+        self.previous_throughput = throughput
+        self.reset_window(progress_byte_count)
+        return self.concurrency_limit
+
+class UploadScheduler:
+    """
+    A class that sends queued upload jobs live first, with a number of concurrent
+    transfers adapted to the link and an optional bandwidth cap.
+    """
+    DEFAULT_MAX_CONCURRENCY = 4
+    MAX_BATCH_JOB_COUNT = 50 # Timestamp folders sent in one transfer
+    LIVE_RESERVED_SLOTS = 1 # Transfers only live jobs may use, above the concurrency limit
+
+    def __init__(self, send_function, round_trip_time_function=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, bandwidth_limit=None):
+        """
+        Args:
+            send_function (function) : called with a list of UploadJob and the bandwidth
+                                    limit of the transfer in bytes per second (or None),
+                                    sends the jobs and updates their progress. Returns
+                                    the number of bytes sent
+            round_trip_time_function (function) : returns the round trip time to the
+                                                server in seconds, or None
+            max_concurrency (int) : the highest number of concurrent backlog transfers
+            bandwidth_limit (float) : the highest total bandwidth of all transfers in
+                                    bytes per second. None for no cap
+
+        """
+        self.send_function = send_function
+        self.round_trip_time_function = round_trip_time_function
+        self.bandwidth_limit = bandwidth_limit
+        self.concurrency_controller = ConcurrencyController(max_concurrency)
+        self.worker_count = max_concurrency + self.LIVE_RESERVED_SLOTS
+
+        self.job_list = [] # Queued jobs
+        self.active_job_list = [] # Jobs being sent
+        self.active_transfer_count = 0
+        self.pending_folder_set = set() # Folders queued or being sent
+        self.sequence_counter = itertools.count()
+        self.scheduler_condition = threading.Condition()
+        self.is_closed = False
+        self.worker_list = []
+
+        self.sent_job_count = 0
+        self.sent_byte_count = 0 # Bytes confirmed on the server
+        self.finished_progress_byte_count = 0 # Bytes sent by finished jobs
+
+    def submit(self, timestamp_folder_directory, priority):
+        """
+        Queue a timestamp folder to be sent, unless it is already queued or being sent.
+
+        Args:
+            timestamp_folder_directory (string) : the timestamp folder on the host device
+            priority (int) : UploadJob.PRIORITY_LIVE or UploadJob.PRIORITY_BACKLOG
+
+        Returns:
+            bool : True if a new job was queued
+
+        """
+        with self.scheduler_condition:
+            if self.is_closed or timestamp_folder_directory in self.pending_folder_set:
+                return False
+            self.pending_folder_set.add(timestamp_folder_directory)
+            self.job_list.append(UploadJob(timestamp_folder_directory, priority,
+                                           next(self.sequence_counter)))
+            self.job_list.sort(key=lambda job: (job.priority, job.sequence_number))
+            self.scheduler_condition.notify_all()
+        return True
+
+    def can_start_transfer(self):
+        """
+        Check whether a worker may take the next queued job. Must be called with the
+        scheduler condition held.
+
+        """
+        if not self.job_list:
+            return False
+        transfer_limit = self.concurrency_controller.concurrency_limit
+        if self.job_list[0].priority == UploadJob.PRIORITY_LIVE:
+            transfer_limit += self.LIVE_RESERVED_SLOTS
+        return self.active_transfer_count < transfer_limit
+
+    def take_batch(self):
+        """
+        Take the next queued job and more queued jobs of the same priority, leaving
+        enough jobs for the other allowed transfers. Must be called with the scheduler
+        condition held.
+
+        Returns:
+            list : the jobs to send in one transfer
+
+        """
+        priority = self.job_list[0].priority
+        same_priority_count = sum(1 for job in self.job_list if job.priority == priority)
+        batch_size = min(self.MAX_BATCH_JOB_COUNT, -(-same_priority_count //
+                         self.concurrency_controller.concurrency_limit))
+        batch_job_list = self.job_list[:batch_size]
+        del self.job_list[:batch_size]
+        for job in batch_job_list:
+            job.state = UploadJob.STATE_SENDING
+        self.active_job_list.extend(batch_job_list)
+        return batch_job_list
+
+    def get_transfer_bandwidth_limit(self):
+        """
+        Get the bandwidth limit of a single transfer, an equal share of the bandwidth
+        cap among all transfers allowed at once, including the slot kept for live
+        images. Transfers cannot change their limit once started, so this keeps the
+        total under the cap at all times, and leaves bandwidth for live images.
+        Must be called with the scheduler condition held.
+
+        """
+        if self.bandwidth_limit is None:
+            return None
+        return self.bandwidth_limit / (self.concurrency_controller.concurrency_limit +
+                                       self.LIVE_RESERVED_SLOTS)
+
+    def process_jobs(self):
+        """
+        Worker loop. Send batches of queued jobs whenever the concurrency limit allows,
+        until the UploadScheduler is closed.
+
+        """
+        while True:
+            with self.scheduler_condition:
+                self.scheduler_condition.wait_for(
+                    lambda: self.is_closed or self.can_start_transfer())
+                if self.is_closed:
+                    return
+                batch_job_list = self.take_batch()
+                self.active_transfer_count += 1
+                transfer_bandwidth_limit = self.get_transfer_bandwidth_limit()
+
+            byte_count = 0
+            try:
+                byte_count = self.send_function(batch_job_list, transfer_bandwidth_limit)
+            except Exception:
+                logging.exception("Unknown Error when sending images to server")
+
+            with self.scheduler_condition:
+                self.active_transfer_count -= 1
+                for job in batch_job_list:
+                    job.state = UploadJob.STATE_DONE
+                    job.finished_time = time.monotonic()
+                    self.active_job_list.remove(job)
+                    self.pending_folder_set.discard(job.timestamp_folder_directory)
+                    self.finished_progress_byte_count += job.bytes_sent
+                self.sent_job_count += len(batch_job_list)
+                self.sent_byte_count += byte_count
+                is_evaluation_due = self.concurrency_controller.is_evaluation_due()
+                is_backlogged = bool(self.job_list)
+                if not is_backlogged:
+                    # Throughput measured while the link is idle says nothing about it
+                    self.concurrency_controller.reset_window(self.get_progress_byte_count())
+                self.scheduler_condition.notify_all()
+
+            if is_evaluation_due and is_backlogged:
+                round_trip_time = self.round_trip_time_function() \
+                    if self.round_trip_time_function is not None else None
+                with self.scheduler_condition:
+                    concurrency_limit = self.concurrency_controller.evaluate(
+                        self.get_progress_byte_count(), round_trip_time)
+                    self.scheduler_condition.notify_all()
+                logging.info("Upload concurrency %s, throughput %.0f B/s, round trip time %s s",
+                             concurrency_limit, self.concurrency_controller.last_throughput,
+                             round_trip_time)
+
+    def get_progress_byte_count(self):
+        """
+        Get the number of bytes sent by all transfers so far, including the ones in
+        progress. Must be called with the scheduler condition held.
+
+        """
+        return self.finished_progress_byte_count + sum(job.bytes_sent
+                                                       for job in self.active_job_list)
+
+    def get_progress(self):
+        """
+        Get the progress of all queued jobs and jobs being sent, and the state of the
+        scheduler.
+
+        Returns:
+            dict : the progress of every job being sent and queued, live first, the
+                concurrency limit, the number of transfers, the last measured
+                throughput and round trip time, and the number of jobs and bytes sent
+
+        """
+        with self.scheduler_condition:
+            return {"jobs": [job.get_progress() for job in self.active_job_list + self.job_list],
+                    "concurrency_limit": self.concurrency_controller.concurrency_limit,
+                    "active_transfers": self.active_transfer_count,
+                    "throughput": self.concurrency_controller.last_throughput,
+                    "round_trip_time": self.concurrency_controller.last_round_trip_time,
+                    "sent_jobs": self.sent_job_count,
+                    "sent_bytes": self.sent_byte_count}
+
+    def start(self):
+        """
+        Start the worker threads.
+
+        """
+        for worker_id in range(self.worker_count):
+            worker = threading.Thread(target=self.process_jobs,
+                                      name=f"dashboard-uploader-{worker_id}", daemon=True)
+            worker.start()
+            self.worker_list.append(worker)
+
+    def close(self):
+        """
+        Stop taking new jobs, let the workers finish the transfers in progress and stop
+        them. Queued jobs are dropped; their folders stay on the host device.
+
+        """
+        with self.scheduler_condition:
+            self.is_closed = True
+            self.job_list.clear()
+            self.scheduler_condition.notify_all()
+        for worker in self.worker_list:
+            worker.join()